@@ -326,9 +326,7 @@ class Inca:
         summary = ""
         summary += "\nTop 10 document types currently in database:\n"
         contents = self.database.list_doctypes().items()
-        for k, v in sorted(
-            self.database.list_doctypes().items(), key=lambda x: x[1], reverse=True
-        )[:10]:
+        for k, v in sorted(contents, key=lambda x: x[1], reverse=True)[:10]:
             summary += "{k:30} : {v:10}\n".format(**locals())
         if len(contents) > 10:
             summary += "...\n"
@@ -191,9 +191,13 @@ class softcosine_similarity(Analysis):
                 {"match": condition_source}
             )
 
-        # Retrieve source and target articles as generators
-        source_query = scroll_query(source_query)
-        target_query = scroll_query(target_query)
+        # Retrieve source and target articles as generators (only the fields used)
+        source_query = scroll_query(
+            source_query, source_includes=[sourcetext, sourcedate, "doctype"]
+        )
+        target_query = scroll_query(
+            target_query, source_includes=[targettext, targetdate, "doctype"]
+        )
 
         # Make generators into lists and filter out those who do not have the specified keys (preventing KeyError)
         target_query = [
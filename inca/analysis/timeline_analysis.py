@@ -5,16 +5,73 @@ This file contains the basics to generate timelines
 
 import pandas
 import numpy
-from ..core.database import client, elastic_index
+import json
+from ..core.database import client, index_for_query
+from ..core.metadata_cache import MetadataCache
+from ..core.retry import retry_call
+from ..core import rollups
 import logging
 from ..core.analysis_base_class import Analysis
 
 logger = logging.getLogger("INCA")
 
 
+# the number of timeline queries sent in a single multi-search request
+MSEARCH_BATCH_SIZE = 50
+
+# results of timeline queries, used by fit(cache=True)
+_timeline_cache = MetadataCache(ttl=300)
+
+
 class timeline_generator(Analysis):
     """Generates timelines from elasticsearch string queries"""
 
+    def _query(self, q, qt, f, timefield, granularity, from_time, to_time, filter):
+        """Returns the elasticsearch query for a single timeseries"""
+        # basic elastic query to select documents for each timeseries
+        elastic_query = {
+            "size": 0,
+            "query": {"bool": {"must": [{"query_string": {"query": q}}]}},
+            "aggs": {
+                "timeline": {
+                    "date_histogram": {"field": timefield, "interval": granularity}
+                }
+            },
+        }
+        if qt != "count":
+            elastic_query["aggs"]["timeline"].update(
+                {"aggs": {"metric": {qt: {"field": f}}}}
+            )
+
+        # add time range if from or to time is specified
+        time_range = {timefield: {}}
+        if from_time:
+            time_range[timefield].update({"gte": from_time})
+        if to_time:
+            time_range[timefield].update({"lte": to_time})
+
+        # apply filter if specified
+        if type(filter) == str:
+            elastic_query["query"]["bool"]["must"].append(
+                {"query_string": {"query": filter}}
+            )
+        elif type(filter) == dict:
+            elastic_query["query"]["bool"]["must"].append({"match": filter})
+
+        if from_time or to_time:
+            elastic_query["query"]["bool"]["must"].append({"range": time_range})
+        return elastic_query
+
+    def _search(self, elastic_queries):
+        """Runs the queries with multi-search requests, returns their responses"""
+        responses = []
+        for start in range(0, len(elastic_queries), MSEARCH_BATCH_SIZE):
+            body = []
+            for elastic_query in elastic_queries[start : start + MSEARCH_BATCH_SIZE]:
+                body.extend([{"index": index_for_query(elastic_query)}, elastic_query])
+            responses.extend(retry_call(client.msearch, body=body)["responses"])
+        return responses
+
     def fit(
         self,
         queries,
@@ -25,8 +82,19 @@ class timeline_generator(Analysis):
         from_time=None,
         to_time=None,
         filter=None,
+        cache=False,
+        rollup=False,
     ):
-        """returns a pandas dataframe """
+        """returns a pandas dataframe
+
+        All queries are sent in multi-search requests, each resulting in a
+        column of the dataframe. With `cache=True`, the results of queries
+        that were run in the last five minutes are reused.
+
+        With `rollup=True`, counts per day or coarser granularity are read
+        from stored daily rollups (see `core.rollups`), which are first
+        updated with the documents added since their last update.
+        """
         if type(queries) == str:
             queries = [queries]
         if type(querytype) == str:
@@ -42,100 +110,75 @@ class timeline_generator(Analysis):
                 field
             ), "if specified, there should be a field for each query"
 
-        target_dataframe = False
-        prepend = []
-
-        for num, q, qt, f in zip(range(len(queries)), queries, querytype, field):
-            logger.debug(num, q, qt, f)
-            if qt != "count" and not field:
+        elastic_queries = []
+        for q, qt, f in zip(queries, querytype, field):
+            if qt != "count" and not f:
                 logger.info(
                     "metrics require a field to which the metric should be applied!,"
                     "which field should be {qt}-ed".format(**locals())
                 )
-
-            # basic elastic query to select documents for each timeseries
-            elastic_query = {
-                "query": {"bool": {"must": [{"query_string": {"query": q}}]}},
-                "aggs": {
-                    "timeline": {
-                        "date_histogram": {"field": timefield, "interval": granularity}
-                    }
-                },
-            }
-            if qt != "count":
-                elastic_query["aggs"]["timeline"].update(
-                    {"aggs": {"metric": {qt: {"field": f}}}}
-                )
-
-            # add time range if from or to time is specified
-            time_range = {timefield: {}}
-            if from_time:
-                time_range[timefield].update({"gte": from_time})
-            if to_time:
-                time_range[timefield].update({"lte": to_time})
-
-            # apply filter if specified
-            if type(filter) == str:
-                elastic_query["query"]["bool"]["must"].append(
-                    {"query_string": {"query": filter}}
+            elastic_queries.append(
+                self._query(
+                    q, qt, f, timefield, granularity, from_time, to_time, filter
                 )
-            elif type(filter) == dict:
-                elastic_query["query"]["bool"]["must"].append({"match": filter})
-
-            if from_time or to_time:
-                elastic_query["query"]["bool"]["must"].append({"range": time_range})
-
-            logger.debug("elastic query = {elastic_query}".format(**locals()))
-            res = client.search(elastic_index, body=elastic_query, size=0)
-            logger.debug("found {res[hits][total]} results in total".format(**locals()))
-
-            if qt == "count":
-                df = pandas.DataFrame(res["aggregations"]["timeline"]["buckets"])
-            else:
-                df = pandas.DataFrame(
-                    [
-                        {
-                            "doc_count": b["metric"]["value"],
-                            "key_as_string": b["key_as_string"],
-                        }
-                        for b in res["aggregations"]["timeline"]["buckets"]
-                    ]
-                )
-            logger.debug("dataframe: {df}".format(**locals()))
-            num += 1
+            )
+        logger.debug("elastic queries = {elastic_queries}".format(**locals()))
+
+        keys = [json.dumps(query, sort_keys=True) for query in elastic_queries]
+        results = {}
+        if rollup and rollups.supports(granularity, from_time, to_time):
+            store = rollups.RollupStore()
+            for q, qt, key in zip(queries, querytype, keys):
+                if qt == "count" and key not in results:
+                    base_query = self._query(
+                        q, qt, None, timefield, granularity, None, None, filter
+                    )["query"]
+                    results[key] = store.timeline(
+                        base_query, timefield, granularity, from_time, to_time
+                    )
+        if cache:
+            for key in keys:
+                if key in results:
+                    continue
+                res = _timeline_cache.peek(key)
+                if res is not None:
+                    results[key] = res
+        missing = [key for key in keys if key not in results]
+        for key, res in zip(
+            missing, self._search([json.loads(key) for key in missing])
+        ):
+            if "error" in res:
+                raise Exception("timeline query failed: {}".format(res["error"]))
+            results[key] = res
+            if cache:
+                _timeline_cache.put(key, res)
+
+        columns = {}
+        for num, q, qt, key in zip(
+            range(1, len(queries) + 1), queries, querytype, keys
+        ):
+            res = results[key]
             longer = len(q) > 10 and "..." or "   "
             new_name = "{num}. {q:.10}{longer}".format(**locals())
-
-            df = df.rename(
-                columns={"doc_count": new_name, "key_as_string": "timestamp"}
+            if type(res) == pandas.Series:
+                # counts read from a rollup
+                columns[new_name] = res
+                continue
+            logger.debug("found {res[hits][total]} results in total".format(**locals()))
+            columns[new_name] = pandas.Series(
+                {
+                    b["key_as_string"]: (
+                        b["doc_count"] if qt == "count" else b["metric"]["value"]
+                    )
+                    for b in res["aggregations"]["timeline"]["buckets"]
+                },
+                dtype=float,
             )
 
-            if type(target_dataframe) == bool and target_dataframe == False:
-                if df.empty:
-                    prepend.append(new_name)
-                    continue
-                else:
-                    target_dataframe = df[["timestamp", new_name]]
-            elif df.empty:
-                target_dataframe[new_name] = numpy.nan
-            else:
-                target_dataframe = target_dataframe.merge(
-                    df[["timestamp", new_name]], on="timestamp", how="outer"
-                )
-
-            if prepend:
-                colnames = [
-                    name for name in target_dataframe.columns if name != "timestamp"
-                ]
-                for empty_column in prepend:
-                    target_dataframe[empty_column] = numpy.nan
-                ordered_cols = ["timestamp"] + prepend + list(colnames)
-                target_dataframe = target_dataframe[ordered_cols]
-                prepend = []
-
-        if not (type(target_dataframe) == bool and target_dataframe == False):
-            target_dataframe = target_dataframe.replace(numpy.nan, 0)
-            return target_dataframe
-        else:
+        target_dataframe = pandas.DataFrame(columns, columns=list(columns))
+        if target_dataframe.empty:
             logger.info("Empty result")
             return pandas.DataFrame()
+        target_dataframe = target_dataframe.sort_index().replace(numpy.nan, 0)
+        target_dataframe.index.name = "timestamp"
+        return target_dataframe.reset_index()
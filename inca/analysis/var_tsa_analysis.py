@@ -57,6 +57,7 @@ class VAR(Analysis):
                 @max_order_detrend = maximum order of detredning, default = 2
                 @stationarity_kpss = True/False, False is default, hence you do ADF test
                 @self.ic = aic/bic/fpe, information criteria, default ='aic'
+                @rollup = True/False, read daily or coarser counts from stored rollups, default = False
         """
         self.max_order_diff = kwargs.get("max_order_diff", 2)
         self.max_order_detrend = kwargs.get("max_order_detrend", 2)
@@ -67,12 +68,14 @@ class VAR(Analysis):
         self.ic = kwargs.get("ic", "aic")
 
         timeline = ta.timeline_generator()
-        df_raw = timeline.analyse(
+        df_raw = timeline.fit(
             queries=queries,
             timefield=timefield,
             granularity=granularity,
+            querytype=querytype,
             from_time=self.from_time,
             to_time=self.to_time,
+            rollup=kwargs.get("rollup", False),
         )
         df_raw.index = df_raw.timestamp
         df_raw = df_raw.drop("timestamp", axis=1)
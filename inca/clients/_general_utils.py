@@ -7,9 +7,10 @@ Mapping : for storing pools in elasticsearch
 """
 
 from ..core.database import client
+from ..core.retry import retry_call
 import datetime
 import logging
-from elasticsearch import NotFoundError, ConnectionTimeout
+from elasticsearch import NotFoundError, ConnectionError
 
 logger = logging.getLogger("INCA")
 
@@ -36,11 +37,14 @@ def put_credentials(service_name, credentials, id, pool_name="default", force=Fa
         Represents the success state of the put request
     """
     try:
-        credentials = client.get("credentials", doc_type=service_name, id=id)
+        credentials = retry_call(
+            client.get, "credentials", doc_type=service_name, id=id
+        )
         logger.info("Updating existing credentials [{id}]".format(**locals()))
         if not pool_name in credentials["_source"]["pools"]:
             credentials["_source"]["pools"].append(pool_name)
-            client.update(
+            retry_call(
+                client.update,
                 index="credentials",
                 doc_type=service_name,
                 id=id,
@@ -57,7 +61,8 @@ def put_credentials(service_name, credentials, id, pool_name="default", force=Fa
             )
             return False
         elif force:
-            client.index(
+            retry_call(
+                client.index,
                 index="credentials",
                 doc_type=service_name,
                 id=id,
@@ -70,12 +75,16 @@ def put_credentials(service_name, credentials, id, pool_name="default", force=Fa
             "pools": [pool_name],
             "credentials": credentials,
         }
-        client.index(
-            index="credentials", doc_type=service_name, id=id, body=credentials
+        retry_call(
+            client.index,
+            index="credentials",
+            doc_type=service_name,
+            id=id,
+            body=credentials,
         )
-    except ConnectionTimeout:
-        logger.warn("elasticsearch timed out, retrying... ")
-        return put_credentials(service_name, pool_name, credentials, id, force)
+    except ConnectionError:
+        logger.warning("Could not connect to Elasticsearch, credentials not stored")
+        return False
     return True
 
 
@@ -95,7 +104,7 @@ def delete_credentials(service_name, pool_name, id):
     -------
     Boolean indicating success
     """
-    client.delete(service_name, pool_name, id)
+    retry_call(client.delete, service_name, pool_name, id)
 
 
 def get_credentials(service_name, pool_name="default", filter=None):
@@ -121,7 +130,9 @@ def get_credentials(service_name, pool_name="default", filter=None):
     else:
         full_query = {"query": {"query_string": {"query": base_query}}}
     try:
-        return client.search("credentials", body=full_query)["hits"]["hits"][0]
+        return retry_call(client.search, "credentials", body=full_query)["hits"][
+            "hits"
+        ][0]
     except Exception as e:
         logger.warning("get_credentials failed {e}".format(**locals()))
         return []
@@ -140,7 +151,7 @@ def get_credentials_by_id(id):
     credentials: dict
         dictionary typed credentials object, with service specific credentials in the 'credentials' key
     """
-    return client.get(index="credentials", id=id)
+    return retry_call(client.get, index="credentials", id=id)
 
 
 def update_credentials_last(id, last_response):
@@ -159,9 +170,10 @@ def update_credentials_last(id, last_response):
     Bool
         indicates update status
     """
-    credentials = client.get(index="credentials", id=id)
+    credentials = retry_call(client.get, index="credentials", id=id)
     credentials["_source"]["last"] = last_response
-    client.index(
+    retry_call(
+        client.index,
         "credentials",
         doc_type=credentials["_type"],
         body=credentials["_source"],
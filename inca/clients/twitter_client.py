@@ -214,8 +214,14 @@ class twitter_timeline(twitter):
                 if not batchsize:
                     continue
                 max_id = min([tweet.get("id", None) for tweet in tweets]) - 1
+                if force:
+                    existing = {}
+                else:
+                    existing = self._check_exists_many(
+                        [tweet["id_str"] for tweet in tweets]
+                    )
                 for num, tweet in enumerate(tweets):
-                    if self._check_exists(tweet["id_str"])[0] and not force:
+                    if existing.get(tweet["id_str"], False):
                         logger.info(
                             "skipping existing {screen_name}-{tweet[id]}".format(
                                 **locals()
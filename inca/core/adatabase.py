@@ -0,0 +1,632 @@
+"""
+Asynchronous counterparts of the CRUD functionality in `core.database`.
+
+The functions in this module are coroutines that share a single
+`AsyncElasticsearch` client per event loop, so that scrapers and services
+that do lots of I/O can have many requests outstanding at once instead of
+waiting for each of them:
+
+```
+async def save(documents):
+    async with AsyncBulkWriter() as writer:
+        for document in documents:
+            await writer.insert(document)
+```
+
+Settings (connection, index, index layout and retries) are the same as those
+of `core.database`. The asynchronous client requires elasticsearch-py 7.8 or
+higher, which is not installed by default (the requirements pin
+elasticsearch 6). Install it with `pip install inca[async]`; without it,
+the coroutines and `AsyncBulkWriter` raise an ImportError that says so.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+
+from elasticsearch import NotFoundError, __versionstr__
+from elasticsearch.exceptions import TransportError
+
+from .database import (
+    client_options,
+    elastic_index,
+    INDEX_LAYOUT,
+    MIGRATION_ALIAS,
+    MGET_CHUNK_SIZE,
+    _index_name,
+    _known_indices,
+    _layout_schema,
+    _remove_dots,
+    _set_index,
+    _update_current_version,
+    _source_filter,
+    index_for_query,
+    search_index,
+)
+from .metadata_cache import metadata_cache
+from .retry import RetryPolicy, default_policy
+
+logger = logging.getLogger("INCA")
+
+ASYNC_MISSING = (
+    "The asynchronous database functions require elasticsearch[async]>=7.8,<8 "
+    "(found elasticsearch {version}), install them with `pip install inca[async]`"
+)
+
+try:
+    from elasticsearch import AsyncElasticsearch
+    from elasticsearch.helpers import async_scan
+except ImportError:
+    AsyncElasticsearch = None
+    logger.debug(ASYNC_MISSING.format(version=__versionstr__))
+
+_client = None
+_client_key = None
+_client_loop = None
+
+
+def get_client():
+    """Returns the asynchronous elasticsearch client of the running event loop
+
+    A client (with its connection pool) is bound to the event loop and the
+    process in which it was created, a new one is created for other loops
+    or forked processes.
+    """
+    global _client, _client_key, _client_loop
+    if AsyncElasticsearch is None:
+        raise ImportError(ASYNC_MISSING.format(version=__versionstr__))
+    loop = asyncio.get_event_loop()
+    key = (os.getpid(), id(loop))
+    if _client is None or _client_key != key:
+        # the connections of a parent process are left to the parent
+        if _client is not None and _client_key[0] == os.getpid():
+            _close_in_loop(_client, _client_loop)
+        _client = AsyncElasticsearch(**client_options())
+        _client_key = key
+        _client_loop = loop
+    return _client
+
+
+def _close_in_loop(old_client, loop):
+    """Closes the client of another event loop, if that loop has not ended"""
+    if loop.is_closed():
+        logger.debug(
+            "Unable to close the elasticsearch client of an event loop that ended, await adatabase.close() before a loop ends"
+        )
+    elif loop.is_running():
+        asyncio.run_coroutine_threadsafe(old_client.close(), loop)
+    else:
+        # this thread may run another loop, which prevents running `loop` here
+        closer = threading.Thread(
+            target=loop.run_until_complete, args=(old_client.close(),)
+        )
+        closer.start()
+        closer.join()
+
+
+async def close():
+    """Closes the connections of the client of this event loop"""
+    global _client, _client_key, _client_loop
+    if _client is not None:
+        await _client.close()
+        _client, _client_key, _client_loop = None, None, None
+
+
+async def retry_call(function, *args, **kwargs):
+    """Await `function` with the given arguments under the default policy"""
+    return await default_policy.acall(function, *args, **kwargs)
+
+
+async def database_available():
+    """Checks whether elasticsearch can be reached"""
+    try:
+        return await get_client().ping()
+    except Exception as e:
+        logger.debug("Unable to communicate with elasticsearch, {}".format(e))
+        return False
+
+
+async def _ensure_index(name):
+    """Creates an index of the layout if needed, see `database._ensure_index`"""
+    if name in _known_indices:
+        return
+    try:
+        await retry_call(get_client().indices.create, index=name, body=_layout_schema())
+        logger.info("Created index {name}".format(**locals()))
+    except TransportError as e:
+        if e.error != "resource_already_exists_exception":
+            raise
+    _known_indices.add(name)
+
+
+async def index_for(document):
+    """Returns the index to which a new document is written"""
+    name = _index_name(document)
+    if name != elastic_index:
+        await _ensure_index(name)
+    return name
+
+
+async def migration_target():
+    """The index to which a running `database.reindex` copies documents, if any"""
+    if INDEX_LAYOUT != "single":
+        return None
+    cached = metadata_cache.peek("migration")
+    if cached is not None:
+        return cached or None
+    try:
+        aliases = await retry_call(get_client().indices.get_alias, name=MIGRATION_ALIAS)
+        target = list(aliases)[0]
+    except NotFoundError:
+        # the absence of a migration is cached as "", like `database.migration_target`
+        target = ""
+    metadata_cache.put("migration", target)
+    return target or None
+
+
+async def _mirror_writes(writes):
+    """Repeats writes on the index of a running migration, see
+    `database._mirror_writes`
+    """
+    target = await migration_target()
+    if not target or not writes:
+        return
+    lines = []
+    for op_type, _id, body in writes:
+        lines.append({op_type: {"_index": target, "_type": "doc", "_id": _id}})
+        if op_type == "update":
+            body = {"doc": body["doc"]}
+        if body is not None:
+            lines.append(body)
+    response = await retry_call(get_client().bulk, body=lines)
+    for item in response["items"]:
+        op_type, result = list(item.items())[0]
+        if result.get("status", 500) >= 300 and result.get("status") not in (404, 409):
+            logger.warning(
+                "Failed to {op_type} {result[_id]} in {target}: {error}".format(
+                    error=result.get("error"), **locals()
+                )
+            )
+
+
+async def check_exists(document_id):
+    """Checks whether a document exists
+
+    Returns
+    ----
+    tuple
+        A boolean indicating whether the document exists and the document
+        (an empty dict if it does not exist)
+    """
+    if document_id is None or str(document_id).strip() == "":
+        logger.warning("You did not provide a document_id, returning False")
+        return False, {}
+    es = get_client()
+    if INDEX_LAYOUT != "single":
+        response = await retry_call(
+            es.search,
+            index=search_index(),
+            body={"size": 1, "query": {"ids": {"values": [document_id]}}},
+        )
+        hits = response["hits"]["hits"]
+        if hits:
+            return True, hits[0]
+        return False, {}
+    try:
+        retrieved = await retry_call(
+            es.get, index=elastic_index, doc_type="doc", id=document_id
+        )
+        return True, retrieved
+    except NotFoundError:
+        return False, {}
+
+
+async def check_exists_many(document_ids, chunk_size=None):
+    """Check for a batch of document ids whether they exist
+
+    The `_mget` requests of all chunks are sent concurrently, see
+    `database.check_exists_many`.
+
+    Returns
+    ----
+    dict
+        A mapping of each (string) id to a boolean indicating whether it exists
+    """
+    if not chunk_size:
+        chunk_size = MGET_CHUNK_SIZE
+    document_ids = [str(_id) for _id in document_ids if _id is not None]
+    existing = {_id: False for _id in document_ids}
+    for_lookup = [_id for _id in existing if _id.strip() != ""]
+    es = get_client()
+
+    async def lookup(chunk):
+        if INDEX_LAYOUT != "single":
+            response = await retry_call(
+                es.search,
+                index=search_index(),
+                body={
+                    "size": len(chunk),
+                    "_source": False,
+                    "query": {"ids": {"values": chunk}},
+                },
+            )
+            return {hit["_id"]: True for hit in response["hits"]["hits"]}
+        response = await retry_call(
+            es.mget,
+            index=elastic_index,
+            doc_type="doc",
+            body={"ids": chunk},
+            _source=False,
+        )
+        return {doc["_id"]: doc.get("found", False) for doc in response["docs"]}
+
+    for found in await asyncio.gather(
+        *[
+            lookup(for_lookup[start : start + chunk_size])
+            for start in range(0, len(for_lookup), chunk_size)
+        ]
+    ):
+        existing.update(found)
+    return existing
+
+
+async def locate(document_ids):
+    """Finds the indices the given documents are stored in, see
+    `database.locate`
+    """
+    document_ids = [str(_id) for _id in document_ids]
+    if INDEX_LAYOUT == "single":
+        return {_id: elastic_index for _id in document_ids}
+    es = get_client()
+
+    async def lookup(chunk):
+        response = await retry_call(
+            es.search,
+            index=search_index(),
+            body={
+                "size": len(chunk),
+                "_source": False,
+                "query": {"ids": {"values": chunk}},
+            },
+        )
+        return {hit["_id"]: hit["_index"] for hit in response["hits"]["hits"]}
+
+    located = {}
+    for found in await asyncio.gather(
+        *[
+            lookup(document_ids[start : start + MGET_CHUNK_SIZE])
+            for start in range(0, len(document_ids), MGET_CHUNK_SIZE)
+        ]
+    ):
+        located.update(found)
+    return located
+
+
+async def insert_document(document, custom_identifier=""):
+    """Insert a new document, see `database.insert_document`
+
+    Returns
+    ----
+    string
+        The id of the document, or an empty dict if `custom_identifier`
+        already exists
+    """
+    document = _remove_dots(document)
+    source = document.get("_source", document)
+    request = dict(index=await index_for(document), doc_type="doc", body=source)
+    if custom_identifier:
+        if (await check_exists(custom_identifier))[0]:
+            logger.warning(
+                "Custom Identifier already exists in database, document is not inserted. Please choose a different identifier."
+            )
+            return {}
+        request["id"] = custom_identifier
+    doc = await retry_call(get_client().index, **request)
+    await _mirror_writes([("index", doc["_id"], source)])
+    metadata_cache.invalidate("doctypes")
+    return doc["_id"]
+
+
+async def insert_documents(documents, identifiers="id"):
+    """Insert a batch of documents, see `database.insert_documents`
+
+    Returns
+    ----
+    List: the ID's under which the documents were inserted
+    """
+    if type(identifiers) == list:
+        if not len(identifiers) == len(documents):
+            logger.warning(
+                "Identifiers and documents are not of same length, "
+                "there are %s docs and %s identifiers!"
+                % (len(documents), len(identifiers))
+            )
+            raise Exception("Unable to process document batch")
+        id_values = identifiers
+    else:
+        id_values = [doc.get(identifiers, "") for doc in documents]
+
+    existing = await check_exists_many([id_value for id_value in id_values if id_value])
+    inserted_ids = []
+    async with AsyncBulkWriter() as writer:
+        for doc, id_value in zip(documents, id_values):
+            if id_value and existing.get(str(id_value), False):
+                logger.warning(
+                    "Identifier %s already exists in database, document is not inserted. Please choose a different identifier."
+                    % id_value
+                )
+                continue
+            doc.pop("_id", None)
+            inserted_ids.append(id_value or "random")
+            await writer.insert(doc, custom_identifier=id_value or None)
+    return inserted_ids
+
+
+async def update_document(document, force=False):
+    """Update a document, see `database.update_document`"""
+    exists, old_document = await check_exists(document["_id"])
+    if not exists:
+        return await insert_document(document, custom_identifier=document["_id"])
+    es = get_client()
+    if force:
+        source = _remove_dots(document)["_source"]
+        await retry_call(
+            es.index,
+            index=old_document["_index"],
+            doc_type="doc",
+            id=document["_id"],
+            body=source,
+        )
+        await _mirror_writes([("index", document["_id"], source)])
+    else:
+        document["_source"].update(old_document["_source"])
+        source = _remove_dots(document)["_source"]
+        await retry_call(
+            es.update,
+            index=old_document["_index"],
+            doc_type="doc",
+            id=document["_id"],
+            body={"doc": source},
+        )
+        await _mirror_writes([("update", document["_id"], {"doc": source})])
+    metadata_cache.invalidate("doctypes")
+
+
+async def scroll_query(
+    query, scroll_time="30m", source_includes=None, source_excludes=None
+):
+    """Scroll through the results of a query, see `database.scroll_query`
+
+    yields
+    ----
+    dict
+        A stored document, including elasticsearch metadata
+    """
+    query = _source_filter(query, source_includes, source_excludes)
+    async for doc in async_scan(
+        get_client(), index=index_for_query(query), query=query, scroll=scroll_time
+    ):
+        yield doc
+
+
+class AsyncBulkWriter(object):
+    """Buffers writes and sends them in concurrent bulk requests
+
+    The asynchronous counterpart of `database.BulkWriter`, with the same
+    handling of rejected and conflicting actions. Up to `concurrency` bulk
+    requests are in flight at the same time, `insert`, `update` and `delete`
+    wait when that many are.
+
+    ```
+    async with AsyncBulkWriter() as writer:
+        async for doc in scroll_query(query):
+            doc["_source"]["new_field"] = "new value"
+            await writer.update(doc, fields=["new_field"])
+    ```
+
+    Parameters
+    ----
+    batch_size : int (default=500)
+        The number of buffered actions that triggers a bulk request
+    concurrency : int (default=4)
+        The maximum number of bulk requests sent at the same time
+    max_retries : int (default=5)
+        The number of times rejected and conflicting items are retried
+    backoff : int or float (default=1)
+        The maximum number of seconds to wait before the first retry, doubled
+        for every next retry
+    """
+
+    def __init__(self, batch_size=500, concurrency=4, max_retries=5, backoff=1):
+        if AsyncElasticsearch is None:
+            # rather than after buffering the first batch
+            raise ImportError(ASYNC_MISSING.format(version=__versionstr__))
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._retry = RetryPolicy(max_attempts=max_retries + 1, base_delay=backoff)
+        self.written = 0
+        self.skipped = 0
+        self.failed = []
+        self._buffer = []
+        self._slots = asyncio.Semaphore(concurrency)
+        self._requests = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.flush()
+        self.report()
+        return False
+
+    async def insert(self, document, custom_identifier=None):
+        """Queue a new document, see `database.BulkWriter.insert`"""
+        action = {"_index": await index_for(document), "_type": "doc"}
+        if custom_identifier:
+            action["_id"] = custom_identifier
+            op_type = "create"
+        else:
+            op_type = "index"
+        body = _remove_dots(document.get("_source", document))
+        await self._add({op_type: action}, body, document, False)
+
+    async def update(self, document, fields=None, force=False):
+        """Queue a partial update, see `database.BulkWriter.update`"""
+        source = document["_source"]
+        if fields:
+            source = {key: source[key] for key in fields if key in source}
+        action = {"_type": "doc", "_id": document["_id"]}
+        _set_index(action, document.get("_index"))
+        body = {"doc": _remove_dots(source)}
+        if "_seq_no" in document and "_primary_term" in document:
+            # conditional updates cannot upsert, a document that is gone is skipped
+            action["if_seq_no"] = document["_seq_no"]
+            action["if_primary_term"] = document["_primary_term"]
+        else:
+            body["doc_as_upsert"] = True
+        await self._add({"update": action}, body, document, force)
+
+    async def delete(self, document_id, index=None):
+        """Queue the deletion of a document, see `database.BulkWriter.delete`"""
+        action = {"_type": "doc", "_id": document_id}
+        _set_index(action, index)
+        await self._add({"delete": action}, None, {"_id": document_id}, False)
+
+    async def _resolve(self, pending):
+        """Looks up the missing indices of `pending` actions in a single
+        `locate` call, see `database.BulkWriter._resolve`
+        """
+        unresolved = [
+            entry for entry in pending if "_index" not in list(entry[0].values())[0]
+        ]
+        if not unresolved:
+            return pending
+        located = await locate([entry[2]["_id"] for entry in unresolved])
+        resolved = []
+        for entry in pending:
+            action, _, document, _ = entry
+            op_type, meta = list(action.items())[0]
+            if "_index" not in meta:
+                index = located.get(str(meta["_id"]))
+                if not index and (op_type == "delete" or "if_seq_no" in meta):
+                    self.skipped += 1
+                    continue
+                meta["_index"] = index or await index_for(document)
+            resolved.append(entry)
+        return resolved
+
+    async def _add(self, action, body, document, force):
+        self._buffer.append((action, body, document, force))
+        if len(self._buffer) >= self.batch_size:
+            pending, self._buffer = self._buffer, []
+            # wait for a free slot, then send without waiting for the response
+            await self._slots.acquire()
+            self._requests.append(asyncio.ensure_future(self._write(pending)))
+            # requests that failed are kept until `flush` raises their error
+            self._requests = [
+                request
+                for request in self._requests
+                if not request.done()
+                or request.cancelled()
+                or request.exception() is not None
+            ]
+
+    async def flush(self):
+        """Send all buffered actions and wait for all outstanding requests
+
+        Raises the first error of a request that failed, after all requests
+        have finished.
+        """
+        pending, self._buffer = self._buffer, []
+        if pending:
+            await self._slots.acquire()
+            self._requests.append(asyncio.ensure_future(self._write(pending)))
+        requests, self._requests = self._requests, []
+        results = await asyncio.gather(*requests, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _send(self, pending):
+        body = []
+        for action, source, _, _ in pending:
+            body.append(action)
+            if source is not None:
+                body.append(source)
+        response = await self._retry.acall(get_client().bulk, body=body)
+        await _mirror_writes(
+            [
+                (op_type, result["_id"], source)
+                for (action, source, _, _), item in zip(pending, response["items"])
+                for op_type, result in item.items()
+                if result.get("status", 500) < 300
+            ]
+        )
+        return response
+
+    async def _write(self, pending):
+        """Send a batch of actions, retrying rejected ones, in a request slot"""
+        try:
+            pending = await self._resolve(pending)
+            metadata_cache.invalidate("doctypes")
+            attempt = 0
+            while pending:
+                response = await self._send(pending)
+                rejected, conflicting = [], []
+                for entry, item in zip(pending, response["items"]):
+                    action, source, document, force = entry
+                    op_type, result = list(item.items())[0]
+                    status = result.get("status", 500)
+                    if status < 300:
+                        self.written += 1
+                    elif status == 429 and attempt < self.max_retries:
+                        rejected.append(entry)
+                    elif status == 404 and op_type in ("delete", "update"):
+                        self.skipped += 1
+                    elif status == 409 and op_type == "create":
+                        logger.warning(
+                            "Identifier {result[_id]} already exists in database, document is not inserted.".format(
+                                **locals()
+                            )
+                        )
+                        self.skipped += 1
+                    elif status == 409 and attempt < self.max_retries:
+                        _update_current_version(action[op_type], result, force)
+                        conflicting.append(entry)
+                    else:
+                        logger.warning(
+                            "Failed to {op_type} {result[_id]}: {error}".format(
+                                error=result.get("error"), **locals()
+                            )
+                        )
+                        self.failed.append(
+                            {
+                                "_id": result.get("_id"),
+                                "op_type": op_type,
+                                "status": status,
+                                "error": result.get("error"),
+                            }
+                        )
+                pending = rejected + conflicting
+                if pending:
+                    attempt += 1
+                if rejected:
+                    await asyncio.sleep(self._retry.delay(attempt))
+        finally:
+            self._slots.release()
+
+    def report(self):
+        """Log and return a summary of the writes, see `database.BulkWriter.report`"""
+        summary = {
+            "written": self.written,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+        }
+        logger.info(
+            "Wrote {written} documents, skipped {skipped}, failed {failed}".format(
+                **summary
+            )
+        )
+        return summary
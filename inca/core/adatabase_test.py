@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from inca.core import adatabase, database
+from inca.core.metadata_cache import metadata_cache
+
+
+class FailingClient(object):
+    """Fails every bulk request"""
+
+    async def bulk(self, body, **kwargs):
+        raise RuntimeError("bulk request failed")
+
+
+def test_failed_bulk_requests_are_raised(monkeypatch):
+    monkeypatch.setattr(adatabase, "AsyncElasticsearch", object)
+    monkeypatch.setattr(adatabase, "get_client", lambda: FailingClient())
+
+    async def write():
+        writer = adatabase.AsyncBulkWriter(batch_size=2, max_retries=0)
+        for number in range(5):
+            await writer.insert({"_source": {"number": number}}, str(number))
+            # let the requests that were sent fail
+            await asyncio.sleep(0)
+        await writer.flush()
+
+    monkeypatch.setattr(adatabase, "index_for", _index_for)
+    with pytest.raises(RuntimeError):
+        asyncio.run(write())
+
+
+async def _index_for(document):
+    return database.elastic_index
+
+
+def test_no_migration_is_cached_alike(monkeypatch):
+    monkeypatch.setattr(adatabase, "INDEX_LAYOUT", "single")
+    monkeypatch.setattr(database, "INDEX_LAYOUT", "single")
+    metadata_cache.put("migration", "")
+    try:
+        assert database.migration_target() is None
+        assert asyncio.run(adatabase.migration_target()) is None
+    finally:
+        metadata_cache.invalidate("migration")
+
+
+def test_missing_async_client_is_reported(monkeypatch):
+    monkeypatch.setattr(adatabase, "AsyncElasticsearch", None)
+    with pytest.raises(ImportError, match=r"inca\[async\]"):
+        adatabase.AsyncBulkWriter()
+    with pytest.raises(ImportError, match=r"inca\[async\]"):
+        adatabase.get_client()
+
+
+class LocatingClient(object):
+    """Finds documents "1" and "2", and accepts every bulk action"""
+
+    def __init__(self):
+        self.searches = []
+        self.requests = []
+
+    async def search(self, index=None, body=None):
+        self.searches.append(body["query"]["ids"]["values"])
+        hits = [
+            {"_id": _id, "_index": "inca-nu-" + _id}
+            for _id in body["query"]["ids"]["values"]
+            if _id in ("1", "2")
+        ]
+        return {"hits": {"hits": hits}}
+
+    async def bulk(self, body, **kwargs):
+        self.requests.append(body)
+        items = [
+            {op_type: {"_id": action["_id"], "status": 200}}
+            for line in body
+            for op_type, action in line.items()
+            if op_type in ("update", "delete")
+        ]
+        return {"items": items}
+
+
+def test_indices_are_located_once_per_bulk_request(monkeypatch):
+    fake = LocatingClient()
+    monkeypatch.setattr(adatabase, "AsyncElasticsearch", object)
+    monkeypatch.setattr(adatabase, "get_client", lambda: fake)
+    monkeypatch.setattr(adatabase, "INDEX_LAYOUT", "month")
+    monkeypatch.setattr(database, "INDEX_LAYOUT", "month")
+
+    async def no_migration():
+        return None
+
+    monkeypatch.setattr(adatabase, "migration_target", no_migration)
+
+    async def write():
+        async with adatabase.AsyncBulkWriter() as writer:
+            await writer.update({"_id": "1", "_source": {"a": 1}})
+            await writer.delete("2")
+            await writer.delete("3")
+        return writer
+
+    writer = asyncio.run(write())
+    assert fake.searches == [["1", "2", "3"]]
+    assert [list(line.values())[0]["_index"] for line in fake.requests[0][::2]] == [
+        "inca-nu-1",
+        "inca-nu-2",
+    ]
+    assert (writer.written, writer.skipped) == (2, 1)
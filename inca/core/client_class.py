@@ -8,16 +8,13 @@ requires a functioning elasticsearch instance.
 """
 from .scraper_class import Scraper
 from ..clients._general_utils import *
-from .database import DATABASE_AVAILABLE
-
-if DATABASE_AVAILABLE:
-    from .database import client
-    from elasticsearch.exceptions import (
-        ConnectionError,
-        ConnectionTimeout,
-        NotFoundError,
-        RequestError,
-    )
+from .database import DATABASE_AVAILABLE, client, BulkWriter
+from .retry import default_policy
+from elasticsearch.exceptions import (
+    ConnectionError,
+    NotFoundError,
+    RequestError,
+)
 import time
 import datetime
 import logging
@@ -205,14 +202,15 @@ class Client(Scraper):
 
         logger.info("Starting client")
         if DATABASE_AVAILABLE == True and kwargs.get("database", True):
-            for docs in self.get(credentials=usable_credentials, *args, **kwargs):
-                # in case the function yields individual rather than batch results
-                if type(docs) == dict:
-                    docs = [docs]
-                for doc in docs:
-                    doc = self._add_metadata(doc)
-                    self._verify(doc)
-                self._save_documents(docs)
+            with BulkWriter() as writer:
+                for docs in self.get(credentials=usable_credentials, *args, **kwargs):
+                    # in case the function yields individual rather than batch results
+                    if type(docs) == dict:
+                        docs = [docs]
+                    for doc in docs:
+                        doc = self._add_metadata(doc)
+                        self._verify(doc)
+                    self._save_documents(docs, writer=writer)
 
         else:
             results = []
@@ -268,22 +266,13 @@ class Client(Scraper):
         logger.info("Adding new application: {appname}".format(**locals()))
         body = {"credentials": app_credentials, "other": kwargs}
         try:
-            attempt = client.index(
+            attempt = default_policy.replace(max_attempts=retries).call(
+                client.index,
                 index=APPLICATIONS_INDEX,
                 doc_type=self.service_name,
                 id=appname,
                 body=body,
             )
-        except ConnectionTimeout:
-            retries -= 1
-            logger.debug("Failed to index, retrying {retries} more times")
-            if retries:
-                time.sleep(1)
-                return self.store_application(
-                    app_credentials, appname, retries, **kwargs
-                )
-            else:
-                return {}
         except ConnectionError:
             logger.debug("Failed to connect, is Elasticsearch up?")
             return {}
@@ -314,22 +303,12 @@ class Client(Scraper):
 
         """
         try:
-            app_credentials = client.get(
-                index=APPLICATIONS_INDEX, doc_type=self.service_name, id=app
+            app_credentials = default_policy.replace(max_attempts=retries).call(
+                client.get, index=APPLICATIONS_INDEX, doc_type=self.service_name, id=app
             )
         except ConnectionError:
             logger.warning("Could not connect to Elasticsearch, is it up?")
             return {}
-        except ConnectionTimeout:
-            retries -= 1
-            logger.info("Connection timeout, retrieing {retries} more times").format(
-                **locals()
-            )
-            if retries:
-                time.sleep(1)
-                return self.load_application(app=app)
-            else:
-                return {}
         except NotFoundError:
             logger.warning("{app} was not found!".format(**locals()))
             return {}
@@ -355,22 +334,15 @@ class Client(Scraper):
 
         """
         try:
-            app_credentials = client.delete(
-                index=APPLICATIONS_INDEX, doc_type=self.service_name, id=app
+            app_credentials = default_policy.replace(max_attempts=retries).call(
+                client.delete,
+                index=APPLICATIONS_INDEX,
+                doc_type=self.service_name,
+                id=app,
             )
         except ConnectionError:
             logger.warning("Could not connect to Elasticsearch, is it up?")
             return False
-        except ConnectionTimeout:
-            retries -= 1
-            logger.info("Connection timeout, retrieing {retries} more times").format(
-                **locals()
-            )
-            if retries:
-                time.sleep(1)
-                return self.remove_application(app=app)
-            else:
-                return False
         except NotFoundError:
             logger.warning("{app} was not found!".format(**locals()))
             return False
@@ -435,8 +407,8 @@ class Client(Scraper):
             return {}
 
         try:
-            credentials_stored = client.index(
-                index=CREDENTIALS_INDEX, doc_type=doctype, id=id, body=doc
+            credentials_stored = default_policy.replace(max_attempts=retries).call(
+                client.index, index=CREDENTIALS_INDEX, doc_type=doctype, id=id, body=doc
             )
             if credentials_stored["created"]:
                 logger.info("CREATED credentials [{id}] for {app}".format(**locals()))
@@ -445,18 +417,6 @@ class Client(Scraper):
         except ConnectionError:
             logger.warning("Could not connect to Elasticsearch, is it up?")
             return {}
-        except ConnectionTimeout:
-            retries -= 1
-            logger.info("Connection timeout, retrieing {retries} more times").format(
-                **locals()
-            )
-            if retries:
-                time.sleep(1)
-                return self.store_credentials(
-                    id=id, app=app, credentials=credentials, retries=retries, **kwargs
-                )
-            else:
-                return {}
 
         return self.load_credentials(app=app, id=id, update_last_loaded=False)
 
@@ -499,15 +459,17 @@ class Client(Scraper):
         """
         ordering = {"lowest": "asc", "highest": "desc"}
         doctype = "{self.service_name}_{app}".format(**locals())
+        retry = default_policy.replace(max_attempts=retries)
         try:
             if id:
-                credentials = client.get(
-                    index=CREDENTIALS_INDEX, doc_type=doctype, id=id
+                credentials = retry.call(
+                    client.get, index=CREDENTIALS_INDEX, doc_type=doctype, id=id
                 )
 
             else:
                 docs = (
-                    client.search(
+                    retry.call(
+                        client.search,
                         index=CREDENTIALS_INDEX,
                         body={
                             "sort": [
@@ -535,15 +497,6 @@ class Client(Scraper):
                     content=credentials["_source"]["content"],
                 )
 
-        except ConnectionTimeout:
-            retries -= 1
-            logger.info(
-                "Connection timeout when trying to retrieve, retrying {retries} more times"
-            )
-            if retries:
-                return self.load_credentials(app=app, id=id, retries=retries)
-            else:
-                return {}
         except ConnectionError:
             logger.warning("Unable to contact Elasticsearch, is it up?")
             return {}
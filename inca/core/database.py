@@ -12,16 +12,26 @@ import logging
 import json
 import csv
 from elasticsearch import Elasticsearch, NotFoundError, helpers
-from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.exceptions import TransportError
 import time
 from datetime import datetime
 import configparser
-import requests
 from celery import Task
 import os
 from tqdm import tqdm
-from hashlib import md5
+import fnmatch
+import queue
+import re
+import pickle
+import collections
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from .filenames import id2filename
+from . import fingerprints
+from .retry import RetryPolicy, retry_call
+from .metadata_cache import metadata_cache, profile_cache
 
 config = configparser.ConfigParser()
 config.read("settings.cfg")
@@ -29,42 +39,458 @@ config.read("settings.cfg")
 logger = logging.getLogger("INCA")
 logging.getLogger("elasticsearch").setLevel(logging.CRITICAL)
 
-try:
-    client = Elasticsearch(
-        host=config.get(
-            "elasticsearch", "%s.host" % config.get("inca", "dependencies")
-        ),
-        port=int(
-            config.get("elasticsearch", "%s.port" % config.get("inca", "dependencies"))
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema.json")
+
+elastic_index = config.get("elasticsearch", "document_index", fallback="inca")
+
+# connection options for the elasticsearch client; each of these can be
+# overridden in the [elasticsearch] section of settings.cfg. Requests are
+# retried by `retry.RetryPolicy` (with its circuit breaker), so the client
+# itself does not retry: retries of both would multiply.
+CLIENT_DEFAULTS = {
+    "timeout": 60,
+    "maxsize": 25,
+    "max_retries": 0,
+    "retry_on_timeout": False,
+    "sniff_on_start": False,
+    "sniff_on_connection_fail": False,
+    "sniffer_timeout": 0,
+    "http_compress": False,
+}
+
+# seconds to wait for the health check, and seconds before an unavailable
+# database is checked again
+HEALTH_TIMEOUT = config.getfloat("elasticsearch", "health_timeout", fallback=2)
+HEALTH_CHECK_INTERVAL = config.getfloat(
+    "elasticsearch", "health_check_interval", fallback=30
+)
+
+# (major, minor) version of the elasticsearch server, (0, 0) if unavailable
+ES_VERSION = (0, 0)
+
+# sequence numbers (for optimistic concurrency control) are returned by
+# searches and accepted by updates from elasticsearch 6.7 onwards
+SEQ_NO_SUPPORTED = False
+
+# maximum number of ids per `_mget` request in check_exists_many
+MGET_CHUNK_SIZE = 1000
+
+# maximum number of documents deleted per second by delete_by_query tasks,
+# -1 means unthrottled
+DELETE_REQUESTS_PER_SECOND = config.getfloat(
+    "elasticsearch", "delete_requests_per_second", fallback=-1
+)
+
+# how documents are distributed over indices: 'single' stores all documents
+# in `elastic_index`, 'doctype' uses an index per doctype and 'month' an index
+# per doctype and month of publication (`publication_date`). With the latter
+# two, `elastic_index` is an alias of all indices.
+INDEX_LAYOUT = config.get("elasticsearch", "index_layout", fallback="single")
+if INDEX_LAYOUT not in ("single", "doctype", "month"):
+    raise ValueError(
+        "Unknown index_layout {INDEX_LAYOUT}, use single, doctype or month".format(
+            **locals()
+        )
+    )
+
+# searches spanning more indices than this search all months of a doctype
+MAX_SEARCH_INDICES = 200
+
+# the field that orders documents with equal sort values in a SearchAfterCursor.
+# If not set, point-in-time searches use `_shard_doc` and others `_id`, which
+# elasticsearch 7 and higher has to load into memory: a keyword field with a
+# unique value per document avoids that.
+CURSOR_TIEBREAKER = config.get("elasticsearch", "cursor_tiebreaker", fallback=None)
+
+# the snapshot repository in which backups are stored, see `create_repository`
+BACKUP_REPOSITORY = config.get(
+    "elasticsearch", "backup_repository", fallback="inca_backup"
+)
+
+# while `reindex` runs, this alias points to the index documents are copied to
+MIGRATION_ALIAS = elastic_index + "_migration"
+
+# seconds that metadata such as the list of doctypes is cached
+metadata_cache.ttl = config.getfloat("elasticsearch", "metadata_ttl", fallback=60)
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_health = {"available": None, "checked": 0}
+_known_indices = set()
+
+
+def client_options():
+    """Reads the elasticsearch connection settings from settings.cfg
+
+    Returns
+    ----
+    dict
+        keyword arguments for the Elasticsearch constructor
+    """
+    dependencies = config.get("inca", "dependencies", fallback="standard")
+    options = {
+        "host": config.get(
+            "elasticsearch", "%s.host" % dependencies, fallback="localhost"
         ),
-        timeout=60,
-    )  # should be updated to reflect config
-    elastic_index = config.get("elasticsearch", "document_index")
-    DATABASE_AVAILABLE = True
-    check = int(client.info()["version"]["number"][0])
-    if check < 6:
+        "port": config.getint("elasticsearch", "%s.port" % dependencies, fallback=9200),
+    }
+    for key, default in CLIENT_DEFAULTS.items():
+        if type(default) == bool:
+            value = config.getboolean("elasticsearch", key, fallback=default)
+        else:
+            value = type(default)(config.get("elasticsearch", key, fallback=default))
+        options[key] = value
+    if not options["sniffer_timeout"]:
+        options["sniffer_timeout"] = None
+    return options
+
+
+def get_client():
+    """Returns the elasticsearch client of this process
+
+    The client (and its connection pool) is created on first use and
+    shared by all threads of a process. A forked process, such as a celery
+    worker, creates a client of its own as connection pools cannot be shared
+    between processes.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = Elasticsearch(**client_options())
+                _client_pid = os.getpid()
+                _health.update(available=None, checked=0)
+    return _client
+
+
+def database_available(refresh=False):
+    """Checks whether elasticsearch can be reached
+
+    The first successful check also determines the server version and
+    creates the document index if it does not yet exist. A failed check is
+    repeated at most once every HEALTH_CHECK_INTERVAL seconds, so that
+    callers do not wait for a timeout on every call.
+
+    Parameters
+    ----
+    refresh : bool (default=False)
+        Check again even if the database was found to be available before
+
+    Returns
+    ----
+    bool
+    """
+    global ES_VERSION, SEQ_NO_SUPPORTED
+    es = get_client()
+    available = _health["available"]
+    if available and not refresh:
+        return True
+    if available is False and not refresh:
+        if time.time() - _health["checked"] < HEALTH_CHECK_INTERVAL:
+            return False
+    available = False
+    try:
+        if es.ping(request_timeout=HEALTH_TIMEOUT):
+            ES_VERSION = tuple(
+                int(number) for number in es.info()["version"]["number"].split(".")[:2]
+            )
+            SEQ_NO_SUPPORTED = ES_VERSION >= (6, 7)
+            if ES_VERSION[0] < 6:
+                logger.warning(
+                    "Your version of ElasticSearch is not compatible with inca, version 6 or higher is required. More information can be found here: ... Continuing without database. This means you will not be able to SAVE the results of any scraper or processor!"
+                )
+            else:
+                if INDEX_LAYOUT != "single":
+                    # indices of the layout are created on first use
+                    if es.indices.exists(elastic_index) and not es.indices.exists_alias(
+                        name=elastic_index
+                    ):
+                        logger.warning(
+                            "{elastic_index} is an index, but the {INDEX_LAYOUT} layout needs it to be an alias. Move its documents to indices of the layout first.".format(
+                                elastic_index=elastic_index, INDEX_LAYOUT=INDEX_LAYOUT
+                            )
+                        )
+                # initialize mappings if index does not yet exist
+                elif not es.indices.exists(elastic_index):
+                    with open(SCHEMA) as schema:
+                        es.indices.create(elastic_index, json.load(schema))
+                available = True
+    except Exception as e:
+        logger.debug("Unable to communicate with elasticsearch, {}".format(e))
+    if not available and _health["available"] is not False:
         logger.warning(
-            "Your version of ElasticSearch is not compatible with inca, version 6 or higher is required. More information can be found here: ... Continuing without database. This means you will not be able to SAVE the results of any scraper or processor!"
+            "No database functionality available. This means you will not be able to SAVE the results of any scraper or processor!"
         )
-        DATABASE_AVAILABLE = False
-    # initialize mappings if index does not yet exist
+    _health.update(available=available, checked=time.time())
+    return available
+
+
+class _LazyClient(object):
+    """Stands in for the elasticsearch client until it is first used"""
+
+    def __getattr__(self, attribute):
+        return getattr(get_client(), attribute)
+
+    def __repr__(self):
+        return "<lazy {}>".format(repr(_client) if _client else "Elasticsearch")
+
+
+class _DatabaseAvailable(object):
+    """Evaluates to the outcome of database_available() when tested"""
+
+    def __bool__(self):
+        return database_available()
+
+    def __eq__(self, other):
+        return bool(self) == other
+
+    def __hash__(self):
+        return hash(bool(self))
+
+    def __repr__(self):
+        return repr(bool(self))
+
+
+# `client` and `DATABASE_AVAILABLE` can be imported by other modules without
+# connecting to elasticsearch at import time
+client = _LazyClient()
+DATABASE_AVAILABLE = _DatabaseAvailable()
+
+
+def _index_part(doctype):
+    """The part of an index name that identifies a doctype"""
+    return re.sub(r"[^a-z0-9_]+", "_", str(doctype).lower()).strip("_") or "unknown"
+
+
+def _month(date):
+    """The 'YYYY.MM' of a date or date string, None if it has no month
+
+    Date math (e.g. 'now-1M' or '2020-01-31||+1M') has no month, as the
+    date it resolves to can be in another month than the one it starts with.
+    """
+    if isinstance(date, datetime):
+        return date.strftime("%Y.%m")
+    if "||" in str(date) or str(date).strip().startswith("now"):
+        return None
+    match = re.match(r"(\d{4})-(\d{2})", str(date or ""))
+    if match:
+        return "{}.{}".format(*match.groups())
+    return None
+
+
+def _layout_schema():
+    """The settings, mappings and aliases of a new index of the layout"""
+    with open(SCHEMA) as schema:
+        body = json.load(schema)
+    body["aliases"] = {elastic_index: {}}
+    return body
+
+
+def _ensure_index(name):
+    """Creates an index of the layout (with the schema and aliases) if needed"""
+    if name in _known_indices:
+        return
     try:
-        # if not elastic_index in client.indices.get_aliases().keys():
-        if not client.indices.exists(elastic_index):
-            client.indices.create(elastic_index, json.load(open("schema.json")))
-    except Exception as e:
-        raise Exception("Unable to communicate with elasticsearch, {}".format(e))
-except:
-    logger.warning(
-        "No database functionality available. This means you will not be able to SAVE the results of any scraper or processor!"
+        retry_call(client.indices.create, name, _layout_schema())
+        logger.info("Created index {name}".format(**locals()))
+    except TransportError as e:
+        if e.error != "resource_already_exists_exception":
+            raise
+    _known_indices.add(name)
+
+
+def index_for(document):
+    """Returns the index to which a new document is written
+
+    With the 'single' layout this is always `elastic_index`. Otherwise, it
+    depends on the doctype (and month of the `publication_date`) of the
+    document, and the index is created if it does not exist.
+
+    Parameters
+    ----
+    document : dict
+        The document, either as an elasticsearch document with a `_source`
+        key or the content of the document itself
+    """
+    name = _index_name(document)
+    if name != elastic_index:
+        _ensure_index(name)
+    return name
+
+
+def _index_name(document):
+    """The name of the index of a new document, see `index_for`"""
+    if INDEX_LAYOUT == "single":
+        return elastic_index
+    source = document.get("_source", document)
+    suffix = "all"
+    if INDEX_LAYOUT == "month":
+        suffix = _month(source.get("publication_date")) or "undated"
+    return "{}-{}-{}".format(
+        elastic_index, _index_part(source.get("doctype", "unknown")), suffix
+    )
+
+
+def search_index(doctype=None, from_time=None, to_time=None):
+    """Returns the indices to search for documents of a doctype and period
+
+    Parameters
+    ----
+    doctype : string or list (default=None)
+        The doctype(s) searched for, all doctypes if None
+    from_time, to_time : string (default=None)
+        The first and last `publication_date` searched for. Only used by
+        the 'month' layout, and only if both are dates (not date math).
+
+    Returns
+    ----
+    string
+        An index expression to pass as `index` to elasticsearch requests
+    """
+    if INDEX_LAYOUT == "single":
+        return elastic_index
+    if doctype is None:
+        parts = ["*"]
+    elif isinstance(doctype, str):
+        parts = [_index_part(doctype)]
+    else:
+        parts = sorted(set(_index_part(d) for d in doctype))
+    months = ["*"]
+    first, last = _month(from_time), _month(to_time)
+    if INDEX_LAYOUT == "month" and first and last:
+        months = []
+        year, month = int(first[:4]), int(first[5:])
+        while "{:04d}.{:02d}".format(year, month) <= last:
+            months.append("{:04d}.{:02d}".format(year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        if len(months) * len(parts) > MAX_SEARCH_INDICES:
+            months = ["*"]
+        # a pattern rather than the index name, so that months without
+        # documents (and therefore without an index) do not fail the search
+        months = [month + "*" for month in months]
+    return ",".join(
+        "{}-{}-{}".format(elastic_index, part, month)
+        for part in parts
+        for month in months
     )
-    DATABASE_AVAILABLE = False
+
+
+def _query_scope(query, scope):
+    """Collects the doctypes and publication dates required by a query"""
+    if not isinstance(query, dict):
+        return
+    for kind, clause in query.items():
+        if not isinstance(clause, dict):
+            continue
+        if kind in ("term", "match", "match_phrase") and "doctype" in clause:
+            value = clause["doctype"]
+            if isinstance(value, dict):
+                value = value.get("value", value.get("query"))
+            scope["doctypes"].append({value})
+        elif kind == "terms" and "doctype" in clause:
+            scope["doctypes"].append(set(clause["doctype"]))
+        elif kind == "range" and isinstance(clause.get("publication_date"), dict):
+            bounds = clause["publication_date"]
+            if "format" in bounds or "time_zone" in bounds:
+                # the bounds may not be the dates their text starts with
+                continue
+            scope["from"].append(_month(bounds.get("gte", bounds.get("gt"))))
+            scope["to"].append(_month(bounds.get("lte", bounds.get("lt"))))
+        elif kind == "bool":
+            # only required clauses narrow down where documents can be
+            for occur in ("must", "filter"):
+                clauses = clause.get(occur, [])
+                if isinstance(clauses, dict):
+                    clauses = [clauses]
+                for required in clauses:
+                    _query_scope(required, scope)
+
+
+def index_for_query(query):
+    """Returns the indices that can hold documents matching a query
+
+    Doctypes and `publication_date` ranges that the query requires (in
+    `term(s)` or `range` clauses, possibly within the `must` or `filter`
+    of a `bool` query) limit the indices that are searched, see
+    `search_index`. Ranges with date math, a `format` or a `time_zone`
+    do not limit the months that are searched.
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch request body or query
+    """
+    if INDEX_LAYOUT == "single":
+        return elastic_index
+    scope = {"doctypes": [], "from": [], "to": []}
+    if isinstance(query, dict):
+        _query_scope(query.get("query", query), scope)
+    doctypes = None
+    if scope["doctypes"]:
+        doctypes = sorted(set.intersection(*scope["doctypes"]), key=str)
+    from_time = max([m for m in scope["from"] if m], default=None)
+    to_time = min([m for m in scope["to"] if m], default=None)
+    if from_time:
+        from_time = from_time.replace(".", "-")
+    if to_time:
+        to_time = to_time.replace(".", "-")
+    if doctypes == []:
+        # contradictory doctypes, no index can hold matching documents
+        doctypes = None
+    return search_index(doctypes, from_time, to_time)
+
+
+def locate(document_ids):
+    """Finds the indices the given documents are stored in
+
+    Returns
+    ----
+    dict
+        A mapping of each (string) id that was found to its index
+    """
+    document_ids = [str(_id) for _id in document_ids]
+    if INDEX_LAYOUT == "single":
+        return {_id: elastic_index for _id in document_ids}
+    located = {}
+    for start in range(0, len(document_ids), MGET_CHUNK_SIZE):
+        chunk = document_ids[start : start + MGET_CHUNK_SIZE]
+        response = retry_call(
+            client.search,
+            index=search_index(),
+            body={
+                "size": len(chunk),
+                "_source": False,
+                "query": {"ids": {"values": chunk}},
+            },
+        )
+        for hit in response["hits"]["hits"]:
+            located[hit["_id"]] = hit["_index"]
+    return located
+
+
+def _index_of(document):
+    """The index a stored document is in, or else would be written to"""
+    if document.get("_index"):
+        return document["_index"]
+    if INDEX_LAYOUT == "single":
+        return elastic_index
+    return locate([document["_id"]]).get(str(document["_id"])) or index_for(document)
+
+
+def _set_index(action, index):
+    """Sets the index of a bulk action on a stored document, if it is known
+    without a lookup"""
+    if index or INDEX_LAYOUT == "single":
+        action["_index"] = index or elastic_index
 
 
 def get_document(doc_id):
     if not check_exists(doc_id)[0]:
         logger.debug("No document found with id {doc_id}".format(**locals()))
         return {}
+    elif INDEX_LAYOUT != "single":
+        return check_exists(doc_id)[1]
     else:
         document = client.get(elastic_index, doc_type="doc", id=doc_id)
     return document
@@ -77,8 +503,20 @@ def check_exists(document_id):
         logger.warning("You did not provide a document_id, returning False")
         return False, {}
     index = elastic_index
+    if INDEX_LAYOUT != "single":
+        # a `get` needs the index of the document, which is not known yet
+        hits = retry_call(
+            client.search,
+            index=search_index(),
+            body={"size": 1, "query": {"ids": {"values": [document_id]}}},
+        )["hits"]["hits"]
+        if hits:
+            return True, hits[0]
+        return False, {}
     try:
-        retrieved = client.get(elastic_index, doc_type="doc", id=document_id)
+        retrieved = retry_call(
+            client.get, elastic_index, doc_type="doc", id=document_id
+        )
         logger.debug(
             "elastic_index {index} - document [{document_id}] found, return document".format(
                 **locals()
@@ -92,18 +530,59 @@ def check_exists(document_id):
             )
         )
         return False, {}
-    # TODO: ADD TIMEOUT HANDLER
-    except ConnectionTimeout:
-        logger.warning(
-            "unable to check for documents in elasticsearch elastic_index [{elastic_index}]".format(
-                **{"elastic_index": elastic_index}
-            )
+
+
+def check_exists_many(document_ids, chunk_size=None):
+    """Check for a batch of document ids whether they exist
+
+    Existence is checked with `_mget` requests of at most `chunk_size` ids,
+    without retrieving the `_source` of the documents, instead of one GET
+    per document.
+
+    Parameters
+    ----
+    document_ids : iterable
+        The ids of the documents to look up
+    chunk_size : int (default=None)
+        The maximum number of ids sent to elasticsearch in a single request,
+        defaults to `MGET_CHUNK_SIZE`
+
+    Returns
+    ----
+    dict
+        A mapping of each (string) id to a boolean indicating whether it exists
+
+    """
+    if not chunk_size:
+        chunk_size = MGET_CHUNK_SIZE
+    document_ids = [str(_id) for _id in document_ids if _id is not None]
+    existing = {_id: False for _id in document_ids}
+    if not DATABASE_AVAILABLE:
+        return existing
+    for_lookup = [_id for _id in existing if _id.strip() != ""]
+    if INDEX_LAYOUT != "single":
+        existing.update({_id: True for _id in locate(for_lookup)})
+        for_lookup = []
+    for start in range(0, len(for_lookup), chunk_size):
+        chunk = for_lookup[start : start + chunk_size]
+        response = retry_call(
+            client.mget,
+            index=elastic_index,
+            doc_type="doc",
+            body={"ids": chunk},
+            _source=False,
         )
-        time.sleep(1)
-        return check_exists(document_id)
+        for doc in response["docs"]:
+            existing[doc["_id"]] = doc.get("found", False)
+    logger.debug(
+        "elastic_index {index} - {found} of {total} documents found".format(
+            index=elastic_index, found=sum(existing.values()), total=len(existing)
+        )
+    )
+    return existing
 
 
-def update_document(document, force=False, retry=0, max_retries=10):
+def update_document(document, force=False):
     """
     Documents should usually only be appended, not updated as such.
 
@@ -117,10 +596,6 @@ def update_document(document, force=False, retry=0, max_retries=10):
         Indicates whether the document should replace (true) or only
         expand existing documents (false). Note that partial updates
         are not supported when forcing.
-    retry (optional): integer [default=0]
-        counter of the number of tries
-    max_retries (optional): integer [default=10]
-        number of attempts to insert documents. Compared to retry integer.
 
     """
     exists, old_document = check_exists(document["_id"])
@@ -130,36 +605,32 @@ def update_document(document, force=False, retry=0, max_retries=10):
         )
         document["_source"].update(old_document["_source"])
         document = _remove_dots(document)
-        client.update(
-            index=elastic_index,
+        retry_call(
+            client.update,
+            index=old_document["_index"],
             doc_type="doc",
             id=document["_id"],
             body={"doc": document["_source"]},
         )
+        _mirror_writes([("update", document["_id"], {"doc": document["_source"]})])
     elif exists and force:
-        client.delete(index=elastic_index, doc_type="doc", id=old_document["_id"])
+        retry_call(
+            client.delete,
+            index=old_document["_index"],
+            doc_type="doc",
+            id=old_document["_id"],
+        )
 
         logging.info("FORCED UPDATE of {old_document[_id]}".format(**locals()))
         document = _remove_dots(document)
-        try:
-            client.index(
-                index=elastic_index,
-                doc_type="doc",
-                id=old_document["_id"],
-                body=document["_source"],
-            )
-        except Exception as e:
-            if retry < max_retries:
-                logging.warning(
-                    "FAILED TO RE-INSERT DOCUMENT {document[_id]}, {e} retrying".format(
-                        **locals()
-                    )
-                )
-                update_document(
-                    document, force=force, retry=retry + 1, max_retries=max_retries
-                )
-            else:
-                raise e
+        retry_call(
+            client.index,
+            index=old_document["_index"],
+            doc_type="doc",
+            id=old_document["_id"],
+            body=document["_source"],
+        )
+        _mirror_writes([("index", old_document["_id"], document["_source"])])
     else:
         logging.debug(
             "No existing document found for {document}, defering to insert function"
@@ -168,42 +639,505 @@ def update_document(document, force=False, retry=0, max_retries=10):
     pass
 
 
-def delete_document(document_id):
-    """ delete a document
+def update_documents(documents, fields=None, force=False, batch_size=500):
+    """Update a batch of documents with bulk partial updates
+
+    Each document is sent as an `update` action instead of retrieving, merging
+    and re-indexing it. Documents retrieved with sequence numbers (see
+    `scroll_query`) are only updated if they did not change in the meantime,
+    see `BulkWriter` for how conflicts are resolved, other documents are
+    created if they do not exist (`doc_as_upsert`).
+
+    Parameters
+    ----
+    documents : iterable
+        elasticsearch documents, i.e. dicts with an `_id` and `_source` key
+    fields : list (default=None)
+        The keys of `_source` to write, defaults to the complete `_source`
+    force : bool (default=False)
+        Whether updates of documents that were changed since they were
+        retrieved are re-sent unconditionally (true), or conditional on the
+        version they were changed to (false)
+    batch_size : int (default=500)
+        The number of documents to send in a single bulk request
+
+    Returns
+    ----
+    int
+        The number of succesfully updated documents
+    """
+    with BulkWriter(batch_size=batch_size) as writer:
+        for document in documents:
+            writer.update(document, fields=fields, force=force)
+    return writer.written
+
+
+def delete_document(document_id, requests_per_second=None):
+    """delete a document
 
     Parameters
     ----
     document_id : string, dict or list
         A string containing the document id. Alternatively, a document retrieved
         from elasticsearch from which the `_id` field can be extracted. If a
-        list, it is assumed each element is an id or document to be deleted.
+        list, it is assumed each element is an id or document to be deleted,
+        and they are deleted with `delete_by_query` requests.
+    requests_per_second : int (default=None)
+        When deleting a list of documents, the maximum number of documents
+        deleted per second, see `delete_by_query`
 
     Returns
     ----
     Bool
-        Whether the document was deleted
+        Whether the document was deleted (a list of them for a list)
 
     """
 
+    index = None
     if type(document_id) == dict:
+        index = document_id.get("_index")
         document_id = document_id["_id"]
     elif type(document_id) == list:
-        return [delete_document(d) for d in document_id]
-    found, document = check_exists(document_id)
-    if not found:
+        document_ids = [
+            str(d["_id"]) if type(d) == dict else str(d) for d in document_id
+        ]
+        existing = check_exists_many(document_ids)
+        to_delete = [_id for _id in document_ids if existing.get(_id)]
+        for start in range(0, len(to_delete), MGET_CHUNK_SIZE):
+            delete_by_query(
+                {
+                    "query": {
+                        "ids": {"values": to_delete[start : start + MGET_CHUNK_SIZE]}
+                    }
+                },
+                requests_per_second=requests_per_second,
+                slices=1,
+            )
+        return [existing.get(_id, False) for _id in document_ids]
+    try:
+        retry_call(
+            client.delete,
+            index=index or _index_of({"_id": document_id}),
+            id=document_id,
+            doc_type="doc",
+        )
+    except NotFoundError:
         logger.debug("{document_id} does not exist".format(**locals()))
         return False
-    response = client.delete(index=elastic_index, id=document["_id"], doc_type="doc")
+    _mirror_writes([("delete", document_id, None)])
+    _forget_deleted()
     return True
 
 
-def delete_doctype(doctype):
-    """Delete all documents of a given type"""
-    for doc in scroll_query(
-        {"query": {"bool": {"filter": {"term": {"doctype": doctype}}}}}
-    ):
-        delete_document(doc["_id"])
-    return True
+def _forget_deleted():
+    """Invalidates the cached metadata that deleting documents makes stale"""
+    metadata_cache.invalidate("doctypes")
+    profile_cache.invalidate()
+
+
+def delete_doctype(doctype, wait=True, requests_per_second=None, slices="auto"):
+    """Delete all documents of a given type
+
+    The documents are deleted by elasticsearch itself, with a sliced
+    `delete_by_query` task.
+
+    Parameters
+    ----
+    doctype : string
+        The doctype of the documents to delete
+    wait : bool (default=True)
+        Wait for the deletion to finish, logging its progress. If False,
+        the id of the deletion task is returned right away, to be followed
+        with `task_status` or `wait_for_task`.
+    requests_per_second : int (default=None)
+        The maximum number of documents deleted per second, so that deleting
+        does not starve other work, defaults to the `delete_requests_per_second`
+        setting (unthrottled if not set)
+    slices : int or 'auto' (default='auto')
+        The number of slices the deletion is divided in
+
+    Returns
+    ----
+    Bool or string
+        True once the documents are deleted, or the task id if not waiting
+    """
+    task = delete_by_query(
+        {"query": {"bool": {"filter": {"term": {"doctype": doctype}}}}},
+        requests_per_second=requests_per_second,
+        slices=slices,
+        wait=wait,
+    )
+    if wait:
+        return True
+    return task
+
+
+def delete_by_query(
+    query, requests_per_second=None, slices="auto", wait=True, poll_interval=5
+):
+    """Delete all documents matching a query with a `delete_by_query` task
+
+    While `reindex` runs, matching documents are deleted from the new index
+    as well.
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query, e.g. `{"query": {"term": {"doctype": "nu"}}}`
+    requests_per_second : int (default=None)
+        Throttles the deletion to this many documents per second, defaults to
+        the `delete_requests_per_second` setting (unthrottled if not set). It
+        can be changed while the task runs with `rethrottle`.
+    slices : int or 'auto' (default='auto')
+        The number of slices the deletion is divided in
+    wait : bool (default=True)
+        Wait for the task to finish
+    poll_interval : int or float (default=5)
+        Seconds between progress reports while waiting
+
+    Returns
+    ----
+    dict or string
+        The result of the task (with `deleted`, `failures` etc.) when
+        waiting, otherwise the task id
+    """
+    if requests_per_second is None:
+        requests_per_second = DELETE_REQUESTS_PER_SECOND
+    index = index_for_query(query)
+    if migration_target():
+        index += "," + migration_target()
+    response = retry_call(
+        client.delete_by_query,
+        index=index,
+        body=query,
+        conflicts="proceed",
+        slices=slices,
+        requests_per_second=requests_per_second,
+        wait_for_completion=False,
+    )
+    task = response["task"]
+    logger.info("Started deleting documents, task {task}".format(**locals()))
+    _forget_deleted()
+    if not wait:
+        return task
+    return wait_for_task(task, poll_interval)
+
+
+def task_status(task):
+    """Returns the status of an elasticsearch task, such as a deletion
+
+    Returns
+    ----
+    dict
+        with `completed` (bool), `status` (progress counters such as `total`
+        and `deleted`) and, once completed, `response` or `error`
+    """
+    response = retry_call(client.tasks.get, task_id=task)
+    return {
+        "completed": response.get("completed", False),
+        "status": response.get("task", {}).get("status", {}),
+        "response": response.get("response"),
+        "error": response.get("error"),
+    }
+
+
+def wait_for_task(task, poll_interval=5):
+    """Waits for an elasticsearch task to finish, logging its progress
+
+    Returns
+    ----
+    dict
+        The response of the task
+
+    Raises
+    ----
+    Exception
+        If the task failed
+    """
+    while True:
+        status = task_status(task)
+        if status["completed"]:
+            break
+        progress = status["status"]
+        logger.info(
+            "Task {task}: {done} of {total} documents done".format(
+                done=progress.get("deleted", 0)
+                + progress.get("updated", 0)
+                + progress.get("created", 0),
+                total=progress.get("total", "?"),
+                **locals()
+            )
+        )
+        time.sleep(poll_interval)
+    _forget_deleted()
+    if status["error"]:
+        raise Exception(
+            "Task {task} failed: {error}".format(error=status["error"], **locals())
+        )
+    response = status["response"] or {}
+    if response.get("failures"):
+        logger.warning(
+            "Task {task} finished with {n} failures, e.g. {failure}".format(
+                n=len(response["failures"]), failure=response["failures"][0], **locals()
+            )
+        )
+    logger.info(
+        "Task {task} finished: {done}".format(
+            done=", ".join(
+                "{} documents {}".format(response[key], key)
+                for key in ("created", "updated", "deleted")
+                if response.get(key)
+            )
+            or "no documents changed",
+            **locals()
+        )
+    )
+    return response
+
+
+def rethrottle(task, requests_per_second, action="delete_by_query"):
+    """Changes the throttling of a running `delete_by_query` or `reindex` task
+
+    Parameters
+    ----
+    task : string
+        The task id, as returned by `delete_by_query(..., wait=False)` or
+        logged by `reindex`
+    requests_per_second : int
+        The new maximum number of documents per second, -1 to unthrottle
+    action : string (default='delete_by_query')
+        The kind of task, 'delete_by_query' or 'reindex'
+    """
+    return retry_call(
+        client.transport.perform_request,
+        "POST",
+        "/_{action}/{task}/_rethrottle".format(**locals()),
+        params={"requests_per_second": requests_per_second},
+    )
+
+
+def migration_target():
+    """The index to which a running `reindex` copies documents, if any
+
+    The migration is announced with the MIGRATION_ALIAS alias, which every
+    process looks up at most once per `metadata_ttl` seconds.
+    """
+    if INDEX_LAYOUT != "single":
+        return None
+
+    def lookup():
+        try:
+            return list(retry_call(client.indices.get_alias, name=MIGRATION_ALIAS))[0]
+        except NotFoundError:
+            # cached as "" rather than None, which `peek` returns when not cached
+            return ""
+
+    return metadata_cache.get("migration", lookup) or None
+
+
+def _mirror_writes(writes):
+    """Repeats writes on the index to which a running `reindex` copies documents
+
+    Parameters
+    ----
+    writes : list
+        (op_type, _id, body) tuples of succesful writes, with the body as it
+        would be sent in a bulk request (None for deletes)
+    """
+    target = migration_target()
+    if not target or not writes:
+        return
+    lines = []
+    for op_type, _id, body in writes:
+        lines.append({op_type: {"_index": target, "_type": "doc", "_id": _id}})
+        if op_type == "update":
+            # without upsert: a document that was not copied yet is copied
+            # including this change
+            body = {"doc": body["doc"]}
+        if body is not None:
+            lines.append(body)
+    response = retry_call(client.bulk, body=lines)
+    for item in response["items"]:
+        op_type, result = list(item.items())[0]
+        # documents that were (not yet) copied are taken care of by the reindex
+        if result.get("status", 500) >= 300 and result.get("status") not in (404, 409):
+            logger.warning(
+                "Failed to {op_type} {result[_id]} in {target}: {error}".format(
+                    error=result.get("error"), **locals()
+                )
+            )
+
+
+def _versioned_indices():
+    """Returns the versions of `elastic_index` (as `{elastic_index}_v{N}`)"""
+    indices = retry_call(client.indices.get_alias, index=elastic_index + "_v*")
+    versions = {}
+    for index in indices:
+        match = re.match(re.escape(elastic_index) + r"_v(\d+)$", index)
+        if match:
+            versions[int(match.group(1))] = index
+    return versions
+
+
+def reindex(
+    schema=None,
+    requests_per_second=None,
+    slices="auto",
+    poll_interval=30,
+    settle=None,
+    keep_old=True,
+):
+    """Moves all documents to a new index without interrupting their use
+
+    Use this to apply changes to the mappings in schema.json (such as new
+    analyzers or sub-fields) to existing documents:
+
+    1. A new index `{elastic_index}_v{N}` is created with the mappings of
+       the schema.
+    2. The new index is announced as migration target (see
+       `migration_target`). After `settle` seconds, when every process
+       noticed it, all writes (inserts, updates and deletes) are repeated on
+       the new index.
+    3. The documents are copied with a sliced and throttled `_reindex` task,
+       which skips documents that were already written to the new index.
+    4. `elastic_index` is atomically moved to the new index, so that all
+       reads and writes use it from then on.
+
+    Only the 'single' index layout can be migrated.
+
+    Parameters
+    ----
+    schema : string or dict (default=None)
+        The path to the schema (settings and mappings) of the new index, or
+        the schema itself, defaults to schema.json
+    requests_per_second : int (default=None)
+        Throttles copying to this many documents per second, defaults to
+        the `delete_requests_per_second` setting (unthrottled if not set).
+        It can be changed while copying with `rethrottle`.
+    slices : int or 'auto' (default='auto')
+        The number of slices copying is divided in
+    poll_interval : int or float (default=30)
+        Seconds between progress reports
+    settle : int or float (default=None)
+        Seconds to wait for other processes to notice the migration, defaults
+        to the `metadata_ttl` setting
+    keep_old : bool (default=True)
+        Keep the previous index after the migration, to be able to switch back.
+        If `elastic_index` was an index rather than an alias (i.e. it was never
+        migrated before), it is always deleted, as its name becomes the alias.
+
+    Returns
+    ----
+    string
+        The name of the new index
+
+    Note
+    ----
+    A document that is updated or deleted while it is being copied may
+    end up in its previous state in the new index. Avoid large concurrent
+    updates (e.g. processors) while migrating.
+    """
+    if INDEX_LAYOUT != "single":
+        raise ValueError(
+            "Only the single index layout can be migrated, not {INDEX_LAYOUT}".format(
+                INDEX_LAYOUT=INDEX_LAYOUT
+            )
+        )
+    if not database_available():
+        raise ConnectionError("Elasticsearch is not available, unable to reindex")
+    if migration_target():
+        raise ValueError(
+            "{target} is being migrated to already".format(target=migration_target())
+        )
+    try:
+        sources = list(retry_call(client.indices.get_alias, name=elastic_index))
+        aliased = True
+    except NotFoundError:
+        sources = [elastic_index]
+        aliased = False
+    versions = _versioned_indices()
+    target = "{}_v{}".format(elastic_index, max(list(versions) + [1]) + 1)
+
+    if schema is None:
+        schema = SCHEMA
+    if type(schema) == str:
+        with open(schema) as schema_file:
+            schema = json.load(schema_file)
+    retry_call(
+        client.indices.create, target, dict(schema, aliases={MIGRATION_ALIAS: {}})
+    )
+    metadata_cache.invalidate("migration")
+    logger.info(
+        "Migrating {sources} to {target}, waiting for other processes to write to both".format(
+            **locals()
+        )
+    )
+    time.sleep(metadata_cache.ttl + 1 if settle is None else settle)
+
+    try:
+        if requests_per_second is None:
+            requests_per_second = DELETE_REQUESTS_PER_SECOND
+        task = retry_call(
+            client.reindex,
+            body={
+                "conflicts": "proceed",
+                "source": {"index": sources},
+                "dest": {"index": target, "op_type": "create"},
+            },
+            slices=slices,
+            requests_per_second=requests_per_second,
+            wait_for_completion=False,
+        )["task"]
+        logger.info("Started copying documents, task {task}".format(**locals()))
+        response = wait_for_task(task, poll_interval)
+        if response.get("failures"):
+            raise Exception(
+                "Failed to copy {n} documents to {target}, e.g. {failure}".format(
+                    n=len(response["failures"]),
+                    failure=response["failures"][0],
+                    **locals()
+                )
+            )
+        retry_call(client.indices.refresh, index=",".join(sources + [target]))
+        old_count = retry_call(client.count, index=",".join(sources))["count"]
+        new_count = retry_call(client.count, index=target)["count"]
+        if old_count != new_count:
+            logger.warning(
+                "{sources} holds {old_count} documents, {target} {new_count}".format(
+                    **locals()
+                )
+            )
+    except:
+        retry_call(client.indices.delete_alias, index=target, name=MIGRATION_ALIAS)
+        metadata_cache.invalidate("migration")
+        logger.error(
+            "Migration failed, {elastic_index} is still in use, {target} can be deleted".format(
+                elastic_index=elastic_index, target=target
+            )
+        )
+        raise
+
+    actions = [
+        {"add": {"index": target, "alias": elastic_index}},
+        {"remove": {"index": target, "alias": MIGRATION_ALIAS}},
+    ]
+    if aliased:
+        actions.extend(
+            {"remove": {"index": source, "alias": elastic_index}} for source in sources
+        )
+    else:
+        actions.append({"remove_index": {"index": elastic_index}})
+    retry_call(client.indices.update_aliases, body={"actions": actions})
+    metadata_cache.invalidate()
+    profile_cache.invalidate()
+    logger.info(
+        "{elastic_index} now uses {target}".format(
+            elastic_index=elastic_index, target=target
+        )
+    )
+    if aliased and not keep_old:
+        retry_call(client.indices.delete, index=",".join(sources))
+    return target
 
 
 def insert_document(document, custom_identifier=""):
@@ -219,14 +1153,12 @@ def insert_document(document, custom_identifier=""):
         document_type = "unknown"
         document["_source"]["doctype"] = document_type
     if not custom_identifier:
-        try:
-            doc = client.index(
-                index=elastic_index,
-                doc_type="doc",
-                body=document.get("_source", document),
-            )
-        except ConnectionTimeout:
-            doc = {"_id": insert_document(document, custom_identifier)}
+        doc = retry_call(
+            client.index,
+            index=index_for(document),
+            doc_type="doc",
+            body=document.get("_source", document),
+        )
     else:
         test = check_exists(custom_identifier)
         if test[0] == True:
@@ -235,16 +1167,16 @@ def insert_document(document, custom_identifier=""):
             )
             return {}
         else:
-            try:
-                doc = client.index(
-                    index=elastic_index,
-                    doc_type="doc",
-                    body=document.get("_source", document),
-                    id=custom_identifier,
-                )
-            except ConnectionTimeout:
-                doc = {"_id": insert_document(document["_source"], custom_identifier)}
+            doc = retry_call(
+                client.index,
+                index=index_for(document),
+                doc_type="doc",
+                body=document.get("_source", document),
+                id=custom_identifier,
+            )
+    _mirror_writes([("index", doc["_id"], document.get("_source", document))])
     logger.debug("added new document, content: {document}".format(**locals()))
+    metadata_cache.invalidate("doctypes")
     return doc["_id"]
 
 
@@ -280,45 +1212,33 @@ def insert_documents(documents, identifiers="id"):
                 % (len(documents), len(identifiers))
             )
             raise Exception("Unable to process document batch")
-        for doc, identifier in zip(documents, identifiers):
-            test = check_exists(identifier)
-            if test[0] == True:
-                logger.warning(
-                    "Identifier %s already exists in database, document is not inserted. Please choose a different identifier."
-                    % identifier
-                )
-                identifier = {}
-                doc["_id"] = identifier
-            else:
-                doc["_id"] = identifier
-
-    if type(identifiers) == str:
+        id_values = identifiers
+    else:
         logger.debug("Processing identifiers as key")
-        for doc in documents:
-            id_value = doc.get(identifiers, "")
-            if id_value:
-                test = check_exists(id_value)
-                if test[0] == True:
-                    logger.warning(
-                        "Identifier %s already exists in database, document is not inserted. Please choose a different identifier."
-                        % id_value
-                    )
-                    id_value = {}
-                    doc["_id"] = id_value
-                else:
-                    doc["_id"] = id_value
-            else:
-                logger.warning(
-                    "Key for identifier not found, reverting to ES generated."
-                )
+        id_values = [doc.get(identifiers, "") for doc in documents]
+
+    # check all identifiers in one batched lookup
+    existing = check_exists_many([id_value for id_value in id_values if id_value])
+    for doc, id_value in zip(documents, id_values):
+        if not id_value:
+            logger.warning("Key for identifier not found, reverting to ES generated.")
+            doc.pop("_id", None)
+        elif existing.get(str(id_value), False):
+            logger.warning(
+                "Identifier %s already exists in database, document is not inserted. Please choose a different identifier."
+                % id_value
+            )
+            doc["_id"] = {}
+        else:
+            doc["_id"] = id_value
 
-    documents = [doc for doc in documents if doc["_id"] != {}]
-    for doc in documents:
-        doc["_index"] = elastic_index
-        doc["_type"] = "doc"
+    documents = [doc for doc in documents if doc.get("_id") != {}]
+    inserted_ids = [doc.get("_id", "random") for doc in documents]
     # Insert documents
-    logger.debug(helpers.bulk(client, documents))
-    return [doc.get("_id", "random") for doc in documents]
+    with BulkWriter() as writer:
+        for doc in documents:
+            writer.insert(doc, custom_identifier=doc.pop("_id", None))
+    return inserted_ids
 
 
 def update_or_insert_document(document, force=False, use_url=False):
@@ -330,7 +1250,7 @@ def update_or_insert_document(document, force=False, use_url=False):
             if use_url == True:
                 if "url" in document["_source"].keys():
                     search = client.search(
-                        index=elastic_index,
+                        index=search_index(),
                         body={"query": {"term": {"url": document["_source"]["url"]}}},
                     )
                     if search["hits"]["total"] != 0:
@@ -346,7 +1266,7 @@ def update_or_insert_document(document, force=False, use_url=False):
                 try:
                     if "url" in document["_source"].keys():
                         search = client.search(
-                            index=elastic_index,
+                            index=search_index(),
                             body={
                                 "query": {"term": {"url": document["_source"]["url"]}}
                             },
@@ -391,15 +1311,326 @@ def remove_field(query, field):
         bulk_upsert().run(batch)
 
 
-class bulk_upsert(Task):
-    """Processers can generate far more updates than elasticsearch wants to handle.
-       Bulk_upsert reduces the load on elasticsearch by enabeling multiple documents
-       to be updated together, reducing the amount of queries.
-    """
+class bulk_upsert(Task):
+    """Processers can generate far more updates than elasticsearch wants to handle.
+       Bulk_upsert reduces the load on elasticsearch by enabeling multiple documents
+       to be updated together, reducing the amount of queries.
+    """
+
+    def run(self, documents):
+        logger.debug(documents)
+        return helpers.bulk(client, documents)
+
+
+class BulkWriter(object):
+    """Buffers writes and sends them to elasticsearch in bulk requests
+
+    Use the writer as a context manager to make sure remaining actions are
+    sent when leaving the block:
+
+    ```
+    with BulkWriter() as writer:
+        for doc in scroll_query(query, seq_no_primary_term=True):
+            doc["_source"]["new_field"] = "new value"
+            writer.update(doc, fields=["new_field"])
+    ```
+
+    The buffer is sent when it holds `batch_size` actions or `max_bytes` of
+    serialized data, or when `flush_interval` seconds have passed since the
+    last request. Bulk requests that fail and items rejected because the
+    cluster is overloaded (status 429) are retried with exponential backoff
+    (see `retry.RetryPolicy`), other failures are collected in `failed`.
+    With the 'doctype' and 'month' layouts, the indices of the documents
+    that are updated or deleted without an `_index` are looked up with a
+    single `locate` call per bulk request.
+
+    New documents with an id are created, never overwritten: if the id
+    exists, the document is skipped. Updates of documents that contain a
+    `_seq_no` and `_primary_term` are conditional on the document not having
+    changed since it was retrieved. When it did change, forced updates are
+    re-sent unconditionally, while other updates are re-sent in the next
+    bulk request as a partial update of the version the document changed to
+    (as reported by the conflict), up to `max_retries` times. Conditional
+    updates of documents that no longer exist are skipped, other updates
+    create the document if needed.
+
+    Parameters
+    ----
+    batch_size : int (default=500)
+        The number of buffered actions that triggers a bulk request
+    max_bytes : int (default=10MB)
+        The size of the buffered request body that triggers a bulk request
+    flush_interval : int or float (default=10)
+        The maximum number of seconds to keep actions in the buffer, checked
+        when new actions are added
+    max_retries : int (default=5)
+        The number of times rejected and conflicting items are retried
+    backoff : int or float (default=1)
+        The maximum number of seconds to wait before the first retry, doubled
+        for every next retry
+
+    """
+
+    def __init__(
+        self,
+        batch_size=500,
+        max_bytes=10 * 1024 * 1024,
+        flush_interval=10,
+        max_retries=5,
+        backoff=1,
+    ):
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._retry = RetryPolicy(max_attempts=max_retries + 1, base_delay=backoff)
+        self.written = 0
+        self.skipped = 0
+        self.failed = []
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        self.report()
+        return False
+
+    def insert(self, document, custom_identifier=None):
+        """Queue a new document
+
+        Parameters
+        ----
+        document : dict
+            The document to insert, either as an elasticsearch document with
+            a `_source` key or the content of the document itself
+        custom_identifier : string (default=None)
+            The `_id` of the document, generated by elasticsearch if omitted.
+            If a document with this id exists, the document is not inserted.
+        """
+        action = {"_index": index_for(document), "_type": "doc"}
+        if custom_identifier:
+            action["_id"] = custom_identifier
+            op_type = "create"
+        else:
+            op_type = "index"
+        body = _remove_dots(document.get("_source", document))
+        self._add({op_type: action}, body, document, False)
+
+    def update(self, document, fields=None, force=False):
+        """Queue a partial update of an elasticsearch document
+
+        Parameters
+        ----
+        document : dict
+            An elasticsearch document, containing an `_id` and `_source` key,
+            and the `_index` it is in if known
+        fields : list (default=None)
+            The keys of `_source` to write, defaults to the complete `_source`
+        force : bool (default=False)
+            Whether the update should overwrite concurrent changes
+        """
+        source = document["_source"]
+        if fields:
+            source = {key: source[key] for key in fields if key in source}
+        action = {"_type": "doc", "_id": document["_id"]}
+        _set_index(action, document.get("_index"))
+        body = {"doc": _remove_dots(source)}
+        if "_seq_no" in document and "_primary_term" in document:
+            # conditional updates cannot upsert, a document that is gone is skipped
+            action["if_seq_no"] = document["_seq_no"]
+            action["if_primary_term"] = document["_primary_term"]
+        else:
+            body["doc_as_upsert"] = True
+        self._add({"update": action}, body, document, force)
+
+    def delete(self, document_id, index=None):
+        """Queue the deletion of a document
+
+        Parameters
+        ----
+        document_id : string
+            The `_id` of the document to delete. Documents that do not exist
+            (anymore) are counted as skipped.
+        index : string (default=None)
+            The index the document is in, e.g. the `_index` of a search hit.
+            Looked up if not given.
+        """
+        action = {"_type": "doc", "_id": document_id}
+        _set_index(action, index)
+        self._add({"delete": action}, None, {"_id": document_id}, False)
+
+    def _resolve(self, pending):
+        """Looks up the indices of the documents of `pending` actions that
+        have none in a single `locate` call
+
+        Returns
+        ----
+        list
+            The actions that can be sent, deletes and conditional updates of
+            documents that do not exist are counted as skipped
+        """
+        unresolved = [
+            entry for entry in pending if "_index" not in list(entry[0].values())[0]
+        ]
+        if not unresolved:
+            return pending
+        located = locate([entry[2]["_id"] for entry in unresolved])
+        resolved = []
+        for entry in pending:
+            action, _, document, _ = entry
+            op_type, meta = list(action.items())[0]
+            if "_index" not in meta:
+                index = located.get(str(meta["_id"]))
+                if not index and (op_type == "delete" or "if_seq_no" in meta):
+                    self.skipped += 1
+                    continue
+                meta["_index"] = index or index_for(document)
+            resolved.append(entry)
+        return resolved
+
+    def _add(self, action, body, document, force):
+        serializer = client.transport.serializer
+        self._buffer.append((action, body, document, force))
+        self._buffer_bytes += len(serializer.dumps(action))
+        if body is not None:
+            self._buffer_bytes += len(serializer.dumps(body))
+        if (
+            len(self._buffer) >= self.batch_size
+            or self._buffer_bytes >= self.max_bytes
+            or time.time() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def _send(self, pending):
+        """Send a bulk request, retrying when the cluster is overloaded"""
+        body = []
+        for action, source, _, _ in pending:
+            body.append(action)
+            # delete actions have no source line
+            if source is not None:
+                body.append(source)
+        response = self._retry.call(client.bulk, body=body)
+        _mirror_writes(
+            [
+                (op_type, result["_id"], source)
+                for (action, source, _, _), item in zip(pending, response["items"])
+                for op_type, result in item.items()
+                if result.get("status", 500) < 300
+            ]
+        )
+        return response
+
+    def flush(self):
+        """Send all buffered actions to elasticsearch"""
+        pending, self._buffer = self._buffer, []
+        self._buffer_bytes = 0
+        self._last_flush = time.time()
+        pending = self._resolve(pending)
+        if any("delete" in action for action, _, _, _ in pending):
+            _forget_deleted()
+        elif pending:
+            metadata_cache.invalidate("doctypes")
+        attempt = 0
+        while pending:
+            response = self._send(pending)
+            rejected, conflicting = [], []
+            for entry, item in zip(pending, response["items"]):
+                action, source, document, force = entry
+                op_type, result = list(item.items())[0]
+                status = result.get("status", 500)
+                if status < 300:
+                    self.written += 1
+                elif status == 429 and attempt < self.max_retries:
+                    rejected.append(entry)
+                elif status == 404 and op_type in ("delete", "update"):
+                    self.skipped += 1
+                elif status == 409 and op_type == "create":
+                    logger.warning(
+                        "Identifier {result[_id]} already exists in database, document is not inserted.".format(
+                            **locals()
+                        )
+                    )
+                    self.skipped += 1
+                elif status == 409 and attempt < self.max_retries:
+                    logger.debug(
+                        "{result[_id]} changed, updating it again".format(**locals())
+                    )
+                    _update_current_version(action[op_type], result, force)
+                    conflicting.append(entry)
+                else:
+                    logger.warning(
+                        "Failed to {op_type} {result[_id]}: {error}".format(
+                            error=result.get("error"), **locals()
+                        )
+                    )
+                    self.failed.append(
+                        {
+                            "_id": result.get("_id"),
+                            "op_type": op_type,
+                            "status": status,
+                            "error": result.get("error"),
+                        }
+                    )
+            logger.debug(
+                "Bulk request with {n} actions took {took}ms".format(
+                    n=len(pending), took=response.get("took")
+                )
+            )
+            pending = rejected + conflicting
+            if pending:
+                attempt += 1
+            if rejected:
+                delay = self._retry.delay(attempt)
+                logger.info(
+                    "{n} actions rejected, retrying in {delay:.1f}s".format(
+                        n=len(rejected), delay=delay
+                    )
+                )
+                time.sleep(delay)
+
+    def report(self):
+        """Log and return a summary of the writes
+
+        Returns
+        ----
+        dict
+            The number of `written`, `skipped` and `failed` documents
+        """
+        summary = {
+            "written": self.written,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+        }
+        logger.info(
+            "Wrote {written} documents, skipped {skipped}, failed {failed}".format(
+                **summary
+            )
+        )
+        return summary
+
 
-    def run(self, documents):
-        logger.debug(documents)
-        return helpers.bulk(client, documents)
+def _update_current_version(action, result, force):
+    """Makes a conditional update that conflicted apply to the version of the
+    document it conflicted with, or unconditional if `force` is set or that
+    version is unknown"""
+    action.pop("if_seq_no", None)
+    action.pop("if_primary_term", None)
+    if force:
+        return
+    error = result.get("error")
+    if isinstance(error, dict):
+        error = error.get("reason")
+    match = re.search(
+        r"current document has seqNo \[(\d+)\] and primary term \[(\d+)\]",
+        str(error or ""),
+    )
+    if match:
+        action["if_seq_no"], action["if_primary_term"] = map(int, match.groups())
 
 
 def _remove_dots(document):
@@ -414,7 +1645,14 @@ def _remove_dots(document):
     return document
 
 
-def scroll_query(query, scroll_time="30m", log_interval=None):
+def scroll_query(
+    query,
+    scroll_time="30m",
+    log_interval=None,
+    seq_no_primary_term=False,
+    source_includes=None,
+    source_excludes=None,
+):
     """Scroll through the results of a query
 
     Parameters
@@ -428,7 +1666,17 @@ def scroll_query(query, scroll_time="30m", log_interval=None):
     log_interval : int or float
         The interval to log an 'INFO'-level update of progress, defaults to
         argmin (N_results/1000 ; 100). Set to '0' for no logging, a integer for
-        every Nth-results and a float for every Nth-fraction of the total
+        every Nth-results and a float for every Nth-fraction of the total.
+        The total is retrieved with a `_count` request, which is skipped
+        when logging is disabled.
+    seq_no_primary_term : bool (default=False)
+        Whether to return the `_seq_no` and `_primary_term` of documents, used
+        by `BulkWriter` to detect concurrent changes. Ignored when the
+        elasticsearch server does not support it.
+    source_includes : list (default=None)
+        If specified, only these fields of `_source` are retrieved
+    source_excludes : list (default=None)
+        Fields of `_source` that are not retrieved, such as 'htmlsource'
 
     yields
     ----
@@ -436,11 +1684,12 @@ def scroll_query(query, scroll_time="30m", log_interval=None):
         A stored document, including elasticsearch metadata
 
     """
+    query = _source_filter(query, source_includes, source_excludes)
     if log_interval == 0:
         total = 0
         update_step = -1
     else:
-        total = client.search(index=elastic_index, body=query)["hits"]["total"]
+        total = count_query(query)
         if type(log_interval) == int:
             update_step = log_interval
         elif type(log_interval) == float:
@@ -448,13 +1697,358 @@ def scroll_query(query, scroll_time="30m", log_interval=None):
         else:
             update_step = min((total / 1000), 100)
 
+    if seq_no_primary_term and database_available() and SEQ_NO_SUPPORTED:
+        query = dict(query, seq_no_primary_term=True)
+
     for doc in tqdm(
-        helpers.scan(client, index=elastic_index, query=query, scroll=scroll_time),
+        helpers.scan(
+            client, index=index_for_query(query), query=query, scroll=scroll_time
+        ),
         total=total,
     ):
         yield doc
 
 
+def _source_filter(query, source_includes=None, source_excludes=None):
+    """Add `_source` filtering to a query, so only the needed fields are transferred"""
+    if not source_includes and not source_excludes:
+        return query
+    source = {}
+    if source_includes:
+        source["includes"] = list(source_includes)
+    if source_excludes:
+        source["excludes"] = list(source_excludes)
+    return dict(query, _source=source)
+
+
+def count_query(query):
+    """Count the number of documents matching a query
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query, only its "query" part is used
+
+    Returns
+    ----
+    int
+        The number of matching documents
+
+    """
+    if "query" in query:
+        body = {"query": query["query"]}
+    else:
+        body = None
+    return client.count(index=index_for_query(query), body=body)["count"]
+
+
+_SLICE_DONE = object()  # marks the end of a slice in parallel_scroll_query
+
+
+def _scroll_slice(query, slice_id, slices, scroll_time, output, stop):
+    """Scroll through a single slice of a query, putting documents in `output`"""
+    sliced_query = dict(query, slice={"id": slice_id, "max": slices})
+    try:
+        for doc in helpers.scan(
+            client,
+            index=index_for_query(query),
+            query=sliced_query,
+            scroll=scroll_time,
+        ):
+            _put_unless_stopped(output, doc, stop)
+            if stop.is_set():
+                return
+    except Exception as e:
+        _put_unless_stopped(output, e, stop)
+    finally:
+        _put_unless_stopped(output, _SLICE_DONE, stop)
+
+
+def _put_unless_stopped(output, item, stop):
+    """Put `item` in `output`, unless the consumer stops before there is room"""
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+
+
+def parallel_scroll_query(
+    query,
+    slices=4,
+    ordered=False,
+    scroll_time="30m",
+    log_interval=None,
+    seq_no_primary_term=False,
+    source_includes=None,
+    source_excludes=None,
+    buffer_size=1000,
+):
+    """Scroll through the results of a query with parallel sliced scrolls
+
+    The query is split in `slices` independent scrolls that are read by
+    a pool of threads and merged into a single generator. Use a number of
+    slices no higher than the number of shards of the index.
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query
+    slices : int (default=4)
+        The number of slices to scroll through in parallel
+    ordered : bool (default=False)
+        Whether to yield documents slice by slice, in a deterministic order,
+        rather than as soon as any slice returns them
+    scroll_time : string (default='30m')
+        A string indicating the time-window to keep the results
+        buffer active in elasticsearch, see `scroll_query`
+    log_interval : int or float
+        Set to '0' to skip counting the results for the progress bar
+    seq_no_primary_term : bool (default=False)
+        Whether to return the `_seq_no` and `_primary_term` of documents
+    source_includes : list (default=None)
+        If specified, only these fields of `_source` are retrieved
+    source_excludes : list (default=None)
+        Fields of `_source` that are not retrieved, such as 'htmlsource'
+    buffer_size : int (default=1000)
+        The maximum number of documents kept in memory per slice
+
+    yields
+    ----
+    dict
+        A stored document, including elasticsearch metadata
+
+    """
+    query = _source_filter(query, source_includes, source_excludes)
+    if log_interval == 0:
+        total = 0
+    else:
+        total = count_query(query)
+
+    if seq_no_primary_term and database_available() and SEQ_NO_SUPPORTED:
+        query = dict(query, seq_no_primary_term=True)
+
+    stop = threading.Event()
+    if ordered:
+        outputs = [queue.Queue(maxsize=buffer_size) for _ in range(slices)]
+    else:
+        outputs = [queue.Queue(maxsize=buffer_size * slices)] * slices
+    # daemon threads, so that a consumer that stops early never blocks the exit
+    for slice_id in range(slices):
+        threading.Thread(
+            target=_scroll_slice,
+            args=(query, slice_id, slices, scroll_time, outputs[slice_id], stop),
+            name="inca-scroll-slice-{}".format(slice_id),
+            daemon=True,
+        ).start()
+
+    def merged():
+        if ordered:
+            for output in outputs:
+                item = output.get()
+                while item is not _SLICE_DONE:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                    item = output.get()
+        else:
+            done = 0
+            while done < slices:
+                item = outputs[0].get()
+                if item is _SLICE_DONE:
+                    done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+
+    try:
+        for doc in tqdm(merged(), total=total):
+            yield doc
+    finally:
+        stop.set()
+
+
+class SearchAfterCursor(object):
+    """Iterates over the results of a query using `search_after` pagination
+
+    In contrast to `scroll_query`, no scroll context is kept open on the
+    cluster between requests. Results are sorted on a stable sort (ending
+    with a tiebreaker, see `tiebreaker`), so iteration can be resumed from a
+    position stored in a resume token, for instance after a crash:
+
+    ```
+    cursor = SearchAfterCursor(query)
+    for doc in cursor:
+        ...
+    token = cursor.resume_token  # a JSON string, store it somewhere
+
+    for doc in SearchAfterCursor(query, resume_token=token):
+        ...  # continues after the last document handled
+    ```
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query
+    sort : list (default=None)
+        The sort order, defaults to the sort of the query or to the tiebreaker
+    resume_token : string (default=None)
+        A token obtained from `resume_token` or `token_after` of an earlier
+        cursor over the same query
+    batch_size : int (default=1000)
+        The number of documents retrieved per request
+    point_in_time : bool (default=None)
+        Whether to search a point-in-time view of the index, so changes made
+        during iteration are not seen. Requires elasticsearch 7.10 or higher,
+        by default a point-in-time is used from elasticsearch 7.12 onwards.
+    keep_alive : string (default='5m')
+        How long the point-in-time is kept between requests. A resume token
+        of a point-in-time search can be used until it expires, afterwards
+        the cursor starts over.
+    tiebreaker : string (default=None)
+        The field that orders documents with equal sort values, which must
+        have a unique value per document. Defaults to the `cursor_tiebreaker`
+        setting, or `_shard_doc` with a point-in-time and `_id` without.
+    seq_no_primary_term : bool (default=False)
+        Whether to return the `_seq_no` and `_primary_term` of documents
+    source_includes : list (default=None)
+        If specified, only these fields of `_source` are retrieved
+    source_excludes : list (default=None)
+        Fields of `_source` that are not retrieved, such as 'htmlsource'
+
+    """
+
+    def __init__(
+        self,
+        query,
+        sort=None,
+        resume_token=None,
+        batch_size=1000,
+        point_in_time=None,
+        keep_alive="5m",
+        seq_no_primary_term=False,
+        source_includes=None,
+        source_excludes=None,
+        tiebreaker=None,
+    ):
+        query = _source_filter(query, source_includes, source_excludes)
+        if seq_no_primary_term and database_available() and SEQ_NO_SUPPORTED:
+            query = dict(query, seq_no_primary_term=True)
+        self.query = {k: v for k, v in query.items() if k != "sort"}
+        self.batch_size = batch_size
+        self.keep_alive = keep_alive
+        available = database_available()
+        if point_in_time is None:
+            # `_shard_doc`, the tiebreaker of point-in-time searches, exists from 7.12
+            point_in_time = available and ES_VERSION >= (7, 12)
+        elif point_in_time and available and ES_VERSION < (7, 10):
+            logger.warning(
+                "point-in-time requires elasticsearch 7.10 or higher, searching the live index"
+            )
+            point_in_time = False
+
+        state = json.loads(resume_token) if resume_token else {}
+        self.pit_id = state.get("pit_id")
+        self.point_in_time = point_in_time or bool(self.pit_id)
+        tiebreaker = tiebreaker or CURSOR_TIEBREAKER
+        if not tiebreaker:
+            if self.point_in_time and ES_VERSION >= (7, 12):
+                tiebreaker = "_shard_doc"
+            else:
+                tiebreaker = "_id"
+        self.sort = state.get("sort") or self._stable_sort(
+            sort or query.get("sort"), tiebreaker
+        )
+        self.search_after = state.get("search_after")
+        self.retrieved = state.get("retrieved", 0)
+
+    @staticmethod
+    def _stable_sort(sort, tiebreaker="_id"):
+        """Add a tiebreaker, so the order of documents is unambiguous"""
+        if not sort:
+            sort = []
+        elif type(sort) != list:
+            sort = [sort]
+        fields = [list(s.keys())[0] if type(s) == dict else s for s in sort]
+        if tiebreaker not in fields:
+            sort = sort + [{tiebreaker: "asc"}]
+        return sort
+
+    def _token(self, search_after, retrieved):
+        return json.dumps(
+            {
+                "sort": self.sort,
+                "search_after": search_after,
+                "retrieved": retrieved,
+                "pit_id": self.pit_id,
+            },
+            default=str,
+        )
+
+    @property
+    def resume_token(self):
+        """A JSON string to resume after the last document that was handled"""
+        return self._token(self.search_after, self.retrieved)
+
+    def token_after(self, document):
+        """A JSON string to resume after a given document of this cursor"""
+        return self._token(document["sort"], self.retrieved)
+
+    def _open_point_in_time(self):
+        response = client.transport.perform_request(
+            "POST",
+            "/{index}/_pit".format(index=index_for_query(self.query)),
+            params={"keep_alive": self.keep_alive},
+        )
+        return response["id"]
+
+    def _close_point_in_time(self, pit_id):
+        try:
+            client.transport.perform_request("DELETE", "/_pit", body={"id": pit_id})
+        except TransportError:
+            logger.debug("Unable to close point-in-time, it will expire")
+
+    def __iter__(self):
+        if self.point_in_time and not self.pit_id:
+            self.pit_id = self._open_point_in_time()
+        while True:
+            body = dict(self.query, size=self.batch_size, sort=self.sort)
+            if self.search_after is not None:
+                body["search_after"] = self.search_after
+            if self.pit_id:
+                body["pit"] = {"id": self.pit_id, "keep_alive": self.keep_alive}
+                try:
+                    response = client.search(body=body)
+                except NotFoundError:
+                    if self.search_after is None:
+                        raise
+                    # positions in one point-in-time are meaningless in another
+                    logger.warning(
+                        "The point-in-time of the resume token expired, starting over"
+                    )
+                    self.pit_id = self._open_point_in_time()
+                    self.search_after = None
+                    continue
+                self.pit_id = response.get("pit_id", self.pit_id)
+            else:
+                response = client.search(index=index_for_query(body), body=body)
+            hits = response["hits"]["hits"]
+            if not hits:
+                break
+            for hit in hits:
+                yield hit
+                # only advance once the document has been handled
+                self.search_after = hit["sort"]
+                self.retrieved += 1
+        # after an interruption, the point-in-time is kept (until it expires)
+        # for the resume token
+        if self.pit_id:
+            self._close_point_in_time(self.pit_id)
+            self.pit_id = None
+
+
 #####################
 #
 # Database backup functionality
@@ -463,9 +2057,10 @@ def scroll_query(query, scroll_time="30m", log_interval=None):
 
 
 def create_repository(location):
-    """Creates a repository called 'inca_backup', which is required
-    to save snapshots. The location must be added to the `path.repo` field
-    of elasticsearch.yml (generally located at the elasticsearch folder)
+    """Creates a repository called 'inca_backup' (or the `backup_repository`
+    setting), which is required to save snapshots. The location must be added
+    to the `path.repo` field of elasticsearch.yml (generally located at the
+    elasticsearch folder)
 
     Parameters
     ----------
@@ -488,39 +2083,44 @@ def create_repository(location):
     inca.core.database.create_repository("/path/to/inca/backup")
     >>> {'acknowledged': True}
     inca.core.database.create_backup("arbitrary_name")
-    >>> {'accepted': True}
+    >>> {'snapshot': 'arbitrary_name', 'state': 'SUCCESS', ...}
     ```
 
     Notes
     -----
     The repository location must match the `path.repo` argument in the
     `elasticsearch.yml` file, generally located in the .../elasticsearch/config
-    path or, alternatively, in the /etc/elasticsearch path. Elasticsearch must be restarted 
-    after the `path.repo` is set or changed. In case you are having trouble with 
-    starting elasticsearch again, run 
-    
+    path or, alternatively, in the /etc/elasticsearch path. Elasticsearch must be restarted
+    after the `path.repo` is set or changed. In case you are having trouble with
+    starting elasticsearch again, run
+
     ```bash
     sudo chown elasticsearch.elasticsearch /path/to/inca/backup
     ```
     """
 
     body = {"type": "fs", "settings": {"compress": "true", "location": location}}
-    return client.snapshot.create_repository("inca_backup", body=body)
+    return client.snapshot.create_repository(BACKUP_REPOSITORY, body=body)
 
 
 def check_snapshot_settings(snapshot):
-    return client.snapshot.status(snapshot)
+    return retry_call(
+        client.snapshot.status, repository=BACKUP_REPOSITORY, snapshot=snapshot
+    )
 
 
 def list_backups():
-    response = requests.get(
-        "http://%s:%s/_snapshot/inca_backup/*"
-        % (
-            config.get("elasticsearch", "%s.host" % config.get("inca", "dependencies")),
-            config.get("elasticsearch", "%s.port" % config.get("inca", "dependencies")),
-        )
+    """Lists the snapshots in the backup repository
+
+    Returns
+    ----
+    dict
+        The elasticsearch response, with the snapshots (their name, indices,
+        state and start and end times) under the "snapshots" key
+    """
+    return retry_call(
+        client.snapshot.get, repository=BACKUP_REPOSITORY, snapshot="_all"
     )
-    return response.json()
 
 
 def delete_backup(snapshot=None, dryrun=True):
@@ -529,60 +2129,339 @@ def delete_backup(snapshot=None, dryrun=True):
             "You need to specify the name of a snapshot to delete. You can get a list of snapshots with .list_backups()"
         )
         return
-    command = "http://%s:%s/_snapshot/inca_backup/%s" % (
-        config.get("elasticsearch", "%s.host" % config.get("inca", "dependencies")),
-        config.get("elasticsearch", "%s.port" % config.get("inca", "dependencies")),
-        snapshot,
-    )
     if dryrun == True:
         print(
-            "This is a dry-run, nothing happens. If you specify dryrun=False, the following DELETE request will be issued:"
+            "This is a dry-run, nothing happens. If you specify dryrun=False, the following snapshot will be deleted:"
+        )
+        print(
+            "{BACKUP_REPOSITORY}/{snapshot}".format(
+                BACKUP_REPOSITORY=BACKUP_REPOSITORY, snapshot=snapshot
+            )
         )
-        print(command)
         return
     else:
-        response = requests.delete(command)
-        return response.json()
+        return retry_call(
+            client.snapshot.delete, repository=BACKUP_REPOSITORY, snapshot=snapshot
+        )
+
+
+def _document_indices(doctype=None):
+    """The names of the indices that hold documents (of a doctype)"""
+    return sorted(retry_call(client.indices.get_alias, index=search_index(doctype)))
+
 
+def backup_progress(name):
+    """Returns the progress of a snapshot
 
-def create_backup(name):
-    """create a backup of the Elasticsearch indices
+    Parameters
+    ----
+    name : string
+        The name of the snapshot
 
-    Saves a named backup to the specified backup directory. This requires
+    Returns
+    ----
+    dict
+        The `state` of the snapshot, the `processed` and `total` number of
+        bytes that are copied (only files that changed since earlier
+        snapshots are copied), the `percentage` done and the `throughput` in
+        bytes per second
+    """
+    status = check_snapshot_settings(name)["snapshots"][0]
+    stats = status.get("stats", {})
+    if "total" in stats:
+        # elasticsearch 7
+        total = stats["incremental"]["size_in_bytes"]
+        processed = stats["processed"]["size_in_bytes"]
+    else:
+        total = stats.get("total_size_in_bytes", 0)
+        processed = stats.get("processed_size_in_bytes", 0)
+    seconds = stats.get("time_in_millis", 0) / 1000.0
+    return {
+        "state": status["state"],
+        "processed": processed,
+        "total": total,
+        "percentage": 100.0 * processed / total if total else 100.0,
+        "throughput": processed / seconds if seconds else 0.0,
+    }
+
+
+def create_backup(name=None, indices=None, wait=True, poll_interval=10):
+    """create a backup of the document indices
+
+    Saves a named snapshot in the backup repository. This requires
     an inca repository to be initialized using the `create_repository` function.
     That function is required to run only once after setting a (new) path.repo
     value.
 
+    Snapshots are incremental: only the files of indices that changed since
+    earlier snapshots in the repository are copied.
+
     Parameters
     ----------
-    name : str
+    name : str (default=None)
         A string specifying a designation for the snapshot. Useful
-        for selectively loading a backup.
+        for selectively loading a backup. Defaults to the index name and the
+        current time, e.g. 'inca-2019.05.01-120000'
+    indices : str or list (default=None)
+        The indices to back up, defaults to all indices holding documents
+    wait : bool (default=True)
+        Wait for the snapshot to finish, logging its progress
+    poll_interval : int or float (default=10)
+        Seconds between progress reports
 
     Returns
     -------
     dict
-        A dictionary with the elasticsearch response
+        A dictionary with the information on the snapshot (its state,
+        indices and duration) or, if not waiting, the elasticsearch response
 
     Notes
     -----
     For this function to run, a 'inca_backup' repository must be instantiated.
     Please see the `create_repository` function.
 
-    Also note that the function returns before the backup process is completed.
+    If not waiting, the function returns before the backup process is completed.
     Avoid shutting down elasticsearch before the backup has been fully written
-    to disk.
+    to disk, see `backup_progress`.
+
+    """
+    if name is None:
+        name = "{}-{}".format(
+            elastic_index, datetime.utcnow().strftime("%Y.%m.%d-%H%M%S")
+        )
+    if indices is None:
+        indices = _document_indices()
+    if type(indices) == list:
+        indices = ",".join(indices)
+    body = {
+        "indices": indices,
+        "ignore_unavailable": False,
+        "include_global_state": False,
+    }
+    response = retry_call(
+        client.snapshot.create, repository=BACKUP_REPOSITORY, snapshot=name, body=body
+    )
+    if not wait:
+        return response
+    while True:
+        progress = backup_progress(name)
+        if progress["state"] not in ("INIT", "STARTED", "IN_PROGRESS"):
+            break
+        logger.info(
+            "Backup {name}: {percentage:.1f}% of {total} bytes, {speed:.1f} MB/s".format(
+                speed=progress["throughput"] / 1e6, name=name, **progress
+            )
+        )
+        time.sleep(poll_interval)
+    snapshot = retry_call(
+        client.snapshot.get, repository=BACKUP_REPOSITORY, snapshot=name
+    )["snapshots"][0]
+    if snapshot["state"] != "SUCCESS":
+        logger.warning(
+            "Backup {name} finished with state {state}: {failures}".format(
+                name=name, state=snapshot["state"], failures=snapshot.get("failures")
+            )
+        )
+    else:
+        logger.info(
+            "Backup {name} finished: {processed} bytes copied in {seconds:.0f}s".format(
+                name=name,
+                processed=progress["processed"],
+                seconds=snapshot.get("duration_in_millis", 0) / 1000.0,
+            )
+        )
+    return snapshot
+
+
+def apply_retention(daily=7, weekly=4, monthly=0, dryrun=True):
+    """Deletes the backups that a retention policy does not keep
+
+    The most recent successful backup of each of the last `daily` days,
+    `weekly` weeks and `monthly` months (that have backups) is kept, as is
+    the most recent backup overall. Run it after each backup, e.g. from cron:
+
+    ```bash
+    python -c "from inca.core import database; database.create_backup(); database.apply_retention(dryrun=False)"
+    ```
 
+    Parameters
+    ----
+    daily, weekly, monthly : int (default=7, 4, 0)
+        The number of days, weeks and months for which a backup is kept
+    dryrun : bool (default=True)
+        Only report which backups would be deleted
+
+    Returns
+    ----
+    list
+        The names of the deleted backups (or those that would be deleted)
     """
-    body = {"indices": "*", "ignore_unavailable": "false", "include_global_state": True}
+    snapshots = sorted(
+        list_backups()["snapshots"],
+        key=lambda snapshot: snapshot.get("start_time_in_millis", 0),
+        reverse=True,
+    )
+    succeeded = [s for s in snapshots if s.get("state") == "SUCCESS"]
+    keep = set(s["snapshot"] for s in succeeded[:1])
+    for number, period in (
+        (daily, "%Y-%m-%d"),
+        (weekly, "%G-%V"),
+        (monthly, "%Y-%m"),
+    ):
+        periods = set()
+        for snapshot in succeeded:
+            started = datetime.utcfromtimestamp(snapshot["start_time_in_millis"] / 1000)
+            key = started.strftime(period)
+            if key not in periods and len(periods) < number:
+                periods.add(key)
+                keep.add(snapshot["snapshot"])
+    in_progress = [s["snapshot"] for s in snapshots if s.get("state") == "IN_PROGRESS"]
+    delete = [
+        s["snapshot"]
+        for s in snapshots
+        if s["snapshot"] not in keep and s["snapshot"] not in in_progress
+    ]
+    for name in delete:
+        if dryrun:
+            logger.info("Would delete backup {name}".format(**locals()))
+        else:
+            logger.info("Deleting backup {name}".format(**locals()))
+            delete_backup(name, dryrun=False)
+    return delete
+
+
+def _wait_for_recovery(indices, poll_interval):
+    """Waits for restored indices to be recovered, logging their progress"""
+    while True:
+        recovery = retry_call(client.indices.recovery, index=",".join(indices))
+        shards = [shard for index in recovery.values() for shard in index["shards"]]
+        recovered = sum(
+            shard["index"]["size"]["recovered_in_bytes"] for shard in shards
+        )
+        total = sum(shard["index"]["size"]["total_in_bytes"] for shard in shards)
+        if shards and all(shard["stage"] == "DONE" for shard in shards):
+            return
+        logger.info("Restoring: {recovered} of {total} bytes".format(**locals()))
+        time.sleep(poll_interval)
+
+
+def restore_backup(name, doctype=None, overwrite=False, poll_interval=10):
+    """Restores documents from a backup
+
+    Without a `doctype`, all document indices of the backup are restored,
+    replacing the current indices (which are closed while restoring).
 
-    return client.snapshot.create(repository="inca_backup", snapshot=name, body=body)
+    With a `doctype`, only documents of that doctype are restored, while
+    the indices stay in use: the indices of the backup that can hold the
+    doctype are restored under a temporary name, the documents are copied
+    with `_reindex`, and the temporary indices are deleted.
 
+    Parameters
+    ----
+    name : string
+        The name of the backup, see `list_backups`
+    doctype : string (default=None)
+        The doctype to restore
+    overwrite : bool (default=False)
+        When restoring a doctype, whether documents that exist are replaced
+        by their version in the backup, or only deleted documents are restored
+    poll_interval : int or float (default=10)
+        Seconds between progress reports
 
-def restore_backup(name):
-    if name in [item["snapshot"] for item in list_backups()["snapshots"]]:
-        client.indices.close("inca")
-        client.snapshot.restore(repository="inca_backup", snapshot=name)
+    Returns
+    ----
+    dict
+        The response of elasticsearch to the restore (or, for a doctype, the
+        result of copying the documents), None if the backup does not exist
+    """
+    snapshots = {item["snapshot"]: item for item in list_backups()["snapshots"]}
+    if name not in snapshots:
+        logger.warning("There is no backup called {name}".format(**locals()))
+        return None
+    if INDEX_LAYOUT == "single":
+        # the index may have been migrated since the backup was made
+        pattern = re.escape(elastic_index) + r"(_v\d+)?$"
+    else:
+        pattern = "|".join(
+            fnmatch.translate(index) for index in search_index(doctype).split(",")
+        )
+    indices = [
+        index for index in snapshots[name]["indices"] if re.match(pattern, index)
+    ]
+    if not indices:
+        logger.warning("Backup {name} holds no documents to restore".format(**locals()))
+        return None
+
+    if doctype is None:
+        existing = retry_call(
+            client.indices.get_alias, index=",".join(indices), ignore_unavailable=True
+        )
+        if existing:
+            retry_call(client.indices.close, index=",".join(existing))
+        response = retry_call(
+            client.snapshot.restore,
+            repository=BACKUP_REPOSITORY,
+            snapshot=name,
+            body={"indices": ",".join(indices), "include_global_state": False},
+        )
+        _wait_for_recovery(indices, poll_interval)
+        metadata_cache.invalidate()
+        profile_cache.invalidate()
+        return response
+
+    retry_call(
+        client.snapshot.restore,
+        repository=BACKUP_REPOSITORY,
+        snapshot=name,
+        body={
+            "indices": ",".join(indices),
+            "include_global_state": False,
+            "include_aliases": False,
+            "rename_pattern": "(.+)",
+            "rename_replacement": "restored-$1",
+        },
+    )
+    restored = ["restored-" + index for index in indices]
+    try:
+        _wait_for_recovery(restored, poll_interval)
+        result = {}
+        for index in indices:
+            if INDEX_LAYOUT == "single":
+                destination = elastic_index
+            else:
+                destination = index
+                _ensure_index(destination)
+            task = retry_call(
+                client.reindex,
+                body={
+                    "conflicts": "proceed",
+                    "source": {
+                        "index": "restored-" + index,
+                        "query": {"term": {"doctype": doctype}},
+                    },
+                    "dest": {
+                        "index": destination,
+                        "op_type": "index" if overwrite else "create",
+                    },
+                },
+                wait_for_completion=False,
+            )["task"]
+            response = wait_for_task(task, poll_interval)
+            for key in ("created", "updated", "version_conflicts"):
+                result[key] = result.get(key, 0) + response.get(key, 0)
+    finally:
+        retry_call(client.indices.delete, index=",".join(restored))
+    metadata_cache.invalidate()
+    profile_cache.invalidate()
+    logger.info(
+        "Restored {doctype} from {name}: {created} documents created, {updated} updated".format(
+            doctype=doctype,
+            name=name,
+            created=result["created"],
+            updated=result["updated"],
+        )
+    )
+    return result
 
 
 #################
@@ -590,82 +2469,329 @@ def restore_backup(name):
 ################
 
 
+class _DedupStore(object):
+    """Remembers content hashes, LSH bands and duplicates during deduplicate
+
+    The tables are kept in an in-memory SQLite database until it holds
+    `max_in_memory` rows, after which they are moved to a temporary file in
+    `spill_dir` so that memory use stays bounded.
+    """
+
+    def __init__(self, max_in_memory=1000000, spill_dir=None):
+        self.max_in_memory = max_in_memory
+        self.spill_dir = spill_dir
+        self.path = None
+        self.rows = 0
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.executescript("""
+            CREATE TABLE hashes (hash TEXT PRIMARY KEY, _id TEXT);
+            CREATE TABLE bands (band TEXT PRIMARY KEY, _id TEXT);
+            CREATE TABLE signatures (_id TEXT PRIMARY KEY, signature BLOB);
+            CREATE TABLE duplicates (
+                _id TEXT PRIMARY KEY, original TEXT, similarity REAL, _index TEXT);
+            """)
+
+    def _added(self, rows):
+        self.rows += rows
+        if self.path is None and self.rows >= self.max_in_memory:
+            handle, self.path = tempfile.mkstemp(
+                prefix="inca_dedup_", suffix=".sqlite", dir=self.spill_dir
+            )
+            os.close(handle)
+            on_disk = sqlite3.connect(self.path)
+            self.connection.commit()
+            self.connection.backup(on_disk)
+            self.connection.close()
+            self.connection = on_disk
+            logger.info("Spilled deduplication tables to {}".format(self.path))
+
+    def first(self, hashval, _id):
+        """Returns the id first stored under `hashval`, storing `_id` if new"""
+        row = self.connection.execute(
+            "SELECT _id FROM hashes WHERE hash = ?", (hashval,)
+        ).fetchone()
+        if row:
+            return row[0]
+        self.connection.execute("INSERT INTO hashes VALUES (?, ?)", (hashval, _id))
+        self._added(1)
+        return _id
+
+    def similar(self, signature, bands, threshold):
+        """Returns the id and similarity of a stored near-duplicate, if any"""
+        for band in bands:
+            row = self.connection.execute(
+                "SELECT signatures._id, signature FROM bands JOIN signatures USING (_id) WHERE band = ?",
+                (band,),
+            ).fetchone()
+            if row:
+                other = fingerprints.np.frombuffer(row[1], dtype=signature.dtype)
+                score = fingerprints.similarity(signature, other)
+                if score >= threshold:
+                    return row[0], score
+        return None, 0
+
+    def add_signature(self, _id, signature, bands):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO signatures VALUES (?, ?)", (_id, signature.tobytes())
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO bands VALUES (?, ?)", [(band, _id) for band in bands]
+        )
+        self._added(1 + len(bands))
+
+    def add_duplicate(self, _id, original, similarity=1.0, index=None):
+        """Stores a duplicate with the index it is in, if known, to delete it"""
+        self.connection.execute(
+            "INSERT OR IGNORE INTO duplicates VALUES (?, ?, ?, ?)",
+            (_id, original, similarity, index),
+        )
+        self._added(1)
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM duplicates").fetchone()[0]
+
+    def duplicates(self):
+        return self.connection.execute(
+            "SELECT _id, original, similarity, _index FROM duplicates"
+        )
+
+    def close(self):
+        self.connection.close()
+        if self.path:
+            os.remove(self.path)
+
+
+# the number of documents per set of duplicates returned by the aggregation,
+# elasticsearch's default `index.max_inner_result_window`
+MAX_TOP_HITS = 100
+
+
+def _duplicates_by_aggregation(store, hash_field, query, partition_size):
+    """Find exact duplicates with a terms aggregation on a stored hash
+
+    The members of each set of duplicates are returned by the aggregation,
+    except for sets larger than MAX_TOP_HITS, of which the other members are
+    retrieved with a single scroll per partition.
+    """
+    query = query or {"match_all": {}}
+    cardinality = retry_call(
+        client.search,
+        index=index_for_query(query),
+        body={
+            "size": 0,
+            "query": query,
+            "aggs": {"hashes": {"cardinality": {"field": hash_field}}},
+        },
+    )["aggregations"]["hashes"]["value"]
+    partitions = max(1, -(-cardinality // partition_size))
+    logger.info(
+        "Searching {cardinality} distinct values of {hash_field} in {partitions} partitions".format(
+            **locals()
+        )
+    )
+    for partition in range(partitions):
+        response = retry_call(
+            client.search,
+            index=index_for_query(query),
+            body={
+                "size": 0,
+                "query": query,
+                "aggs": {
+                    "hashes": {
+                        "terms": {
+                            "field": hash_field,
+                            "min_doc_count": 2,
+                            "size": partition_size,
+                            "include": {
+                                "partition": partition,
+                                "num_partitions": partitions,
+                            },
+                        },
+                        "aggs": {
+                            "members": {
+                                "top_hits": {
+                                    "size": MAX_TOP_HITS,
+                                    "sort": [{"META.ADDED": {"order": "asc"}}],
+                                    "_source": False,
+                                }
+                            }
+                        },
+                    }
+                },
+            },
+        )
+        # hash -> original of the sets with more members than top_hits returns
+        larger = {}
+        for bucket in response["aggregations"]["hashes"]["buckets"]:
+            members = bucket["members"]["hits"]["hits"]
+            original = members[0]["_id"]
+            for member in members[1:]:
+                store.add_duplicate(member["_id"], original, index=member["_index"])
+            if bucket["doc_count"] > len(members):
+                larger[bucket["key"]] = original
+        if not larger:
+            continue
+        # the remaining members of these sets are retrieved with a single scroll
+        remaining = {"bool": {"filter": [query, {"terms": {hash_field: list(larger)}}]}}
+        for doc in scroll_query(
+            {"query": remaining}, log_interval=0, source_includes=[hash_field]
+        ):
+            value = doc["_source"]
+            for key in hash_field.split("."):
+                value = value.get(key, {})
+            if doc["_id"] != larger[value]:
+                store.add_duplicate(doc["_id"], larger[value], index=doc["_index"])
+
+
 def deduplicate(
-    g, dryrun=True, check_keys=["text", "title", "doctype", "publication_date"]
+    g=None,
+    dryrun=True,
+    check_keys=["text", "title", "doctype", "publication_date"],
+    hash_field=None,
+    query=None,
+    near_duplicates=False,
+    near_field="text",
+    threshold=0.8,
+    num_perm=64,
+    bands=16,
+    max_in_memory=1000000,
+    spill_dir=None,
+    partition_size=10000,
 ):
     """
-    Takes a document generator `g` as input and lists (if `dryrun=True`)
-    or remove (if `dryrun=False`) duplicate documents. 
-    With ```check_keys = ['key1', 'key2', ...] ``` you can specify the keys
-    on which the documents are compared.
+    Lists (if `dryrun=True`) or removes (if `dryrun=False`) duplicate documents.
+
+    Duplicates are found either by hashing the `check_keys` of the documents
+    generated by `g`, or (if `hash_field` is given) by aggregating on a hash
+    that was stored at ingest, which does not require reading the documents
+    at all. Of each set of duplicates the first document is kept: the first
+    one generated by `g`, or the earliest added when aggregating.
+
+    With `near_duplicates=True`, documents generated by `g` of which the
+    `near_field` is (almost) the same as that of an earlier document, such as
+    copies of a wire story by different outlets, are removed as well. These
+    are found with MinHash signatures of the word shingles of `near_field`,
+    bucketed with locality sensitive hashing.
+
+    Hashes and duplicates are kept in a SQLite database that is moved to disk
+    when it grows beyond `max_in_memory` rows, and duplicates are deleted
+    with bulk requests.
+
+    Parameters
+    ----
+    g : generator (default=None)
+        The documents to deduplicate, not needed when using `hash_field`
+    dryrun : bool (default=True)
+        Only list the duplicates
+    check_keys : list
+        The keys on which documents generated by `g` are compared
+    hash_field : string (default=None)
+        A field with a content hash stored at ingest, e.g. 'META.CONTENT_HASH'
+    query : dict (default=None)
+        Restricts the documents searched when using `hash_field`, e.g.
+        `{"term": {"doctype": "nu"}}`
+    near_duplicates : bool (default=False)
+        Also find near-duplicates in the documents generated by `g`, cannot
+        be combined with `hash_field`
+    near_field : string (default='text')
+        The field compared to find near-duplicates
+    threshold : float (default=0.8)
+        The minimum estimated Jaccard similarity of near-duplicates
+    num_perm : int (default=64)
+        The length of the MinHash signatures
+    bands : int (default=16)
+        The number of LSH bands, more bands find more candidates
+    max_in_memory : int (default=1000000)
+        The number of rows kept in memory before moving to disk
+    spill_dir : string (default=None)
+        Where to store the database on disk, defaults to the temporary folder
+    partition_size : int (default=10000)
+        The number of hashes per aggregation request when using `hash_field`
 
     Example usage:
     ```
     g = myinca.database.doctype_generator('nu')
-    myinca.database.deduplicate('nu', dryrun = True)
+    myinca.database.deduplicate(g, dryrun = True)
+
+    myinca.database.deduplicate(hash_field='META.CONTENT_HASH', query={"term": {"doctype": "nu"}})
     ```
 
     Functionality inspired by https://www.elastic.co/blog/how-to-find-and-remove-duplicate-documents-in-elasticsearch
     """
 
-    dict_of_duplicate_docs = {}
-    for doc in g:
-        combined_key = ""
-        for mykey in check_keys:
-            combined_key += str(doc["_source"].get(mykey, ""))
-        _id = doc["_id"]
-        hashval = md5(combined_key.encode("utf-8")).digest()
-        dict_of_duplicate_docs.setdefault(hashval, []).append(_id)
-    logger.info("Created hashtable")
-    # Search through the hash of doc values to see if any
-    # duplicate hashes have been found
-    numdups = 0
-    if dryrun:
-        for hashval, array_of_ids in dict_of_duplicate_docs.items():
-            id_to_keep = array_of_ids.pop(0)  # let's always keep the first doc
-            if len(array_of_ids) > 0:
-                # print("********** Duplicate docs hash=%s **********" % hashval)
-                # Get the documents that have mapped to the current hashval
-                matching_docs = client.mget(
-                    index=elastic_index, doc_type="doc", body={"ids": array_of_ids}
+    if hash_field and near_duplicates:
+        raise ValueError(
+            "Near-duplicates are found in the documents of `g`, not with `hash_field`"
+        )
+    store = _DedupStore(max_in_memory=max_in_memory, spill_dir=spill_dir)
+    try:
+        if hash_field:
+            _duplicates_by_aggregation(store, hash_field, query, partition_size)
+        else:
+            for doc in g:
+                _id = doc["_id"]
+                original = store.first(fingerprints.content_hash(doc, check_keys), _id)
+                if original != _id:
+                    store.add_duplicate(_id, original, index=doc.get("_index"))
+                    if dryrun:
+                        _print_duplicate(doc)
+                    continue
+                if not near_duplicates:
+                    continue
+                signature = fingerprints.minhash(
+                    doc["_source"].get(near_field, ""), num_perm=num_perm
+                )
+                if signature is None:
+                    continue
+                doc_bands = fingerprints.lsh_bands(signature, bands)
+                original, similarity = store.similar(signature, doc_bands, threshold)
+                if original:
+                    store.add_duplicate(
+                        _id, original, similarity, index=doc.get("_index")
+                    )
+                    if dryrun:
+                        _print_duplicate(doc, similarity)
+                else:
+                    store.add_signature(_id, signature, doc_bands)
+        logger.info("Created hashtable")
+        numdups = store.count()
+        if dryrun:
+            print(
+                "\nRun again with `dryrun=False` (and a fresh generator) to remove these {} documents".format(
+                    numdups
                 )
-
-                for doc in matching_docs["docs"]:
-                    numdups += 1
-                    try:
-                        print(
-                            "{}\t{}\t{}".format(
-                                doc["_source"].get("title", " " * 20)[:20],
-                                doc["_source"].get("text", " " * 20)[:20],
-                                doc["_source"].get("publication_date", " " * 10),
-                            )
-                        )
-                    except:
-                        pass
-        print(
-            "\nUse a fresh generator and run again with `dryrun=False` to remove these {} documents".format(
-                numdups
             )
-        )
-    else:
-        deleted = 0
-        to_delete = sum(
-            [len(array_of_ids) - 1 for array_of_ids in dict_of_duplicate_docs.values()]
-        )
+            return numdups
         q = "Type: Yes, go for it! if you really want to delete {} documents ".format(
-            to_delete
+            numdups
         )
         reallydelete = input(q)
         if reallydelete == "Yes, go for it!":
-            for hashval, array_of_ids in dict_of_duplicate_docs.items():
-                id_to_keep = array_of_ids.pop(0)  # let's always keep the first doc
-                for _id in array_of_ids:
-                    try:
-                        client.delete(index=elastic_index, doc_type="doc", id=_id)
-                        deleted += 1
-                    except:
-                        print("Could not delete {}.".format(_id))
-            print("Deleted {} documents".format(deleted))
+            with BulkWriter() as writer:
+                for _id, original, similarity, index in store.duplicates():
+                    writer.delete(_id, index=index)
+            for failure in writer.failed:
+                print("Could not delete {}.".format(failure["_id"]))
+            print("Deleted {} documents".format(writer.written))
+            return writer.written
+        return 0
+    finally:
+        store.close()
+
+
+def _print_duplicate(doc, similarity=1.0):
+    source = doc.get("_source", {})
+    try:
+        print(
+            "{}\t{}\t{}\t{:.2f}".format(
+                str(source.get("title", " " * 20))[:20],
+                str(source.get("text", " " * 20))[:20],
+                source.get("publication_date", " " * 10),
+                similarity,
+            )
+        )
+    except:
+        pass
 
 
 ######################
@@ -673,60 +2799,183 @@ def deduplicate(
 ######################
 
 
-def reparse(g, f, force=False):
+def _parse_many(f, htmlsources):
+    """Parse a chunk of html sources, in a worker process of reparse"""
+    parsed = []
+    for htmlsource in htmlsources:
+        try:
+            parsed.append(f(None, htmlsource))
+        except Exception as e:
+            logger.warning("Could not parse document: {}".format(e))
+            parsed.append({})
+    return parsed
+
+
+def _needs_reparse(source, fields, force):
+    if force:
+        return True
+    # without a list of fields, we only know what is missing after parsing
+    if fields is None:
+        return True
+    return any(not str(source.get(field) or "").strip() for field in fields)
+
+
+def reparse(
+    g,
+    f,
+    force=False,
+    fields=["text"],
+    workers=None,
+    chunksize=20,
+    batch_size=500,
+    log_interval=1000,
+):
     """
-    Takes a document generator `g` as reparses the `htmlsource` key using
+    Takes a document generator `g` and reparses the `htmlsource` key using
     a parse function f taken from an INCA-scraper.
-  
-    In the current implementation, only the text field is considered.
-    By default, the text field is only updated if it was empty.
+
+    By default, only the text field is considered, and it is only updated
+    if it was empty. The parse function runs in a pool of `workers`
+    processes, and the reparsed fields are written with bulk partial updates.
 
     Arguments
     ---------
-    force (bool): If True, non-empty text is replaced as well.
+    g : generator, string or dict
+        The documents to reparse. If a query (string or dict) is given
+        instead, only the fields needed for reparsing are retrieved.
+    f : function
+        The parse function, called as f(None, htmlsource) and returning a dict
+    force (bool): If True, non-empty fields are replaced as well.
+    fields : list (default=['text'])
+        The fields to take from the parse function, or None for all fields
+        it returns. Empty fields in the document are always filled, others
+        only replaced when forced. A replaced text is kept as `text_old`.
+    workers : int (default=None)
+        The number of processes that parse documents, defaults to the number
+        of CPUs. With 1, or if the parse function cannot be sent to another
+        process, documents are parsed in this process.
+    chunksize : int (default=20)
+        The number of documents sent to a worker at once
+    batch_size : int (default=500)
+        The number of documents per bulk update
+    log_interval : int (default=1000)
+        Log progress every `log_interval` documents
 
     Example usage:
     ```
     from inca.rssscrapers import news_scraper
-    f = news_scraper.nu.parsehtml 
-   
-    g = myinca.database.document_generator('doctype:"nu" AND publication_date:[2017-01-01 TO 2017-03-15]')
-    myinca.database.reparse(g, f, force = False)
-    ```
-    """
-
-    # TODO reparse now only repareses the the texts, not other fields (such as author, title etc)
-    # To implement that, we need a better logic on which fields are to be replaced when
-
-    for doc in g:
-        text_old = doc["_source"].get("text", "")
-        htmlsource = doc["_source"].get("htmlsource", None)
-        if not htmlsource:
-            logger.warning("No HTML source")
-            continue
+    f = news_scraper.nu.parsehtml
 
-        _id = doc["_id"]
-        if text_old.strip() == "":
-            logger.info("No text available for {}, reparsing".format(_id))
-            text_new = f(None, htmlsource)["text"]
-        elif force == True:
-            logger.info("Overwriting extisting text for {}, reparsing".format(_id))
-            text_new = f(None, htmlsource)["text"]
-        else:
-            logger.debug("Old text exists, will not overwrite")
-            continue
+    myinca.database.reparse('doctype:"nu" AND publication_date:[2017-01-01 TO 2017-03-15]', f, force = False)
+    myinca.database.reparse('doctype:"nu"', f, force = True, fields=None)
+    ```
 
-        logger.info(
-            "Old text: {} characters, first 30: {}".format(len(text_old), text_old[:30])
-        )
-        logger.info(
-            "New text: {} characters, first 30: {}".format(len(text_new), text_new[:30])
+    Returns
+    ----
+    dict
+        The number of `read`, `reparsed` and `updated` documents
+    """
+    if type(g) == str:
+        g = {"query": {"bool": {"must": {"query_string": {"query": g}}}}}
+    if type(g) == dict:
+        # only retrieve what is needed to reparse and fingerprint documents
+        includes = None
+        if fields is not None or force:
+            includes = list(fingerprints.CONTENT_KEYS) + list(fields or [])
+        g = scroll_query(g, source_includes=includes)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        try:
+            pickle.dumps(f)
+        except Exception:
+            logger.warning(
+                "The parse function cannot be sent to worker processes, parsing in this process"
+            )
+            workers = 1
+
+    stats = {"read": 0, "reparsed": 0, "updated": 0}
+    start = time.time()
+    next_log = log_interval
+
+    def chunks():
+        chunk = []
+        for doc in g:
+            stats["read"] += 1
+            htmlsource = doc["_source"].get("htmlsource", None)
+            if not htmlsource:
+                logger.warning("No HTML source for {}".format(doc["_id"]))
+                continue
+            if not _needs_reparse(doc["_source"], fields, force):
+                logger.debug(
+                    "Fields of {} exist, will not overwrite".format(doc["_id"])
+                )
+                continue
+            chunk.append(doc)
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def parsed_chunks():
+        if workers == 1:
+            for chunk in chunks():
+                htmlsources = [doc["_source"]["htmlsource"] for doc in chunk]
+                yield chunk, _parse_many(f, htmlsources)
+            return
+        with ProcessPoolExecutor(workers) as pool:
+            pending = collections.deque()
+            for chunk in chunks():
+                htmlsources = [doc["_source"]["htmlsource"] for doc in chunk]
+                pending.append((chunk, pool.submit(_parse_many, f, htmlsources)))
+                # keep a bounded number of chunks in flight, in order
+                while len(pending) > 2 * workers:
+                    chunk, future = pending.popleft()
+                    yield chunk, future.result()
+            while pending:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+
+    with BulkWriter(batch_size=batch_size) as writer:
+        for chunk, results in parsed_chunks():
+            for doc, new_fields in zip(chunk, results):
+                stats["reparsed"] += 1
+                source = doc["_source"]
+                update = {}
+                for field, value in new_fields.items():
+                    if fields is not None and field not in fields:
+                        continue
+                    old_value = source.get(field)
+                    if str(old_value or "").strip() and not force:
+                        continue
+                    if value == old_value:
+                        continue
+                    update[field] = value
+                if not update:
+                    continue
+                text_old = source.get("text") or ""
+                if "text" in update and len(str(text_old).strip()) > 1:
+                    update["text_old"] = text_old  # to be sure, store old text as well
+                logger.debug("Reparsed {} of {}".format(list(update), doc["_id"]))
+                source.update(update)
+                # only the new fingerprints are sent, they are merged into the stored META
+                source["META"] = fingerprints.fingerprint(source)
+                # partial update of the reparsed fields only, overwriting the old ones
+                writer.update(doc, fields=list(update) + ["META"], force=True)
+                stats["updated"] += 1
+            if log_interval and stats["reparsed"] >= next_log:
+                next_log += log_interval
+                elapsed = time.time() - start
+                logger.info(
+                    "Reparsed {reparsed} of {read} documents read, {updated} updated ({rate:.1f} documents/s)".format(
+                        rate=stats["reparsed"] / max(elapsed, 1e-6), **stats
+                    )
+                )
+    logger.info(
+        "Done: reparsed {reparsed} of {read} documents read, {updated} updated".format(
+            **stats
         )
-
-        doc["_source"]["text"] = text_new
-        if len(text_old.strip()) > 1:
-            doc["_source"]["text_old"] = text_old  # to be sure, store old text as well
-
-        update_document(
-            doc, force=True
-        )  # this force=True has nothing to do with the parameter passed to reparse()
+    )
+    return stats
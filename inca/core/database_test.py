@@ -1,6 +1,347 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from inca.core import database
+
 testdocs = [
     {"text": "Dit is een test"},
     {"text_nl": "dit is een nederlandse zin"},
     {"raw": "@dit #is %een !rare *zin"},
     {"text_raw": "@dit ^ook #is %een !rare *zin"},
 ]
+
+
+class FakeClient(object):
+    """Answers bulk requests, with the status returned by `status(op_type, action, source)`"""
+
+    def __init__(self, status=lambda op_type, action, source: 200):
+        self.status = status
+        self.requests = []
+        self.transport = SimpleNamespace(serializer=SimpleNamespace(dumps=json.dumps))
+
+    def bulk(self, body, **kwargs):
+        self.requests.append(body)
+        items, lines = [], iter(body)
+        for line in lines:
+            op_type, action = list(line.items())[0]
+            source = None if op_type == "delete" else next(lines)
+            status = self.status(op_type, action, source)
+            items.append({op_type: {"_id": action.get("_id"), "status": status}})
+        return {"took": 1, "items": items}
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    fake = FakeClient()
+    monkeypatch.setattr(database, "client", fake)
+    monkeypatch.setattr(database, "migration_target", lambda: None)
+    return fake
+
+
+def test_conditional_update_does_not_upsert(fake_client):
+    def status(op_type, action, source):
+        # elasticsearch rejects compare-and-write combined with upsert
+        if "if_seq_no" in action and source.get("doc_as_upsert"):
+            return 400
+        return 404 if action["_id"] == "gone" else 200
+
+    fake_client.status = status
+    with database.BulkWriter() as writer:
+        for _id in ("1", "gone"):
+            writer.update(
+                {"_id": _id, "_seq_no": 3, "_primary_term": 1, "_source": {"a": 1}},
+                fields=["a"],
+            )
+        writer.update({"_id": "2", "_source": {"a": 1}})
+    actions = fake_client.requests[0]
+    assert actions[1] == {"doc": {"a": 1}}
+    assert actions[5] == {"doc": {"a": 1}, "doc_as_upsert": True}
+    assert (writer.written, writer.skipped, writer.failed) == (2, 1, [])
+
+
+def test_parallel_scroll_threads_stop_with_consumer(monkeypatch):
+    def scan(client, index=None, query=None, scroll=None):
+        for number in range(100):
+            yield {"_id": "%s-%s" % (query["slice"]["id"], number), "_source": {}}
+
+    monkeypatch.setattr(database.helpers, "scan", scan)
+    monkeypatch.setattr(database, "index_for_query", lambda query: "inca")
+    documents = database.parallel_scroll_query(
+        {"query": {"match_all": {}}}, slices=2, log_interval=0, buffer_size=1
+    )
+    next(documents)
+    slices = [
+        thread
+        for thread in threading.enumerate()
+        if thread.name.startswith("inca-scroll-slice-")
+    ]
+    assert len(slices) == 2
+    documents.close()
+    for thread in slices:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in slices)
+
+
+class SortingClient(object):
+    """Answers searches over numbered documents sorted on (`n`, tiebreaker)"""
+
+    def __init__(self, number):
+        self.hits = [
+            {"_id": str(n), "_source": {"n": n // 2}, "sort": [n // 2, str(n)]}
+            for n in range(number)
+        ]
+        self.bodies = []
+
+    def search(self, index=None, body=None):
+        self.bodies.append(body)
+        after = body.get("search_after")
+        hits = [hit for hit in self.hits if after is None or hit["sort"] > after]
+        return {"hits": {"hits": hits[: body["size"]]}}
+
+
+def test_cursor_resumes_after_last_handled_document(monkeypatch):
+    fake = SortingClient(7)
+    monkeypatch.setattr(database, "client", fake)
+    monkeypatch.setattr(database, "database_available", lambda: False)
+    monkeypatch.setattr(database, "index_for_query", lambda query: "inca")
+    cursor = database.SearchAfterCursor({"sort": [{"n": "asc"}]}, batch_size=2)
+    handled = []
+    for document in cursor:
+        handled.append(document["_id"])
+        if len(handled) == 3:
+            break
+    # the document that was being handled is returned again
+    resumed = database.SearchAfterCursor({}, resume_token=cursor.resume_token)
+    assert [document["_id"] for document in resumed] == [str(n) for n in range(2, 7)]
+    resumed = database.SearchAfterCursor({}, resume_token=cursor.token_after(document))
+    handled.extend(document["_id"] for document in resumed)
+    assert handled == [str(n) for n in range(7)]
+    assert fake.bodies[0]["sort"] == [{"n": "asc"}, {"_id": "asc"}]
+
+
+def test_cursor_tiebreaker(monkeypatch):
+    monkeypatch.setattr(database, "database_available", lambda: False)
+    cursor = database.SearchAfterCursor({}, tiebreaker="id")
+    assert cursor.sort == [{"id": "asc"}]
+
+
+def test_cursor_starts_over_when_point_in_time_expired(monkeypatch):
+    fake = SortingClient(3)
+    search = fake.search
+
+    def search_point_in_time(index=None, body=None):
+        if body["pit"]["id"] == "expired":
+            raise database.NotFoundError(404)
+        return dict(search(body=body), pit_id=body["pit"]["id"])
+
+    fake.search = search_point_in_time
+    monkeypatch.setattr(database, "client", fake)
+    monkeypatch.setattr(database, "database_available", lambda: True)
+    monkeypatch.setattr(database, "ES_VERSION", (7, 12))
+    monkeypatch.setattr(
+        database.SearchAfterCursor, "_open_point_in_time", lambda self: "new"
+    )
+    monkeypatch.setattr(
+        database.SearchAfterCursor, "_close_point_in_time", lambda self, pit_id: None
+    )
+    cursor = database.SearchAfterCursor({})
+    assert cursor.sort == [{"_shard_doc": "asc"}]
+    cursor.pit_id = "expired"
+    cursor.search_after = [0, "0"]
+    assert [document["_id"] for document in cursor] == ["0", "1", "2"]
+    assert cursor.pit_id is None
+
+
+class DuplicateClient(FakeClient):
+    """Answers the aggregations of `_duplicates_by_aggregation`"""
+
+    def __init__(self, sets):
+        super(DuplicateClient, self).__init__()
+        self.sets = sets
+
+    def search(self, index=None, body=None):
+        if "cardinality" in body["aggs"]["hashes"]:
+            return {"aggregations": {"hashes": {"value": len(self.sets)}}}
+        size = body["aggs"]["hashes"]["aggs"]["members"]["top_hits"]["size"]
+        buckets = [
+            {
+                "key": key,
+                "doc_count": len(ids),
+                "members": {
+                    "hits": {
+                        "hits": [
+                            {"_id": _id, "_index": "inca-" + _id} for _id in ids[:size]
+                        ]
+                    }
+                },
+            }
+            for key, ids in self.sets.items()
+            if len(ids) > 1
+        ]
+        return {"aggregations": {"hashes": {"buckets": buckets}}}
+
+
+DUPLICATE_SETS = {
+    "a": ["a0", "a1", "a2"],
+    "b": ["b0"],
+    "c": ["c%s" % n for n in range(5)],
+}
+
+
+@pytest.fixture
+def duplicates(monkeypatch):
+    fake = DuplicateClient(DUPLICATE_SETS)
+    monkeypatch.setattr(database, "client", fake)
+    monkeypatch.setattr(database, "MAX_TOP_HITS", 3)
+    fake.scrolls = []
+
+    def scroll_query(query, log_interval=None, source_includes=None):
+        keys = query["query"]["bool"]["filter"][1]["terms"]["META.CONTENT_HASH"]
+        fake.scrolls.append(keys)
+        for key in keys:
+            for _id in DUPLICATE_SETS[key]:
+                yield {
+                    "_id": _id,
+                    "_index": "inca-" + _id,
+                    "_source": {"META": {"CONTENT_HASH": key}},
+                }
+
+    monkeypatch.setattr(database, "scroll_query", scroll_query)
+    return fake
+
+
+def test_duplicates_by_aggregation(duplicates):
+    store = database._DedupStore()
+    try:
+        database._duplicates_by_aggregation(store, "META.CONTENT_HASH", None, 10)
+        found = sorted(
+            (_id, original, index) for _id, original, _, index in store.duplicates()
+        )
+    finally:
+        store.close()
+    assert found == [("a1", "a0", "inca-a1"), ("a2", "a0", "inca-a2")] + [
+        ("c%s" % n, "c0", "inca-c%s" % n) for n in range(1, 5)
+    ]
+    assert duplicates.scrolls == [["c"]]
+
+
+def test_duplicates_are_deleted_without_lookups(duplicates, monkeypatch):
+    def locate(document_ids):
+        raise AssertionError("looked up {}".format(document_ids))
+
+    monkeypatch.setattr(database, "INDEX_LAYOUT", "month")
+    monkeypatch.setattr(database, "locate", locate)
+    monkeypatch.setattr(database, "migration_target", lambda: None)
+    monkeypatch.setattr(database, "_forget_deleted", lambda: None)
+    monkeypatch.setattr("builtins.input", lambda question: "Yes, go for it!")
+    deleted = database.deduplicate(hash_field="META.CONTENT_HASH", dryrun=False)
+    assert deleted == 6
+    (request,) = duplicates.requests
+    assert all(
+        action["delete"]["_index"] == "inca-" + action["delete"]["_id"]
+        for action in request
+    )
+
+
+def test_near_duplicates_need_documents():
+    with pytest.raises(ValueError):
+        database.deduplicate(hash_field="META.CONTENT_HASH", near_duplicates=True)
+
+
+@pytest.mark.parametrize(
+    "bounds, months",
+    [
+        ({"gte": "2020-01-15", "lt": "2020-03-01"}, "2020.01*,2020.02*,2020.03*"),
+        ({"gte": "2020-01-31||+1M", "lte": "2020-03-01"}, "*"),
+        ({"gte": "now-1M", "lte": "now"}, "*"),
+        ({"gte": "2020-01-01", "lte": "2020-01-01||+1M"}, "*"),
+        ({"gte": "2020-02-01", "lte": "2020-02-29", "time_zone": "+01:00"}, "*"),
+        ({"gte": "2020-02-01", "lte": "2020-29-02", "format": "yyyy-dd-MM"}, "*"),
+    ],
+)
+def test_month_scope_ignores_date_math(monkeypatch, bounds, months):
+    monkeypatch.setattr(database, "INDEX_LAYOUT", "month")
+    monkeypatch.setattr(database, "elastic_index", "inca")
+    query = {"query": {"bool": {"filter": [{"range": {"publication_date": bounds}}]}}}
+    expected = ",".join("inca-*-" + month for month in months.split(","))
+    assert database.index_for_query(query) == expected
+
+
+def test_indices_are_located_once_per_bulk_request(fake_client, monkeypatch):
+    lookups = []
+
+    def locate(document_ids):
+        lookups.append(document_ids)
+        return {"1": "inca-nu-2020.01", "2": "inca-nu-2020.02"}
+
+    monkeypatch.setattr(database, "INDEX_LAYOUT", "month")
+    monkeypatch.setattr(database, "locate", locate)
+    monkeypatch.setattr(database, "index_for", lambda document: "inca-new")
+    monkeypatch.setattr(database, "_forget_deleted", lambda: None)
+    with database.BulkWriter() as writer:
+        writer.update({"_id": "1", "_source": {"a": 1}})
+        writer.update({"_id": "3", "_source": {"a": 1}})
+        writer.update({"_id": "4", "_seq_no": 1, "_primary_term": 1, "_source": {}})
+        writer.update({"_id": "5", "_index": "inca-nu-2019.12", "_source": {"a": 1}})
+        writer.delete("2")
+        writer.delete("6")
+    assert lookups == [["1", "3", "4", "2", "6"]]
+    (request,) = fake_client.requests
+    actions = [line for line in request if "update" in line or "delete" in line]
+    assert [list(action.values())[0]["_index"] for action in actions] == [
+        "inca-nu-2020.01",
+        "inca-new",
+        "inca-nu-2019.12",
+        "inca-nu-2020.02",
+    ]
+    assert (writer.written, writer.skipped) == (4, 2)
+
+
+@pytest.mark.parametrize("force", [False, True])
+def test_conflicting_updates_are_resent_in_bulk(fake_client, monkeypatch, force):
+    def status(op_type, action, source):
+        # the document was changed to seq_no 7 since it was retrieved
+        return 200 if action.get("if_seq_no", 7) == 7 else 409
+
+    def bulk(body, **kwargs):
+        response = FakeClient.bulk(fake_client, body)
+        for item in response["items"]:
+            if item["update"]["status"] == 409:
+                item["update"]["error"] = {
+                    "type": "version_conflict_engine_exception",
+                    "reason": "[doc][1]: version conflict, required seqNo [3], "
+                    "primary term [1]. current document has seqNo [7] and "
+                    "primary term [2]",
+                }
+        return response
+
+    def sleep(seconds):
+        raise AssertionError("conflicts are re-sent without waiting")
+
+    fake_client.status = status
+    monkeypatch.setattr(fake_client, "bulk", bulk)
+    monkeypatch.setattr(database.time, "sleep", sleep)
+    with database.BulkWriter() as writer:
+        writer.update(
+            {"_id": "1", "_seq_no": 3, "_primary_term": 1, "_source": {"a": 1}},
+            force=force,
+        )
+    first, second = fake_client.requests
+    assert second[1] == {"doc": {"a": 1}}
+    if force:
+        assert "if_seq_no" not in second[0]["update"]
+    else:
+        assert second[0]["update"]["if_seq_no"] == 7
+        assert second[0]["update"]["if_primary_term"] == 2
+    assert (writer.written, writer.failed) == (1, [])
+
+
+def test_updates_that_keep_conflicting_fail(fake_client):
+    fake_client.status = lambda op_type, action, source: 409
+    with database.BulkWriter(max_retries=2) as writer:
+        writer.update({"_id": "1", "_seq_no": 3, "_primary_term": 1, "_source": {}})
+    assert len(fake_client.requests) == 3
+    assert [failure["status"] for failure in writer.failed] == [409]
@@ -12,10 +12,17 @@ import datetime
 import types
 from celery import Task
 from .search_utils import doctype_last, doctype_first
+from .fingerprints import fingerprint
 
 logger = logging.getLogger("INCA")
 
-from .database import insert_document, insert_documents, update_document, check_exists
+from .database import (
+    insert_document,
+    insert_documents,
+    update_document,
+    check_exists,
+    check_exists_many,
+)
 
 
 class Document(Task):
@@ -50,7 +57,7 @@ class Document(Task):
         """
         pass
 
-    def _save_document(self, document, forced=False):
+    def _save_document(self, document, forced=False, writer=None):
         """
         Documents are saved to the general document collection
         defined in the core.database file.
@@ -61,10 +68,13 @@ class Document(Task):
         Note that by default, documents can only extend, not replace
         old documents.
 
+        If a `writer` (a core.database.BulkWriter) is given, the document
+        is queued for a bulk request instead of inserted directly.
+
         """
         if type(document) == list:
             logger.debug("Detected document batch, forwarding to batch saver")
-            self._save_documents(document, forced=forced)
+            self._save_documents(document, forced=forced, writer=writer)
 
         else:
             logger.debug("Saving individual document")
@@ -83,15 +93,20 @@ class Document(Task):
             else:
                 custom_identifier = None
             self._verify(document)
-            insert_document(document, custom_identifier=custom_identifier)
+            if writer is not None:
+                writer.insert(document, custom_identifier=custom_identifier)
+            else:
+                insert_document(document, custom_identifier=custom_identifier)
 
-    def _save_documents(self, documents, forced=False):
+    def _save_documents(self, documents, forced=False, writer=None):
         """
         Handles a batch of multiple documents for efficient processing in ES.
 
         Functionality mirrors that of _save_document, but calls the batch_update
-        on the list of documents rather than individually inserting them.
+        on the list of documents rather than individually inserting them. The
+        existence of custom identifiers is checked for the whole batch at once.
         """
+        identifiers = []
         for document in documents:
             assert (
                 self.doctype
@@ -106,10 +121,15 @@ class Document(Task):
             if "_id" in document.keys():
                 custom_identifier = document.pop("_id")
             else:
-                custom_identifier = None
+                custom_identifier = document.get("id", None)
+            identifiers.append(custom_identifier)
             self._verify(document)
 
-        insert_documents(documents)
+        if writer is not None:
+            for document, custom_identifier in zip(documents, identifiers):
+                writer.insert(document, custom_identifier=custom_identifier)
+        else:
+            insert_documents(documents, identifiers=identifiers)
 
     def _update_document(self, new_document_body):
         """
@@ -126,7 +146,8 @@ class Document(Task):
         the 'get' function docstring and arguments.
 
         All new keys are reflected in the 'META' key with the information
-        about the script in question.
+        about the script in question. A hash and SimHash of the content are
+        stored as 'META.CONTENT_HASH' and 'META.SIMHASH'.
 
         """
         if type(document) == list or isinstance(document, types.GeneratorType):
@@ -160,6 +181,9 @@ class Document(Task):
             if key not in document["META"].keys():
                 document["META"][key] = meta
 
+        # hashes of the content for change detection and deduplication
+        document["META"].update(fingerprint(document))
+
         return document
 
     def _verify(self, document):
@@ -214,6 +238,10 @@ class Document(Task):
         """Checks whether a document already exists, can be overwritten for testing etc """
         return check_exists(doc_id)
 
+    def _check_exists_many(self, doc_ids):
+        """Checks for a batch of ids whether the documents exist, can be overwritten for testing etc """
+        return check_exists_many(doc_ids)
+
     def _last_added(self):
         """returns last added document of class"""
         last = doctype_last(self.doctype)
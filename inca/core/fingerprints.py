@@ -0,0 +1,169 @@
+"""
+This file provides fingerprints of document contents.
+
+1. content_hash(document, keys) : a stable hash of the given fields, equal for exact duplicates
+2. minhash(text) : a MinHash signature of the word shingles of a text, to estimate similarity
+3. lsh_bands(signature, bands) : the keys under which a signature is bucketed for near-duplicate search
+4. simhash(text) : a compact 64-bit fingerprint of a text, similar texts differ in few bits
+5. fingerprint(document) : the content hash and SimHash stored in the META of new documents
+
+"""
+
+from hashlib import md5, blake2b
+import re
+
+import numpy as np
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+_permutations = {}
+
+# the fields of which the content hash is stored at ingest, see `fingerprint`
+CONTENT_KEYS = ("text", "title", "htmlsource")
+
+
+def content_hash(document, keys=("text", "title", "doctype", "publication_date")):
+    """Returns a hexadecimal md5 hash of the values of `keys` in `document`
+
+    Parameters
+    ----
+    document : dict
+        A document, either as stored in elasticsearch (with a `_source` key)
+        or its contents
+    keys : iterable
+        The fields that are hashed, missing fields count as empty strings
+    """
+    source = document.get("_source", document)
+    combined = "\x1f".join(str(source.get(key, "") or "") for key in keys)
+    return md5(combined.encode("utf-8")).hexdigest()
+
+
+def shingles(text, size=5):
+    """Returns the set of lowercased `size`-word sequences in `text`"""
+    words = re.findall(r"\w+", str(text).lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def _get_permutations(num_perm):
+    if num_perm not in _permutations:
+        generator = np.random.RandomState(1)
+        _permutations[num_perm] = (
+            generator.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64),
+            generator.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64),
+        )
+    return _permutations[num_perm]
+
+
+def minhash(text, num_perm=64, shingle_size=5):
+    """Returns the MinHash signature of the word shingles of `text`
+
+    The share of positions at which the signatures of two texts are equal
+    estimates the Jaccard similarity of their shingles, see `similarity`.
+
+    Parameters
+    ----
+    text : string
+    num_perm : int (default=64)
+        The length of the signature
+    shingle_size : int (default=5)
+        The number of words per shingle
+
+    Returns
+    ----
+    numpy.ndarray or None
+        The signature (uint32 values) or None if the text contains no words
+    """
+    units = shingles(text, shingle_size)
+    if not units:
+        return None
+    hashes = np.array(
+        [
+            int.from_bytes(blake2b(unit.encode("utf-8"), digest_size=4).digest(), "big")
+            for unit in units
+        ],
+        dtype=np.uint64,
+    )
+    a, b = _get_permutations(num_perm)
+    with np.errstate(over="ignore"):
+        permuted = (np.outer(a, hashes) + b[:, None]) % _MERSENNE_PRIME
+    return (permuted & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+
+def similarity(signature, other):
+    """Estimates the Jaccard similarity of two MinHash signatures"""
+    return float(np.mean(signature == other))
+
+
+def lsh_bands(signature, bands=16):
+    """Returns one key per band of the signature
+
+    Texts of which at least one band key is equal are candidate
+    near-duplicates. More bands find more candidates at lower similarities.
+    """
+    rows = len(signature) // bands
+    return [
+        "{}:{}".format(
+            band,
+            md5(signature[band * rows : (band + 1) * rows].tobytes()).hexdigest()[:16],
+        )
+        for band in range(bands)
+    ]
+
+
+def simhash(text):
+    """Returns the 64-bit SimHash of the words in `text` as 16 hex characters
+
+    The number of bits in which the SimHashes of two texts differ (see
+    `simhash_distance`) is small when the texts are similar.
+
+    Returns
+    ----
+    string or None
+        None if the text contains no words
+    """
+    counts = {}
+    for word in re.findall(r"\w+", str(text).lower()):
+        counts[word] = counts.get(word, 0) + 1
+    if not counts:
+        return None
+    hashes = np.array(
+        [blake2b(word.encode("utf-8"), digest_size=8).digest() for word in counts],
+        dtype="S8",
+    )
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1)
+    weights = np.array(list(counts.values()))
+    votes = weights @ (2 * bits.astype(np.int64) - 1)
+    return np.packbits(votes > 0).tobytes().hex()
+
+
+def simhash_distance(fingerprint, other):
+    """The number of bits in which two SimHashes differ"""
+    return bin(int(fingerprint, 16) ^ int(other, 16)).count("1")
+
+
+def fingerprint(document, keys=CONTENT_KEYS):
+    """Returns the fingerprints of a document to store in its META
+
+    Parameters
+    ----
+    document : dict
+        The contents of a document
+    keys : iterable (default=CONTENT_KEYS)
+        The fields that are hashed
+
+    Returns
+    ----
+    dict
+        `CONTENT_HASH`, a hash of `keys` that changes with any change to
+        these fields, and `SIMHASH`, a SimHash of the `text`. Empty if the
+        document has none of the `keys`.
+    """
+    if not any(document.get(key) for key in keys):
+        return {}
+    return {
+        "CONTENT_HASH": content_hash(document, keys),
+        "SIMHASH": simhash(document.get("text", "")),
+    }
@@ -0,0 +1,51 @@
+from inca.core import fingerprints
+
+TEXT = (
+    "De aanrandingen in Keulen zouden het werk kunnen zijn van bendes "
+    "straatrovers, schrijft de krant op basis van politiebronnen"
+)
+
+
+def test_content_hash_ignores_unhashed_fields():
+    document = {"text": TEXT, "title": "Keulen", "doctype": "nu"}
+    assert fingerprints.content_hash(document) == fingerprints.content_hash(
+        {"_source": dict(document, url="https://nu.nl")}
+    )
+    assert fingerprints.content_hash(document) != fingerprints.content_hash(
+        dict(document, title="Keulen!")
+    )
+
+
+def test_minhash_estimates_similarity():
+    signature = fingerprints.minhash(TEXT)
+    assert len(signature) == 64
+    assert fingerprints.similarity(signature, fingerprints.minhash(TEXT.upper())) == 1
+    other = fingerprints.minhash("Een heel ander bericht over het weer van morgen")
+    assert fingerprints.similarity(signature, other) < 0.2
+    assert fingerprints.minhash("...") is None
+
+
+def test_similar_texts_share_a_band():
+    bands = fingerprints.lsh_bands(fingerprints.minhash(TEXT))
+    similar = fingerprints.lsh_bands(fingerprints.minhash(TEXT + " in Keulen"))
+    assert len(bands) == 16
+    assert set(bands) & set(similar)
+
+
+def test_simhash_distance():
+    fingerprint = fingerprints.simhash(TEXT)
+    assert len(fingerprint) == 16
+    assert fingerprints.simhash_distance(fingerprint, fingerprint) == 0
+    close = fingerprints.simhash_distance(
+        fingerprint, fingerprints.simhash(TEXT + " gisteren")
+    )
+    far = fingerprints.simhash_distance(
+        fingerprint, fingerprints.simhash("Een heel ander bericht over het weer")
+    )
+    assert close < far
+    assert fingerprints.simhash("") is None
+
+
+def test_fingerprint_of_documents_without_content():
+    assert fingerprints.fingerprint({"url": "https://nu.nl"}) == {}
+    assert set(fingerprints.fingerprint({"text": TEXT})) == {"CONTENT_HASH", "SIMHASH"}
@@ -4,7 +4,8 @@ import os
 import time
 from .document_class import Document
 from collections import Counter
-from .search_utils import document_generator
+from .search_utils import document_generator, document_cursor
+from .database import BulkWriter
 from .filenames import id2filename
 import zipfile
 import gzip
@@ -103,7 +104,7 @@ class Importer(BaseImportExport):
 
     functiontype = "importer"
 
-    def _ingest(self, iterable, doctype):
+    def _ingest(self, iterable, doctype, writer=None):
         """Ingest document (batch)
 
         Parameters
@@ -117,6 +118,10 @@ class Importer(BaseImportExport):
         doctype : string
             A string to set the doctype of the added documents
 
+        writer : core.database.BulkWriter (default=None)
+            A writer to queue the documents in, they are inserted
+            directly if omitted
+
         """
         self.doctype = doctype
 
@@ -128,7 +133,7 @@ class Importer(BaseImportExport):
             i = self._add_metadata(iterable.get("_source", iterable))
 
         # Save document(s) using document base-class method
-        self._save_document(i)
+        self._save_document(i, writer=writer)
 
     def _apply_mapping(self, document, mapping):
         """Apply a given mapping to a document
@@ -191,11 +196,12 @@ class Importer(BaseImportExport):
     def run(self, mapping={}, *args, **kwargs):
         """uses the documents from the load method in batches """
         self.processed = 0
-        for batch in self._process_by_batch(self.load(*args, **kwargs)):
-            batch = list(map(lambda doc: self._apply_mapping(doc, mapping), batch))
-            for doc in batch:
-                self._ingest(iterable=doc, doctype=doc["doctype"])
-                self.processed += 1
+        with BulkWriter() as writer:
+            for batch in self._process_by_batch(self.load(*args, **kwargs)):
+                batch = list(map(lambda doc: self._apply_mapping(doc, mapping), batch))
+                for doc in batch:
+                    self._ingest(iterable=doc, doctype=doc["doctype"], writer=writer)
+                    self.processed += 1
         logger.info("Added {} documents to the database.".format(self.processed))
 
 
@@ -211,6 +217,7 @@ class Exporter(BaseImportExport):
         BaseImportExport.__init__(self, *args, **kwargs)
         self.fileobj = None
         self.extension = ""
+        self.resume_token = None
 
     def save(self, batch_of_documents, destination="exports", *args, **kwargs):
         """To be implemented in subclass
@@ -264,8 +271,22 @@ class Exporter(BaseImportExport):
                     logger.warning("Unable to ready field {k} for writing".format(k=k))
         return flat_dict
 
-    def _retrieve(self, query):
-        for doc in document_generator(query):
+    def _source_filter(self, *args, **kwargs):
+        """Returns the fields to include and exclude when retrieving documents
+
+        Receives the arguments passed to `save`. Override this method in
+        subclasses that do not export all fields, so these are not retrieved
+        from elasticsearch.
+
+        Returns
+        ----
+        tuple
+            the `_source` includes and excludes, `None` to retrieve all fields
+        """
+        return None, None
+
+    def _retrieve(self, documents):
+        for doc in documents:
             self.processed += 1
             yield doc
 
@@ -301,6 +322,8 @@ class Exporter(BaseImportExport):
         destination="exports/",
         overwrite=False,
         batchsize=None,
+        resumable=False,
+        resume_token=None,
         *args,
         **kwargs
     ):
@@ -330,15 +353,36 @@ class Exporter(BaseImportExport):
             Whether to write over an existing file (stop if False)
         batchsize : int
             Size of documents to keep in memory for each batch
+        resumable : bool (default=False)
+            Whether to retrieve documents with a resumable cursor instead of
+            a scroll. After every batch, `self.resume_token` holds a token to
+            continue after the last exported document.
+        resume_token : string (default=None)
+            The `resume_token` of an interrupted (resumable) export of the same
+            query, to continue where it stopped
         *args & **kwargs
             Subclass specific arguments passed to save method
 
         """
         if not batchsize:
             batchsize = self.batchsize
+        source_includes, source_excludes = self._source_filter(*args, **kwargs)
+        if resumable or resume_token:
+            documents = document_cursor(
+                query,
+                resume_token=resume_token,
+                source_includes=source_includes,
+                source_excludes=source_excludes,
+            )
+        else:
+            documents = document_generator(
+                query, source_includes=source_includes, source_excludes=source_excludes
+            )
         for docbatch in self._process_by_batch(
-            self._retrieve(query), batchsize=batchsize
+            self._retrieve(documents), batchsize=batchsize
         ):
             self.save(docbatch, destination=destination, *args, **kwargs)
+            if resumable or resume_token:
+                self.resume_token = documents.token_after(docbatch[-1])
         if self.fileobj:
             self.fileobj.close()
@@ -0,0 +1,86 @@
+"""
+This file provides an in-process cache for database metadata.
+
+Metadata such as the list of doctypes and their document counts is asked
+for on hot paths (e.g. every time a processor decides whether it was given a
+doctype), but changes slowly. Values are cached for `ttl` seconds. Writes
+through `core.database` invalidate the cache of the process that made them;
+other processes see changes once their entries expire. Deletions also
+invalidate the field profiles in `profile_cache`.
+"""
+
+import threading
+import time
+
+
+class MetadataCache(object):
+    """A thread-safe mapping of keys to values that expire after `ttl` seconds
+
+    Parameters
+    ----
+    ttl : int or float (default=60)
+        The number of seconds a computed value is used
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._entries = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, refresh=False):
+        """Returns the cached value of `key`, calling `compute()` if it expired
+
+        Parameters
+        ----
+        key : string
+        compute : function
+            Called without arguments to compute the value if it is not cached
+        refresh : bool (default=False)
+            Compute the value even if it is cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            generation = self._generation
+        if entry and not refresh and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        value = compute()
+        with self._lock:
+            # do not store values that may predate an invalidation
+            if generation == self._generation:
+                self._entries[key] = (time.time(), value)
+        return value
+
+    def peek(self, key):
+        """Returns the cached value of `key`, or None if it is not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def put(self, key, value):
+        """Caches `value` under `key`, forgetting values that expired"""
+        now = time.time()
+        with self._lock:
+            for expired in [
+                k for k, entry in self._entries.items() if now - entry[0] >= self.ttl
+            ]:
+                del self._entries[expired]
+            self._entries[key] = (now, value)
+
+    def invalidate(self, *keys):
+        """Forget the given keys, or everything if no keys are given"""
+        with self._lock:
+            self._generation += 1
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+metadata_cache = MetadataCache()
+
+# field coverage profiles per doctype (see `search_utils.doctype_fields`), which
+# are updated with new documents but recomputed after documents are deleted
+profile_cache = MetadataCache(ttl=24 * 60 * 60)
@@ -0,0 +1,71 @@
+import threading
+
+from inca.core import metadata_cache
+from inca.core.metadata_cache import MetadataCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_values_expire(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(metadata_cache, "time", clock)
+    cache = MetadataCache(ttl=60)
+    computed = []
+
+    def compute():
+        computed.append(clock.now)
+        return len(computed)
+
+    assert cache.get("doctypes", compute) == 1
+    clock.now += 59
+    assert cache.get("doctypes", compute) == 1
+    assert cache.peek("doctypes") == 1
+    clock.now += 1
+    assert cache.peek("doctypes") is None
+    assert cache.get("doctypes", compute) == 2
+    assert cache.get("doctypes", compute, refresh=True) == 3
+
+
+def test_put_forgets_expired_values(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(metadata_cache, "time", clock)
+    cache = MetadataCache(ttl=60)
+    cache.put("old", 1)
+    clock.now += 60
+    cache.put("new", 2)
+    assert list(cache._entries) == ["new"]
+
+
+def test_invalidate():
+    cache = MetadataCache()
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.invalidate("a")
+    assert cache.peek("a") is None and cache.peek("b") == 2
+    cache.invalidate()
+    assert cache.peek("b") is None
+
+
+def test_values_computed_before_an_invalidation_are_not_stored():
+    cache = MetadataCache()
+    computing, invalidated = threading.Event(), threading.Event()
+
+    def compute():
+        computing.set()
+        invalidated.wait(5)
+        return "stale"
+
+    thread = threading.Thread(target=lambda: cache.get("doctypes", compute))
+    thread.start()
+    computing.wait(5)
+    cache.invalidate("doctypes")
+    invalidated.set()
+    thread.join(5)
+    assert cache.peek("doctypes") is None
+    assert cache.get("doctypes", lambda: "fresh") == "fresh"
@@ -0,0 +1,153 @@
+"""
+This file provides an in-process registry of loaded models.
+
+Processors such as `ner`, `pretrained` and `sentiment_vader_en` need a model
+(a spaCy pipeline, a pickled classifier, a lexicon) that is expensive to
+load, but can be reused for every document. Models are loaded the first time
+they are asked for and kept until the estimated memory they use exceeds the
+budget, after which the least recently used models are dropped.
+
+Models that were loaded before a process forks (e.g. the workers of the
+'parallel' action of `Processer.runwrap`, or a prefork celery worker) are
+reused by the child processes, unless they are registered as not fork-safe.
+"""
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+
+def _rss():
+    """The resident memory of this process in bytes, or None if unknown"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _path_size(path):
+    """The size in bytes of a file, or of all files in a directory"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return size
+
+
+class ModelRegistry(object):
+    """A thread-safe, least recently used cache of loaded models
+
+    Parameters
+    ----
+    budget : int (default=None)
+        The number of bytes the models may use in total, or None for no
+        limit. The model that was used last is always kept.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self._entries = OrderedDict()
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            registry = weakref.ref(self)
+
+            def after_fork():
+                if registry() is not None:
+                    registry()._after_fork()
+
+            os.register_at_fork(after_in_child=after_fork)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # locks may have been held by threads that do not exist in the child
+        self._reset()
+        for key in [k for k, entry in self._entries.items() if not entry[2]]:
+            del self._entries[key]
+
+    def get(self, key, load, size=None, fork_safe=True):
+        """Returns the model registered under `key`, calling `load()` if it
+        is not loaded yet
+
+        Threads asking for the same model at the same time wait for a single
+        load.
+
+        Parameters
+        ----
+        key : string
+            Identifies the model, e.g. the path it is loaded from
+        load : function
+            Called without arguments to load the model
+        size : int (default=None)
+            The number of bytes the model uses. If not given, it is estimated
+            from the memory the process gained while loading, or from the
+            size of the file or directory `key` if that is larger.
+        fork_safe : bool (default=True)
+            Whether child processes can use the model loaded by their parent,
+            otherwise they load it again
+        """
+        if os.getpid() != self._pid:
+            # forked without register_at_fork
+            self._after_fork()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                return entry[0]
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+            before = _rss()
+            model = load()
+            if size is None:
+                after = _rss()
+                size = after - before if before is not None and after else 0
+                if isinstance(key, str) and os.path.exists(key):
+                    size = max(size, _path_size(key))
+            with self._lock:
+                self._entries[key] = (model, max(size, 0), fork_safe)
+                self._loading.pop(key, None)
+                self._evict()
+        return model
+
+    def _evict(self):
+        """Drops the least recently used models until they fit the budget"""
+        while (
+            self.budget is not None
+            and len(self._entries) > 1
+            and self.used > self.budget
+        ):
+            self._entries.popitem(last=False)
+
+    @property
+    def used(self):
+        """The estimated number of bytes used by the loaded models"""
+        return sum(entry[1] for entry in self._entries.values())
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def evict(self, *keys):
+        """Drop the given models, or all models if no keys are given"""
+        with self._lock:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+model_registry = ModelRegistry()
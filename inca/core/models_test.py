@@ -0,0 +1,83 @@
+import os
+import threading
+
+import pytest
+
+from inca.core.models import ModelRegistry
+
+
+def test_models_are_loaded_once():
+    registry = ModelRegistry()
+    loads = []
+    started = threading.Event()
+
+    def load():
+        loads.append(1)
+        started.wait(5)
+        return object()
+
+    models = []
+    threads = [
+        threading.Thread(target=lambda: models.append(registry.get("m", load, size=1)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    started.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(loads) == 1
+    assert len(models) == 4 and all(model is models[0] for model in models)
+
+
+def test_least_recently_used_models_are_evicted():
+    registry = ModelRegistry(budget=25)
+    registry.get("a", object, size=10)
+    registry.get("b", object, size=10)
+    registry.get("a", object)
+    registry.get("c", object, size=10)
+    assert "b" not in registry and "a" in registry and "c" in registry
+    assert registry.used == 20
+
+
+def test_the_last_model_is_kept_over_budget():
+    registry = ModelRegistry(budget=5)
+    registry.get("a", object, size=10)
+    registry.get("b", object, size=10)
+    assert "a" not in registry and "b" in registry
+
+
+def test_size_is_estimated_from_the_model_path(tmp_path):
+    path = tmp_path / "model"
+    path.mkdir()
+    (path / "weights").write_bytes(b"0" * 100000)
+    registry = ModelRegistry()
+    registry.get(str(path), object)
+    assert registry.used >= 100000
+
+
+def test_evict():
+    registry = ModelRegistry()
+    registry.get("a", object, size=1)
+    registry.get("b", object, size=1)
+    registry.evict("a")
+    assert "a" not in registry and "b" in registry
+    registry.evict()
+    assert registry.used == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_models_that_are_not_fork_safe_are_reloaded_in_children():
+    registry = ModelRegistry()
+    registry.get("safe", object, size=1)
+    registry.get("unsafe", object, size=1, fork_safe=False)
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.write(write, b"%d%d" % ("safe" in registry, "unsafe" in registry))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    os.close(write)
+    assert os.read(read, 2) == b"10"
+    os.close(read)
+    assert "unsafe" in registry
@@ -10,9 +10,33 @@ yields a key:value pair per document, but does not need to return the old docume
 
 """
 
+import datetime
+import functools
+import json
 import logging
+import os
+import pickle
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from celery import Task
 from .document_class import Document
-from .database import get_document, update_document, check_exists, config
+from .database import (
+    get_document,
+    update_document,
+    check_exists,
+    config,
+    BulkWriter,
+    SearchAfterCursor,
+)
+from .models import model_registry
 
 # from . import *
 from inca import core
@@ -22,6 +46,9 @@ from collections import OrderedDict
 logger = logging.getLogger("INCA")
 logger.setLevel("DEBUG")
 
+# the memory (in MB) that models loaded by processors may use per process
+model_registry.budget = config.getfloat("inca", "model_memory", fallback=2048) * 2**20
+
 
 class Processer(Document):
     """
@@ -48,6 +75,129 @@ class Processer(Document):
         """CHANGE THIS METHOD, should return the changed document"""
         return updated_field
 
+    def setup(self):
+        """OVERWRITE THIS METHOD to load models, stemmers etc. once, it is called
+        before the first document is processed (and once in every worker
+        process of the 'parallel' action)
+        """
+        pass
+
+    def _ensure_setup(self):
+        if not getattr(self, "_is_set_up", False):
+            self.setup()
+            self._is_set_up = True
+
+    def process_batch(self, document_fields, *args, **kwargs):
+        """OVERWRITE THIS METHOD if a list of fields can be processed more
+        efficiently at once than one by one, should return a list with the
+        result for each field, in order.
+
+        Used by the 'batch' and 'celery_batch' actions of `runwrap`. If
+        `extra_fields` are used, they are passed as a list with the extra
+        fields of each document.
+        """
+        extra_fields = kwargs.pop("extra_fields", None)
+        if extra_fields is None:
+            return [self.process(field, *args, **kwargs) for field in document_fields]
+        return [
+            self.process(field, *args, extra_fields=extra, **kwargs)
+            for field, extra in zip(document_fields, extra_fields)
+        ]
+
+    def _process_documents(self, documents, field, new_key, force, *args, **kwargs):
+        """Processes a batch of documents with `process_batch`
+
+        Returns
+        ----
+        tuple
+            The documents (in the same form as given) and a list of those that
+            got a new value for `new_key`
+        """
+        documents = [
+            get_document(doc) if type(doc) != dict and check_exists(doc)[0] else doc
+            for doc in documents
+        ]
+        todo = []
+        for document in documents:
+            if type(document) != dict:
+                logger.debug("document retrieval failure {document}".format(**locals()))
+                continue
+            source = document.get("_source", document)
+            if field not in source:
+                logger.warning("Key not found in document")
+                continue
+            if force or new_key not in source:
+                todo.append(document)
+        if not todo:
+            return documents, []
+        self._ensure_setup()
+        self._apply(
+            [document.get("_source", document) for document in todo],
+            field,
+            new_key,
+            *args,
+            **kwargs
+        )
+        return documents, todo
+
+    def _apply(self, sources, field, new_key, *args, **kwargs):
+        """Sets `new_key` in the contents of documents to the results of
+        `process_batch` on their `field`
+        """
+        if "extra_fields" in kwargs:
+            fieldnames = kwargs.pop("extra_fields")
+            kwargs["extra_fields"] = [
+                OrderedDict((name, source.get(name)) for name in fieldnames)
+                for source in sources
+            ]
+        results = self.process_batch(
+            [source[field] for source in sources], *args, **kwargs
+        )
+        for source, result in zip(sources, results):
+            source[new_key] = result
+
+    def _output_keys(self, field, new_key):
+        """The fields that are written when results are saved"""
+        return [new_key]
+
+    def _worker_spec(self):
+        """The class and keyword arguments from which the processor is
+        recreated in the worker processes of the 'parallel' action
+        """
+        return type(self), {}
+
+    def run_batch(
+        self, documents, field, new_key=None, save=False, force=False, *args, **kwargs
+    ):
+        """
+        Run a processor on a batch of documents with `process_batch`.
+
+        Input
+        ---
+        documents: list
+            documents (or ids) to be processed
+        field, new_key, save, force, extra_fields:
+            see `run`
+
+        Returns
+        ---
+        The processed documents or, when saving, the number of saved documents
+        """
+        if not new_key:
+            new_key = "%s_%s" % (field, self.__name__)
+        documents, updated = self._process_documents(
+            documents, field, new_key, force, *args, **kwargs
+        )
+        if not save:
+            return documents
+        with BulkWriter() as writer:
+            for document in updated:
+                if "_id" in document:
+                    writer.update(
+                        document, fields=self._output_keys(field, new_key), force=force
+                    )
+        return writer.written
+
     def runwrap(
         self,
         docs_or_query,
@@ -67,53 +217,229 @@ class Processer(Document):
         ---
         docs_or_query:
             either a list of documents, an elasticsearch query or a string specifying the doctype
-        action: on of ['run','delay', 'batch' ]
+        action: on of ['run','delay', 'batch', 'celery_batch', 'parallel' ]
+
+        The 'batch' action retrieves documents in pages of `batch_size`
+        (default 100) and processes each page with `process_batch`, in up to
+        `concurrency` (default 1) threads. The 'celery_batch' action sends
+        the pages to celery workers, which process and save them, with up to
+        `concurrency` (default 4) pages outstanding. Both log the number of
+        processed documents and the throughput every `log_interval` (default
+        10) seconds.
+
+        The 'parallel' action is meant for processors that keep the CPU busy.
+        Pages of `batch_size` documents, read on a separate thread, are
+        processed by `concurrency` (default: the number of CPUs) worker
+        processes, each of which calls `setup` once. Results are yielded or
+        saved as soon as a page is done, or in the original order if
+        `ordered=True`.
+
+        When saving, only the fields used by the processor are retrieved and
+        results are written as bulk partial updates of the new key only,
+        rather than per document.
+
+        Processing a query or doctype can be made resumable by passing
+        `resumable=True`: documents are then retrieved with a cursor and, each
+        time results are written, `self.resume_token` is set to a token that
+        can be passed as `resume_token=<token>` to continue after an
+        interruption. On elasticsearch 7.12 and higher the cursor searches a
+        point-in-time, which is kept for an hour after an interruption: later
+        resumes start over (skipping documents that already have the new key
+        unless `force=True`).
 
         """
-        documents = _doctype_query_or_list(docs_or_query, field=field, force=force)
+        batch_size = kwargs.pop("batch_size", 100)
+        concurrency = kwargs.pop("concurrency", None)
+        log_interval = kwargs.pop("log_interval", 10)
+        ordered = kwargs.pop("ordered", False)
+        resume_token = kwargs.pop("resume_token", None)
+        resumable = kwargs.pop("resumable", False) or bool(resume_token)
+        self.resume_token = resume_token
+        if save:
+            source_includes = [field, new_key or "%s_%s" % (field, self.__name__)]
+            source_includes.extend(kwargs.get("extra_fields", []))
+        else:
+            source_includes = None
+        documents = _doctype_query_or_list(
+            docs_or_query,
+            field=field,
+            force=force,
+            task=None if new_key else self.__name__,
+            seq_no_primary_term=save,
+            source_includes=source_includes,
+            resumable=resumable,
+            resume_token=resume_token,
+        )
+        # lists of documents are not retrieved with a cursor
+        resumable = isinstance(documents, SearchAfterCursor)
+
+        if action == "parallel":
+            try:
+                # the processor is recreated in the workers
+                pickle.dumps((self._worker_spec(), args, kwargs))
+            except Exception:
+                logger.warning(
+                    "Unable to process in parallel, the processor or its "
+                    "arguments cannot be pickled. Processing in batches instead"
+                )
+                action = "batch"
 
         if action == "run":
-            for doc in documents:
-                if save == False:
+            if save == False:
+                for doc in documents:
                     yield self.run(doc, field, new_key, save, force, *args, **kwargs)
-                elif (
-                    save == True
-                ):  # do not yield documents if saving to database anyway
-                    _ = self.run(doc, field, new_key, save, force, *args, **kwargs)
+            elif save == True:  # do not yield documents if saving to database anyway
+                if not new_key:
+                    new_key = "%s_%s" % (field, self.__name__)
+                with BulkWriter() as writer:
+                    for num, doc in enumerate(documents):
+                        skip = (
+                            not force
+                            and type(doc) == dict
+                            and new_key in doc.get("_source", {})
+                        )
+                        doc = self.run(
+                            doc, field, new_key, False, force, *args, **kwargs
+                        )
+                        if (
+                            not skip
+                            and type(doc) == dict
+                            and "_id" in doc
+                            and new_key in doc.get("_source", {})
+                        ):
+                            writer.update(
+                                doc,
+                                fields=self._output_keys(field, new_key),
+                                force=force,
+                            )
+                        if resumable and not (num + 1) % writer.batch_size:
+                            # only move the resume token past written results
+                            writer.flush()
+                            self.resume_token = documents.token_after(doc)
+                if resumable:
+                    self.resume_token = documents.resume_token
 
         elif action == "delay":
             for doc in documents:
                 for placeholder in self.delay(doc, *args, **kwargs):
                     yield placeholder
         elif action == "batch":
-            for num, batch in enumerate(_batcher(documents, batchsize=bulksize)):
-                core.database.bulk_upsert().run(
-                    documents=[
-                        target_func.run(
-                            document=doc, field=field, force=force, *args, **kwargs
-                        )
-                        for doc in batch
-                    ]
+            if not new_key:
+                new_key = "%s_%s" % (field, self.__name__)
+            progress = _Progress(log_interval)
+
+            def process_page(page):
+                return self._process_documents(
+                    page, field, new_key, force, *args, **kwargs
                 )
-                now = datetime.datetime.now()
-                logger.info("processed batch {num} {now}".format(**locals()))
-                yield batch
+
+            pages = _bounded_map(
+                process_page,
+                _batcher(documents, batchsize=batch_size),
+                ThreadPoolExecutor(max_workers=concurrency or 1),
+                concurrency or 1,
+            )
+            writer = BulkWriter(batch_size=batch_size) if save else None
+            try:
+                for _, (page, updated) in pages:
+                    progress.update(len(page))
+                    if not save:
+                        for doc in page:
+                            yield doc
+                        continue
+                    for doc in updated:
+                        if "_id" in doc:
+                            writer.update(
+                                doc,
+                                fields=self._output_keys(field, new_key),
+                                force=force,
+                            )
+                    if resumable:
+                        # only move the resume token past written results
+                        writer.flush()
+                        self.resume_token = documents.token_after(page[-1])
+            finally:
+                if writer is not None:
+                    writer.flush()
+                    writer.report()
+                progress.done()
+
+        elif action == "parallel":
+            if not new_key:
+                new_key = "%s_%s" % (field, self.__name__)
+            workers = concurrency or os.cpu_count() or 1
+            progress = _Progress(log_interval)
+            pages = _bounded_map(
+                functools.partial(
+                    _process_in_worker,
+                    field=field,
+                    new_key=new_key,
+                    force=force,
+                    args=args,
+                    kwargs=kwargs,
+                ),
+                (
+                    [doc if type(doc) == dict else get_document(doc) for doc in page]
+                    for page in _prefetch(
+                        _batcher(documents, batchsize=batch_size), 2 * workers
+                    )
+                ),
+                ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=_init_worker,
+                    initargs=self._worker_spec(),
+                ),
+                2 * workers,
+                ordered=ordered or resumable,
+            )
+            writer = BulkWriter(batch_size=batch_size) if save else None
+            try:
+                for page, results in pages:
+                    progress.update(len(page))
+                    for position, values in results:
+                        page[position].get("_source", page[position]).update(values)
+                    if not save:
+                        for doc in page:
+                            yield doc
+                        continue
+                    for position, _ in results:
+                        if "_id" in page[position]:
+                            writer.update(
+                                page[position],
+                                fields=self._output_keys(field, new_key),
+                                force=force,
+                            )
+                    if resumable:
+                        writer.flush()
+                        self.resume_token = documents.token_after(page[-1])
+            finally:
+                if writer is not None:
+                    writer.flush()
+                    writer.report()
+                progress.done()
 
         elif action == "celery_batch":
-            for batch in _batcher(documents, batchsize=bulksize):
+            if not new_key:
+                new_key = "%s_%s" % (field, self.__name__)
+            progress = _Progress(log_interval)
+            outstanding = deque()
+            for batch in _batcher(documents, batchsize=batch_size):
                 if not batch:
                     continue  # ignore empty batches
-                batch_tasks = [
-                    target_func.s(
-                        document=doc, field=field, force=force, *args, **kwargs
-                    )
-                    for doc in batch
-                ]
-                batch_chord = chord(batch_tasks)
-                batch_result = batch_chord(
-                    taskmaster.tasks["core.database.bulk_upsert"].s()
+                while len(outstanding) >= (concurrency or 4):
+                    size, result = outstanding.popleft()
+                    result.get()
+                    progress.update(size)
+                result = processor_batch().apply_async(
+                    args=(self.name, batch, field, new_key, force) + args,
+                    kwargs=kwargs,
                 )
-                yield batch
+                outstanding.append((len(batch), result))
+                yield result
+            for size, result in outstanding:
+                result.get()
+                progress.update(size)
+            progress.done()
 
     def run(
         self, document, field, new_key=None, save=False, force=False, *args, **kwargs
@@ -167,18 +493,9 @@ class Processer(Document):
                 document = document["_source"]
             return document
         # 4. process document
-        # if extra_fields were supplied, then replace the list of field names with a dict containing their values
-        if "extra_fields" in kwargs:
-            extra_fields = OrderedDict()
-            for fieldname in kwargs.pop("extra_fields"):
-                extra_fields[fieldname] = document["_source"].get(fieldname)
-            document["_source"][new_key] = self.process(
-                document["_source"][field], *args, extra_fields=extra_fields, **kwargs
-            )
-        else:
-            document["_source"][new_key] = self.process(
-                document["_source"][field], *args, **kwargs
-            )
+        self._ensure_setup()
+        # if extra_fields were supplied, they are passed as a dict containing their values
+        self._apply([document["_source"]], field, new_key, *args, **kwargs)
         # 3. add metadata
         # document['_source'] = self._add_metadata(document['_source'])
         # 4. check metadata
@@ -194,7 +511,168 @@ class Processer(Document):
         return document
 
 
-def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=None):
+class Pipeline(Processer):
+    """Chains processors, running all of them on a document in one pass
+
+    The field is read once, each step processes the result of the previous
+    one in memory and only the result of the last step (and, optionally,
+    those of selected intermediate steps) is written, once. The steps and
+    their arguments are recorded in `META.<new_key>`.
+
+    ```
+    pipeline = Pipeline([
+        lower_punct,
+        (remove_stopwords, {"stopwords": "dutch"}),
+        (stemming, {"language": "dutch"}),
+    ])
+    pipeline.runwrap("nu", "text", save=True, action="batch")
+    ```
+
+    stores `text_lower_punct_remove_stopwords_stemming`, the same key as
+    running the three processors one after the other.
+
+    Parameters
+    ----
+    steps : list
+        Processors (classes or instances), or (processor, kwargs) tuples to
+        pass keyword arguments to the `process` method of a step
+    keep : bool or list (default=False)
+        Also save the results of intermediate steps, under the key they would
+        get if the processors ran one after the other. Either True for all
+        steps, or a list of the names or positions of the steps to keep.
+    """
+
+    version = "0.1"
+
+    def __init__(self, steps=None, keep=False, test=True, async_=True):
+        super().__init__(test, async_)
+        self.steps = []
+        for step in steps or []:
+            processor, kwargs = step if isinstance(step, tuple) else (step, {})
+            if isinstance(processor, type):
+                processor = processor()
+            self.steps.append((processor, dict(kwargs)))
+        self.keep = keep
+        self.__name__ = "_".join(self._step_names()) or "pipeline"
+
+    def _step_names(self):
+        return [type(processor).__name__ for processor, _ in self.steps]
+
+    def _kept_keys(self, field):
+        """The keys of the kept intermediate results, by step position"""
+        names = self._step_names()
+        kept = {}
+        for position, name in enumerate(names[:-1]):
+            if self.keep is True or (
+                self.keep and (position in self.keep or name in self.keep)
+            ):
+                kept[position] = "_".join([field] + names[: position + 1])
+        return kept
+
+    def setup(self):
+        for processor, _ in self.steps:
+            processor._ensure_setup()
+
+    def process(self, document_field, *args, **kwargs):
+        """Returns the result of all steps on `document_field`"""
+        return self.process_batch([document_field])[0]
+
+    def process_batch(self, document_fields, *args, **kwargs):
+        return self._chain(document_fields)[-1]
+
+    def _chain(self, document_fields):
+        """Returns the results of each step on a list of fields"""
+        self._ensure_setup()
+        results = []
+        values = list(document_fields)
+        for processor, kwargs in self.steps:
+            values = processor.process_batch(values, **kwargs)
+            results.append(values)
+        return results or [values]
+
+    def _apply(self, sources, field, new_key, *args, **kwargs):
+        if kwargs.pop("extra_fields", None):
+            logger.warning("Pipelines do not pass extra_fields to their steps")
+        results = self._chain([source[field] for source in sources])
+        meta = self._metadata(field)
+        kept = self._kept_keys(field)
+        for position, source in enumerate(sources):
+            for step, key in kept.items():
+                source[key] = results[step][position]
+            source[new_key] = results[-1][position]
+            source.setdefault("META", {})[new_key] = meta
+
+    def _output_keys(self, field, new_key):
+        return list(self._kept_keys(field).values()) + [new_key, "META"]
+
+    def _metadata(self, field):
+        return dict(
+            ADDED_AT=datetime.datetime.now(),
+            ADDED_USING=str(self.__class__).split("'")[1],
+            FUNCTION_VERSION=self.version,
+            FUNCTION_TYPE=self.functiontype,
+            SOURCE_FIELD=field,
+            KEPT=list(self._kept_keys(field).values()),
+            # arguments are stored as JSON, as steps may take arguments of
+            # different types under the same name
+            PIPELINE=[
+                dict(
+                    PROCESSOR=str(processor.__class__).split("'")[1],
+                    FUNCTION_VERSION=processor.version,
+                    FUNCTION_ARGUMENTS=json.dumps(kwargs, default=str, sort_keys=True),
+                )
+                for processor, kwargs in self.steps
+            ],
+        )
+
+    def _worker_spec(self):
+        return (
+            Pipeline,
+            {
+                "steps": [
+                    (type(processor), kwargs) for processor, kwargs in self.steps
+                ],
+                "keep": self.keep,
+            },
+        )
+
+    def runwrap(
+        self,
+        docs_or_query,
+        field,
+        new_key=None,
+        save=False,
+        force=False,
+        action="run",
+        *args,
+        **kwargs
+    ):
+        """See `Processer.runwrap`. Pipelines are not registered with celery
+        workers, so the 'delay' and 'celery_batch' actions process in
+        batches locally instead.
+        """
+        if action in ("delay", "celery_batch"):
+            logger.warning(
+                "Pipelines run locally, using the 'batch' action instead of '{action}'".format(
+                    **locals()
+                )
+            )
+            action = "batch"
+        return super().runwrap(
+            docs_or_query, field, new_key, save, force, action, *args, **kwargs
+        )
+
+
+def _doctype_query_or_list(
+    doctype_query_or_list,
+    force=False,
+    field=None,
+    task=None,
+    seq_no_primary_term=False,
+    source_includes=None,
+    resumable=False,
+    resume_token=None,
+):
     """
     This function helps other functions dynamically interpret the argument for document selection.
     It allows for either a list of documents, an elasticsearch query, a string-query or a doctype
@@ -215,19 +693,42 @@ def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=
     task: string (default=None)
         Function for which the documents are used. Argument is used only to generate the expected outcome
         fieldname, i.e. <field>_<function>
+    seq_no_primary_term: bool (default=False)
+        Whether retrieved documents should include their sequence number, to
+        detect concurrent changes when saving
+    source_includes: list (default=None)
+        If specified, only these fields of the documents are retrieved
+    resumable: bool (default=False)
+        Whether to retrieve documents of a query or doctype with a resumable
+        core.database.SearchAfterCursor instead of a scroll
+    resume_token: string (default=None)
+        The resume token of an interrupted cursor to continue from
 
     Returns
     -------
     Iterable
     """
 
+    scroll_options = dict(
+        seq_no_primary_term=seq_no_primary_term, source_includes=source_includes
+    )
+
+    def retrieve(query):
+        if resumable or resume_token:
+            # an interrupted run can resume within the hour the point-in-time
+            # (if any) is kept
+            return core.database.SearchAfterCursor(
+                query, resume_token=resume_token, keep_alive="1h", **scroll_options
+            )
+        return core.database.scroll_query(query, **scroll_options)
+
     if type(doctype_query_or_list) == list:
         documents = doctype_query_or_list
     elif type(doctype_query_or_list) == str:
-        if doctype_query_or_list in core.search_utils.list_doctypes():
+        if core.search_utils.is_doctype(doctype_query_or_list):
             logger.info("assuming documents of given type should be processed")
             if force or not field:
-                documents = core.database.scroll_query(
+                documents = retrieve(
                     {"query": {"term": {"doctype": "%s" % doctype_query_or_list}}}
                 )
             elif not force and field:
@@ -250,12 +751,12 @@ def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=
                     }
                 }
                 logger.debug(q)
-                documents = core.database.scroll_query(q)
+                documents = retrieve(q)
 
         else:
             logger.info("assuming input is a query_string")
             if force or not field:
-                documents = core.database.scroll_query(
+                documents = retrieve(
                     {"query": {"query_string": {"query": doctype_query_or_list}}}
                 )
             elif not force and field:
@@ -266,7 +767,7 @@ def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=
                 #    {'missing':{'field':'%s_%s' %(field, task)}},
                 #    {'query_string':{'query':doctype_query_or_list}}
                 # ]}})
-                documents = core.database.scroll_query(
+                documents = retrieve(
                     {
                         "query": {
                             "query_string": {
@@ -282,10 +783,158 @@ def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=
         if not force and field and task and not doctype_query_or_list:
             field = "%s_%s" % (field, task)
             doctype_query_or_list.update({"query": {"missing": {"field": field}}})
-        documents = core.database.scroll_query(doctype_query_or_list)
+        documents = retrieve(doctype_query_or_list)
     return documents
 
 
+class processor_batch(Task):
+    """Processes a batch of documents on a celery worker and saves the results,
+    see the 'celery_batch' action of `Processer.runwrap`
+    """
+
+    def run(self, processor, documents, field, new_key, force=False, *args, **kwargs):
+        return self.app.tasks[processor].run_batch(
+            documents, field, new_key, True, force, *args, **kwargs
+        )
+
+
+class _Progress(object):
+    """Logs the number of processed documents and the throughput"""
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.processed = 0
+        self.started = self.logged = time.time()
+
+    def update(self, processed):
+        self.processed += processed
+        if self.interval and time.time() - self.logged >= self.interval:
+            self.logged = time.time()
+            self._log()
+
+    def done(self):
+        self._log()
+
+    def _log(self):
+        seconds = max(time.time() - self.started, 1e-6)
+        logger.info(
+            "Processed {n} documents in {seconds:.0f}s ({rate:.1f} documents/s)".format(
+                n=self.processed, seconds=seconds, rate=self.processed / seconds
+            )
+        )
+
+
+def _bounded_map(function, iterable, executor, max_pending, ordered=True):
+    """Yields `(item, function(item))` for the items of `iterable`, computed
+    by `executor` with at most `max_pending` items submitted at a time
+
+    Results are yielded in the order of the items if `ordered`, otherwise
+    as soon as they are computed.
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= max_pending:
+                if not ordered:
+                    wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                    done = next(entry for entry in pending if entry[1].done())
+                    pending.remove(done)
+                else:
+                    done = pending.popleft()
+                yield done[0], done[1].result()
+            pending.append((item, executor.submit(function, item)))
+        while pending:
+            if not ordered:
+                wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                done = next(entry for entry in pending if entry[1].done())
+                pending.remove(done)
+            else:
+                done = pending.popleft()
+            yield done[0], done[1].result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+_PREFETCH_DONE = object()  # marks the end of the items in _prefetch
+
+
+def _prefetch(iterable, size):
+    """Iterates over `iterable` on a separate thread, keeping up to `size`
+    items ready
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            for item in iterable:
+                put(item)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            put(e)
+        put(_PREFETCH_DONE)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _PREFETCH_DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+# the processor of a worker process of the 'parallel' action
+_worker = {}
+
+
+def _init_worker(processor_class, processor_kwargs):
+    """Creates and sets up the processor of a worker process"""
+    processor = processor_class(**processor_kwargs)
+    processor._ensure_setup()
+    _worker["processor"] = processor
+
+
+def _process_in_worker(page, field, new_key, force, args, kwargs):
+    """Processes a page of documents in a worker process
+
+    Returns
+    ----
+    list
+        (position, {key: value}) of the documents that got a new value for
+        `new_key`, with the values of the keys that are saved
+    """
+    processor = _worker["processor"]
+    documents, updated = processor._process_documents(
+        page, field, new_key, force, *args, **kwargs
+    )
+    updated = set(id(document) for document in updated)
+    keys = processor._output_keys(field, new_key)
+    results = []
+    for position, document in enumerate(documents):
+        if id(document) in updated:
+            source = document.get("_source", document)
+            results.append(
+                (position, {key: source[key] for key in keys if key in source})
+            )
+    return results
+
+
 def _batcher(stuff, batchsize=10):
     batch = []
     for num, thing in enumerate(stuff):
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from inca.core import database, processor_class
+from inca.core.processor_class import Processer, _bounded_map
+
+
+class FakeCursor(database.SearchAfterCursor):
+    """A cursor over a list of documents, with the `_id` as token"""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def token_after(self, document):
+        return document["_id"]
+
+    @property
+    def resume_token(self):
+        return "done"
+
+
+class RecordingWriter(object):
+    """Records the ids of flushed updates"""
+
+    written_ids = []
+
+    def __init__(self, batch_size=2, **kwargs):
+        self.batch_size = batch_size
+        self._buffer = []
+
+    def update(self, document, fields=None, force=False):
+        self._buffer.append(document["_id"])
+
+    def flush(self):
+        RecordingWriter.written_ids.extend(self._buffer)
+        self._buffer = []
+
+    def report(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class crash_on_3(Processer):
+    __name__ = "crash_on_3"
+
+    def process(self, document_field):
+        if document_field == "3":
+            raise RuntimeError("interrupted")
+        return document_field.upper()
+
+
+def test_resume_token_only_passes_written_documents(monkeypatch):
+    documents = [{"_id": str(n), "_source": {"text": str(n)}} for n in range(6)]
+    monkeypatch.setattr(
+        processor_class, "_doctype_query_or_list", lambda *a, **k: FakeCursor(documents)
+    )
+    monkeypatch.setattr(processor_class, "BulkWriter", RecordingWriter)
+    RecordingWriter.written_ids = []
+    processor = crash_on_3()
+    with pytest.raises(RuntimeError):
+        list(processor.runwrap("a query", "text", save=True, resumable=True))
+    written = RecordingWriter.written_ids
+    assert processor.resume_token in written
+    # every document up to the resume token is written
+    assert written == [str(n) for n in range(int(processor.resume_token) + 1)]
+
+
+def test_bounded_map_limits_pending_items():
+    consumed = []
+
+    def numbers():
+        for number in range(10):
+            consumed.append(number)
+            yield number
+
+    results = _bounded_map(
+        lambda n: n * n, numbers(), ThreadPoolExecutor(2), max_pending=3
+    )
+    assert next(results) == (0, 0)
+    assert len(consumed) == 4
+    assert list(results) == [(n, n * n) for n in range(1, 10)]
+    unordered = _bounded_map(
+        lambda n: n * n, range(10), ThreadPoolExecutor(2), max_pending=3, ordered=False
+    )
+    assert sorted(unordered) == [(n, n * n) for n in range(10)]
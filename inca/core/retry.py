@@ -0,0 +1,277 @@
+"""
+Retry policies for requests to elasticsearch.
+
+Requests that fail with a transient error (a timeout, a dropped connection or
+a request rejected by an overloaded cluster) are retried with exponential
+backoff and jitter, until either a maximum number of attempts or a maximum
+elapsed time is reached. All policies share a circuit breaker: after a number
+of consecutive failures it opens and requests fail fast with a
+`CircuitOpenError` instead of adding to the load of an unhealthy cluster.
+After `reset_timeout` seconds requests are let through again, and the first
+success closes the circuit.
+
+The number of calls, retries and failures is kept in `counters`, use
+`retry_stats()` to monitor them.
+"""
+
+import asyncio
+import functools
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+from elasticsearch.exceptions import ConnectionError, TransportError
+
+logger = logging.getLogger("INCA")
+
+# HTTP status codes of requests that may succeed when tried again
+RETRY_STATUSES = (429, 502, 503, 504)
+
+counters = Counter()
+_counters_lock = threading.Lock()
+
+
+def _count(name):
+    with _counters_lock:
+        counters[name] += 1
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a request while the circuit is open"""
+
+    pass
+
+
+def is_transient(exception):
+    """Whether a request that raised `exception` is worth retrying"""
+    if isinstance(exception, CircuitOpenError):
+        return False
+    if isinstance(exception, ConnectionError):
+        return True
+    return (
+        isinstance(exception, TransportError)
+        and exception.status_code in RETRY_STATUSES
+    )
+
+
+class CircuitBreaker(object):
+    """Stops requests after too many consecutive transient failures
+
+    Parameters
+    ----
+    failure_threshold : int (default=5)
+        The number of consecutive failures after which the circuit opens
+    reset_timeout : int or float (default=30)
+        The number of seconds after which requests are tried again
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("Elasticsearch is responding again, closing circuit")
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold or self.state == "open":
+                return
+            self.opened_at = time.time()
+        _count("circuit_opened")
+        logger.warning(
+            "{n} consecutive requests to elasticsearch failed, not sending requests for {s}s".format(
+                n=self.failures, s=self.reset_timeout
+            )
+        )
+
+
+class RetryPolicy(object):
+    """Retries a function that sends requests to elasticsearch
+
+    Can be used either by passing the function to `call` or as a decorator.
+    Coroutine functions are retried with `acall`.
+
+    Parameters
+    ----
+    max_attempts : int (default=5)
+        The maximum number of times the function is called
+    base_delay : int or float (default=0.5)
+        The maximum number of seconds to wait before the first retry, doubled
+        for every next retry. The actual delay is drawn at random between 0
+        and this maximum, so that clients do not retry in lockstep.
+    max_delay : int or float (default=30)
+        The upper limit on the delay between two attempts
+    max_elapsed : int or float (default=120)
+        Do not retry if the next attempt would start more than this many
+        seconds after the first one
+    breaker : CircuitBreaker (default=None)
+        The circuit breaker to consult and update, defaults to the one shared
+        by all policies
+    """
+
+    def __init__(
+        self,
+        max_attempts=5,
+        base_delay=0.5,
+        max_delay=30,
+        max_elapsed=120,
+        breaker=None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.breaker = breaker or circuit_breaker
+
+    def replace(self, **options):
+        """Returns a copy of this policy with some of its options changed"""
+        settings = dict(
+            max_attempts=self.max_attempts,
+            base_delay=self.base_delay,
+            max_delay=self.max_delay,
+            max_elapsed=self.max_elapsed,
+            breaker=self.breaker,
+        )
+        settings.update(options)
+        return RetryPolicy(**settings)
+
+    def delay(self, attempt):
+        """The number of seconds to wait after the `attempt`-th failure"""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+
+    def _start_attempt(self):
+        """Counts an attempt, unless the circuit is open"""
+        if not self.breaker.allow():
+            _count("rejected")
+            raise CircuitOpenError(
+                "N/A", "elasticsearch is unavailable, request not sent", None
+            )
+        _count("calls")
+
+    def _retry_delay(self, exception, attempt, start):
+        """The number of seconds to wait before retrying after the `attempt`-th
+        attempt raised `exception`, or None if it should not be retried
+        """
+        if not is_transient(exception):
+            if isinstance(exception, TransportError):
+                # elasticsearch responded, it just did not like the request
+                self.breaker.success()
+            return None
+        _count("failures")
+        self.breaker.failure()
+        delay = self.delay(attempt)
+        if (
+            attempt >= self.max_attempts
+            or time.time() - start + delay > self.max_elapsed
+        ):
+            _count("gave_up")
+            return None
+        _count("retries")
+        logger.warning(
+            "Request to elasticsearch failed ({exception}), retrying in {delay:.1f}s".format(
+                **locals()
+            )
+        )
+        return delay
+
+    def call(self, function, *args, **kwargs):
+        """Call `function` with the given arguments, retrying on transient errors
+
+        Raises
+        ----
+        CircuitOpenError
+            If the circuit is open
+        Exception
+            Whatever `function` raised last, if it was not transient or the
+            attempts or time ran out
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            self._start_attempt()
+            attempt += 1
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, start)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+
+    async def acall(self, function, *args, **kwargs):
+        """Await coroutine `function` with the given arguments, retrying on
+        transient errors, see `call`
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            self._start_attempt()
+            attempt += 1
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, start)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+
+        return wrapper
+
+
+circuit_breaker = CircuitBreaker()
+default_policy = RetryPolicy()
+
+
+def retry_call(function, *args, **kwargs):
+    """Call `function` with the given arguments under the default policy"""
+    return default_policy.call(function, *args, **kwargs)
+
+
+def retry_stats():
+    """Returns the retry counters and the state of the circuit breaker
+
+    Returns
+    ----
+    dict
+        Counts of `calls`, `retries`, `failures`, requests that `gave_up`,
+        requests `rejected` by the open circuit and times the circuit opened,
+        plus the current `circuit` state
+    """
+    with _counters_lock:
+        stats = dict(counters)
+    stats["circuit"] = circuit_breaker.state
+    return stats
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from elasticsearch.exceptions import ConnectionError, TransportError
+
+from inca.core import retry
+from inca.core.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class Flaky(object):
+    """Raises the given exceptions, one per call, then returns "ok" """
+
+    def __init__(self, *exceptions):
+        self.exceptions = list(exceptions)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(retry.time, "sleep", lambda seconds: None)
+
+
+def test_delay_grows_exponentially_up_to_max_delay(monkeypatch):
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+    policy = RetryPolicy(base_delay=0.5, max_delay=3)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [0.5, 1, 2, 3, 3]
+
+
+def test_transient_errors_are_retried(no_sleep):
+    policy = RetryPolicy(max_attempts=3, breaker=CircuitBreaker())
+    flaky = Flaky(
+        ConnectionError("N/A", "down", None),
+        TransportError(429, "es_rejected_execution_exception", {}),
+    )
+    assert policy.call(flaky) == "ok"
+    assert flaky.calls == 3
+
+
+def test_attempts_run_out(no_sleep):
+    policy = RetryPolicy(max_attempts=2, breaker=CircuitBreaker())
+    flaky = Flaky(*[ConnectionError("N/A", "down", None)] * 3)
+    with pytest.raises(ConnectionError):
+        policy.call(flaky)
+    assert flaky.calls == 2
+
+
+def test_other_errors_are_not_retried(no_sleep):
+    breaker = CircuitBreaker(failure_threshold=1)
+    flaky = Flaky(TransportError(400, "parsing_exception", {}))
+    with pytest.raises(TransportError):
+        RetryPolicy(breaker=breaker).call(flaky)
+    assert flaky.calls == 1
+    assert breaker.state == "closed"
+
+
+def test_circuit_opens_and_recovers(no_sleep, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry.time, "time", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    policy = RetryPolicy(max_attempts=2, breaker=breaker)
+    with pytest.raises(ConnectionError):
+        policy.call(Flaky(*[ConnectionError("N/A", "down", None)] * 2))
+    assert breaker.state == "open"
+    flaky = Flaky()
+    with pytest.raises(CircuitOpenError):
+        policy.call(flaky)
+    assert flaky.calls == 0
+    now[0] += 30
+    assert breaker.state == "half-open"
+    assert policy.call(flaky) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_coroutines_are_retried(monkeypatch):
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(retry.asyncio, "sleep", no_sleep)
+    flaky = Flaky(TransportError(503, "unavailable_shards_exception", {}))
+
+    async def request():
+        return flaky()
+
+    policy = RetryPolicy(breaker=CircuitBreaker())
+    assert asyncio.run(policy.acall(request)) == "ok"
+    assert flaky.calls == 2
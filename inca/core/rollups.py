@@ -0,0 +1,279 @@
+"""
+This file provides stored daily rollups of query counts.
+
+Counting the documents that match a query per day over years of documents
+is expensive, while most of those counts never change. A rollup stores the
+number of matching documents per day and doctype in a local SQLite database.
+Each update only counts the documents that were added (according to
+`META.ADDED`) since the previous update, so that long timelines can be read
+from the store instead of being recomputed by elasticsearch.
+
+Documents that are deleted or changed after they were counted are not
+reflected in a rollup until it is rebuilt.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import pandas
+
+from .database import client, index_for_query, config
+from .retry import retry_call
+
+logger = logging.getLogger("INCA")
+
+ROLLUP_PATH = os.path.expanduser(
+    config.get("elasticsearch", "rollup_path", fallback="~/.inca/rollups.sqlite")
+)
+
+# documents added less than this many seconds ago are left for the next
+# update, as they may not be searchable yet
+ROLLUP_LAG = 600
+
+# the number of (day, doctype) buckets retrieved per request
+ROLLUP_PAGE_SIZE = 1000
+
+# pandas resampling rules matching the elasticsearch intervals that can be
+# computed from daily counts
+GRANULARITIES = {
+    "day": "D",
+    "1d": "D",
+    "week": "W-MON",
+    "1w": "W-MON",
+    "month": "MS",
+    "1M": "MS",
+    "quarter": "QS",
+    "1q": "QS",
+    "year": "YS",
+    "1y": "YS",
+}
+
+
+class RollupStore(object):
+    """Daily counts of documents matching queries, updated incrementally
+
+    Parameters
+    ----
+    path : string (default=None)
+        The SQLite file in which rollups are stored, defaults to the
+        `rollup_path` setting or ~/.inca/rollups.sqlite
+    """
+
+    def __init__(self, path=None):
+        self.path = path or ROLLUP_PATH
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS rollups (
+                key TEXT PRIMARY KEY, query TEXT, timefield TEXT,
+                watermark INTEGER, updated REAL);
+            CREATE TABLE IF NOT EXISTS counts (
+                key TEXT, doctype TEXT, day TEXT, count INTEGER,
+                PRIMARY KEY (key, doctype, day));
+            """)
+
+    @staticmethod
+    def key(query, timefield):
+        """The identifier of the rollup of an elasticsearch query on a timefield"""
+        return json.dumps({"query": query, "timefield": timefield}, sort_keys=True)
+
+    def update(self, query, timefield, rebuild=False):
+        """Count the documents added since the last update of a rollup
+
+        The rollup is created if it does not exist yet. Concurrent updates
+        of the same store wait for each other.
+
+        Parameters
+        ----
+        query : dict
+            The elasticsearch query (the contents of the "query" key)
+        timefield : string
+            The date field by which documents are counted
+        rebuild : bool (default=False)
+            Discard the stored counts and count all documents again
+
+        Returns
+        ----
+        string
+            The key of the rollup
+        """
+        key = self.key(query, timefield)
+        watermark = int((time.time() - ROLLUP_LAG) * 1000)
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            if rebuild:
+                self.connection.execute("DELETE FROM rollups WHERE key = ?", (key,))
+                self.connection.execute("DELETE FROM counts WHERE key = ?", (key,))
+            row = self.connection.execute(
+                "SELECT watermark FROM rollups WHERE key = ?", (key,)
+            ).fetchone()
+            added = {"lte": watermark, "format": "epoch_millis"}
+            if row:
+                added["gt"] = row[0]
+            new_documents = {
+                "bool": {
+                    "must": [query],
+                    "filter": [{"range": {"META.ADDED": added}}],
+                }
+            }
+            if not row:
+                # the first update also counts documents without META.ADDED
+                new_documents["bool"]["filter"] = [
+                    {
+                        "bool": {
+                            "should": [
+                                {"range": {"META.ADDED": added}},
+                                {
+                                    "bool": {
+                                        "must_not": {"exists": {"field": "META.ADDED"}}
+                                    }
+                                },
+                            ]
+                        }
+                    }
+                ]
+            counted = 0
+            for day, doctype, count in self._daily_counts(new_documents, timefield):
+                self.connection.execute(
+                    """INSERT INTO counts VALUES (?, ?, ?, ?)
+                    ON CONFLICT (key, doctype, day)
+                    DO UPDATE SET count = count + excluded.count""",
+                    (key, doctype, day, count),
+                )
+                counted += count
+            self.connection.execute(
+                "INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(query), timefield, watermark, time.time()),
+            )
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        logger.debug("Added {counted} documents to rollup {key}".format(**locals()))
+        return key
+
+    def _daily_counts(self, query, timefield):
+        """Yields (day, doctype, count) for the documents matching `query`"""
+        composite = {
+            "size": ROLLUP_PAGE_SIZE,
+            "sources": [
+                {
+                    "day": {
+                        "date_histogram": {
+                            "field": timefield,
+                            "interval": "1d",
+                            "format": "yyyy-MM-dd",
+                        }
+                    }
+                },
+                {"doctype": {"terms": {"field": "doctype", "missing_bucket": True}}},
+            ],
+        }
+        while True:
+            response = retry_call(
+                client.search,
+                index=index_for_query(query),
+                body={
+                    "size": 0,
+                    "query": query,
+                    "aggs": {"days": {"composite": composite}},
+                },
+            )
+            buckets = response["aggregations"]["days"]["buckets"]
+            for bucket in buckets:
+                day, doctype = bucket["key"]["day"], bucket["key"]["doctype"]
+                yield day, doctype or "", bucket["doc_count"]
+            after = response["aggregations"]["days"].get("after_key")
+            if not buckets or not after:
+                break
+            composite["after"] = after
+
+    def daily(self, key, doctype=None):
+        """Returns the stored daily counts of a rollup as a pandas Series
+
+        Parameters
+        ----
+        key : string
+            The key of the rollup, as returned by `update`
+        doctype : string (default=None)
+            Only count documents of this doctype
+        """
+        sql = "SELECT day, SUM(count) FROM counts WHERE key = ?"
+        arguments = [key]
+        if doctype:
+            sql += " AND doctype = ?"
+            arguments.append(doctype)
+        rows = self.connection.execute(sql + " GROUP BY day", arguments).fetchall()
+        series = pandas.Series(
+            [count for day, count in rows],
+            index=pandas.to_datetime([day for day, count in rows]),
+            dtype=float,
+        )
+        return series.sort_index()
+
+    def timeline(
+        self,
+        query,
+        timefield,
+        granularity="day",
+        from_time=None,
+        to_time=None,
+        update=True,
+    ):
+        """Returns the counts of a query per `granularity` from its rollup
+
+        Parameters
+        ----
+        query : dict
+            The elasticsearch query (the contents of the "query" key)
+        timefield : string
+            The date field by which documents are counted
+        granularity : string (default='day')
+            One of day, week, month, quarter or year
+        from_time, to_time : string (default=None)
+            Only count documents from/to this date
+        update : bool (default=True)
+            Count new documents before reading the rollup
+
+        Returns
+        ----
+        pandas.Series
+            The counts, indexed by the start of each period formatted like
+            the `key_as_string` of elasticsearch date histograms
+        """
+        if update:
+            key = self.update(query, timefield)
+        else:
+            key = self.key(query, timefield)
+        daily = self.daily(key)
+        if from_time:
+            daily = daily[daily.index >= pandas.Timestamp(from_time)]
+        if to_time:
+            daily = daily[daily.index <= pandas.Timestamp(to_time)]
+        daily = daily[daily > 0]
+        if daily.empty:
+            return pandas.Series(dtype=float)
+        counts = daily.resample(
+            GRANULARITIES[granularity], label="left", closed="left"
+        ).sum()
+        counts.index = counts.index.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        return counts
+
+
+def supports(granularity, from_time=None, to_time=None):
+    """Whether a timeline can be computed from daily rollups"""
+    if granularity not in GRANULARITIES:
+        return False
+    try:
+        for moment in (from_time, to_time):
+            if moment:
+                pandas.Timestamp(moment)
+    except ValueError:
+        # e.g. elasticsearch date math such as 'now-1y'
+        return False
+    return True
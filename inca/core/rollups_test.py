@@ -0,0 +1,132 @@
+import pytest
+
+from inca.core import rollups
+
+
+class RollupClient(object):
+    """Counts documents per day and doctype like a composite aggregation,
+    with the given page size"""
+
+    def __init__(self, documents, page_size=2):
+        self.documents = documents
+        self.page_size = page_size
+        self.ranges = []
+
+    def _added(self, query):
+        filter = query["bool"]["filter"][0]
+        if "range" in filter:
+            return filter["range"]["META.ADDED"], False
+        should = filter["bool"]["should"]
+        return should[0]["range"]["META.ADDED"], True
+
+    def search(self, index=None, body=None):
+        added, include_missing = self._added(body["query"])
+        self.ranges.append(added)
+        counts = {}
+        for day, doctype, timestamp in self.documents:
+            if timestamp is None:
+                if not include_missing:
+                    continue
+            elif timestamp > added["lte"] or timestamp <= added.get("gt", -1):
+                continue
+            counts[(day, doctype)] = counts.get((day, doctype), 0) + 1
+        keys = sorted(counts)
+        composite = body["aggs"]["days"]["composite"]
+        if "after" in composite:
+            after = (composite["after"]["day"], composite["after"]["doctype"])
+            keys = [key for key in keys if key > after]
+        page = keys[: self.page_size]
+        result = {
+            "buckets": [
+                {
+                    "key": {"day": day, "doctype": doctype},
+                    "doc_count": counts[day, doctype],
+                }
+                for day, doctype in page
+            ]
+        }
+        if page:
+            result["after_key"] = {"day": page[-1][0], "doctype": page[-1][1]}
+        return {"aggregations": {"days": result}}
+
+
+QUERY = {"match": {"text": "keulen"}}
+
+
+def store(tmp_path, monkeypatch, documents, now=10000.0):
+    client = RollupClient(documents)
+    monkeypatch.setattr(rollups, "client", client)
+    monkeypatch.setattr(rollups, "index_for_query", lambda query: "inca")
+    monkeypatch.setattr(rollups.time, "time", lambda: now)
+    monkeypatch.setattr(rollups, "ROLLUP_LAG", 0)
+    return rollups.RollupStore(str(tmp_path / "rollups.sqlite")), client
+
+
+def test_updates_only_count_new_documents(tmp_path, monkeypatch):
+    documents = [
+        ("2020-01-01", "nu", None),
+        ("2020-01-01", "nu", 1000),
+        ("2020-01-02", "nos", 2000),
+        ("2020-01-03", "nu", 20000 * 1000),
+    ]
+    rollup, client = store(tmp_path, monkeypatch, documents)
+    key = rollup.update(QUERY, "publication_date")
+    assert rollup.daily(key).to_dict() == {
+        rollups.pandas.Timestamp("2020-01-01"): 2,
+        rollups.pandas.Timestamp("2020-01-02"): 1,
+    }
+
+    monkeypatch.setattr(rollups.time, "time", lambda: 30.0 * 1000)
+    documents.append(("2020-01-01", "nu", 25000 * 1000))
+    assert rollup.update(QUERY, "publication_date") == key
+    assert client.ranges[-1]["gt"] == 10000 * 1000
+    assert rollup.daily(key, doctype="nu").to_dict() == {
+        rollups.pandas.Timestamp("2020-01-01"): 3,
+        rollups.pandas.Timestamp("2020-01-03"): 1,
+    }
+    assert rollup.daily(key).sum() == 5
+
+
+def test_rebuild_counts_everything_again(tmp_path, monkeypatch):
+    documents = [("2020-01-01", "nu", 1000), ("2020-01-02", "nu", 2000)]
+    rollup, client = store(tmp_path, monkeypatch, documents)
+    key = rollup.update(QUERY, "publication_date")
+    documents.pop()
+    rollup.update(QUERY, "publication_date")
+    assert rollup.daily(key).sum() == 2
+    rollup.update(QUERY, "publication_date", rebuild=True)
+    assert rollup.daily(key).sum() == 1
+
+
+def test_failed_updates_keep_the_watermark(tmp_path, monkeypatch):
+    rollup, client = store(tmp_path, monkeypatch, [("2020-01-01", "nu", 1000)])
+
+    def fail(**kwargs):
+        raise RuntimeError("unavailable")
+
+    monkeypatch.setattr(client, "search", fail)
+    monkeypatch.setattr(rollups, "retry_call", lambda call, **kwargs: call(**kwargs))
+    with pytest.raises(RuntimeError):
+        rollup.update(QUERY, "publication_date")
+    row = rollup.connection.execute("SELECT COUNT(*) FROM rollups").fetchone()
+    assert row == (0,)
+
+
+def test_timeline(tmp_path, monkeypatch):
+    documents = [
+        ("2020-01-01", "nu", 1000),
+        ("2020-01-31", "nu", 1000),
+        ("2020-03-02", "nos", 1000),
+    ]
+    rollup, client = store(tmp_path, monkeypatch, documents)
+    timeline = rollup.timeline(
+        QUERY, "publication_date", granularity="month", from_time="2020-01-15"
+    )
+    assert timeline.to_dict() == {
+        "2020-01-01T00:00:00.000Z": 1,
+        "2020-02-01T00:00:00.000Z": 0,
+        "2020-03-01T00:00:00.000Z": 1,
+    }
+    assert rollups.supports("month", "2020-01-01")
+    assert not rollups.supports("month", "now-1y")
+    assert not rollups.supports("hour")
@@ -22,7 +22,13 @@ language  : If you can safely assume the language of specified documents, please
 """
 import logging
 from .document_class import Document
-from .database import check_exists, client, elastic_index
+from .database import (
+    check_exists,
+    check_exists_many,
+    client,
+    search_index,
+    BulkWriter,
+)
 
 logger = logging.getLogger("INCA")
 
@@ -74,25 +80,26 @@ class Scraper(Document):
 
         logger.info("Started scraping")
         if save == True:
-            for doc in self.get(save, *args, **kwargs):
-                if (
-                    check_if_url_exists == False
-                    or client.search(
-                        index=elastic_index,
-                        body={"query": {"term": {"url": doc["url"]}}},
-                    )["hits"]["total"]
-                    == 0
-                ):
-                    if type(doc) == dict:
-                        doc = self._add_metadata(doc)
-                        self._save_document(doc)
+            with BulkWriter() as writer:
+                for doc in self.get(save, *args, **kwargs):
+                    if (
+                        check_if_url_exists == False
+                        or client.search(
+                            index=search_index(),
+                            body={"query": {"term": {"url": doc["url"]}}},
+                        )["hits"]["total"]
+                        == 0
+                    ):
+                        if type(doc) == dict:
+                            doc = self._add_metadata(doc)
+                            self._save_document(doc, writer=writer)
+                        else:
+                            doc = self._add_metadata(doc)
+                            self._save_documents(doc, writer=writer)
                     else:
-                        doc = self._add_metadata(doc)
-                        self._save_documents(doc)
-                else:
-                    logger.info(
-                        "A document with this URL already existed - did not save the new one."
-                    )
+                        logger.info(
+                            "A document with this URL already existed - did not save the new one."
+                        )
         else:
             return [self._add_metadata(doc) for doc in self.get(save, *args, **kwargs)]
 
@@ -116,6 +123,9 @@ class Scraper(Document):
     def _check_exists(self, *args, **kwargs):
         return check_exists(*args, **kwargs)
 
+    def _check_exists_many(self, *args, **kwargs):
+        return check_exists_many(*args, **kwargs)
+
 
 class UnparsableException(Exception):
     def __init__(self):
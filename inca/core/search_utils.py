@@ -3,10 +3,15 @@ This file provides basic search functionality for the INCA database.
 """
 from .database import client as _client
 from .database import scroll_query as _scroll_query
-from .database import elastic_index as _elastic_index
+from .database import parallel_scroll_query as _parallel_scroll_query
+from .database import SearchAfterCursor as _SearchAfterCursor
+from .database import search_index as _search_index
+from .database import index_for_query as _index_for_query
 from .database import DATABASE_AVAILABLE as _DATABASE_AVAILABLE
 from .database import delete_doctype, delete_document, insert_document, insert_documents
 from .database import deduplicate, reparse
+from .metadata_cache import metadata_cache as _metadata_cache
+from .metadata_cache import profile_cache as _profile_cache
 import logging as _logging
 from .basic_utils import dotkeys as _dotkeys
 import _datetime as _datetime
@@ -16,27 +21,105 @@ from collections import defaultdict
 _logger = _logging.getLogger("INCA")
 
 
-def list_doctypes():
-    if not _DATABASE_AVAILABLE:
-        _logger.warning("Could not list documents: No database instance available")
-        return {"NO DOCUMENTS: DATABASE UNAVAILABLE": 0}
-
-    existing_doctypes = _client.search(
-        _elastic_index,
+def _doctype_metadata():
+    """Retrieves the number of documents and first/last META.ADDED per doctype"""
+    buckets = _client.search(
+        _search_index(),
         body={
             "size": 0,
-            "aggs": {"doctypes": {"terms": {"field": "doctype", "size": 1000}}},
+            "aggs": {
+                "doctypes": {
+                    "terms": {"field": "doctype", "size": 1000},
+                    "aggs": {
+                        "first": {"min": {"field": "META.ADDED"}},
+                        "last": {"max": {"field": "META.ADDED"}},
+                    },
+                }
+            },
         },
     )["aggregations"]["doctypes"]["buckets"]
+    return {
+        item["key"]: {
+            "count": item["doc_count"],
+            "first_added": item["first"].get("value_as_string"),
+            "last_added": item["last"].get("value_as_string"),
+        }
+        for item in buckets
+    }
+
+
+def doctype_metadata(refresh=False):
+    """Returns the number of documents and first/last META.ADDED per doctype
+
+    The result is cached for a minute (see `metadata_ttl` in settings.cfg),
+    or until documents are added or deleted by this process.
+
+    Parameters
+    ----
+    refresh : bool (default=False)
+        Retrieve the metadata even if it is cached
+
+    Returns
+    ----
+    dict
+        doctype -> {'count': int, 'first_added': str, 'last_added': str}
+    """
+    if not _DATABASE_AVAILABLE:
+        _logger.warning("Could not list documents: No database instance available")
+        return {}
+    return _metadata_cache.get("doctypes", _doctype_metadata, refresh=refresh)
+
+
+def list_doctypes(refresh=False):
+    if not _DATABASE_AVAILABLE:
+        _logger.warning("Could not list documents: No database instance available")
+        return {"NO DOCUMENTS: DATABASE UNAVAILABLE": 0}
+
     overview = {}
-    for item in existing_doctypes:
-        overview[item["key"]] = item["doc_count"]
+    for doctype, metadata in doctype_metadata(refresh).items():
+        overview[doctype] = metadata["count"]
     return overview
 
 
-def doctype_generator(doctype):
+def is_doctype(name):
+    """Whether documents of doctype `name` exist, according to the cached metadata"""
+    return name in doctype_metadata()
+
+
+def _scroll(query, slices=None, **kwargs):
+    """Scroll through a query, with `slices` parallel scrolls if specified"""
+    if slices:
+        return _parallel_scroll_query(query, slices=slices, **kwargs)
+    return _scroll_query(query, **kwargs)
+
+
+def doctype_generator(doctype, slices=None, source_includes=None, source_excludes=None):
+    """A generator to get all documents of a doctype
+
+    Parameters
+    ----
+    doctype : string
+        The doctype of the documents to return
+    slices : int (default=None)
+        If specified, the number of slices to scroll through in parallel
+    source_includes : list (default=None)
+        If specified, only these fields are retrieved
+    source_excludes : list (default=None)
+        Fields that are not retrieved, such as 'htmlsource'
+
+    Yields
+    ----
+    dict representing a document
+    """
     query = {"query": {"term": {"doctype": doctype}}}
-    for num, doc in enumerate(_scroll_query(query)):
+    for num, doc in enumerate(
+        _scroll(
+            query,
+            slices,
+            source_includes=source_includes,
+            source_excludes=source_excludes,
+        )
+    ):
         if not _DATABASE_AVAILABLE:
             _logger.warning("Could not get documents: No database instance available")
             break
@@ -45,7 +128,9 @@ def doctype_generator(doctype):
         yield doc
 
 
-def document_generator(query="*"):
+def document_generator(
+    query="*", slices=None, source_includes=None, source_excludes=None
+):
     """A generator to get results for a query
 
     Parameters
@@ -53,6 +138,13 @@ def document_generator(query="*"):
     query : string (default="*") or dict
         A string query specifying the documents to return or a dict
         that is a elasticsearch query
+    slices : int (default=None)
+        If specified, the number of slices to scroll through in parallel
+        (the order of documents is not preserved)
+    source_includes : list (default=None)
+        If specified, only these fields are retrieved
+    source_excludes : list (default=None)
+        Fields that are not retrieved, such as 'htmlsource'
 
     Yields
     ----
@@ -76,10 +168,40 @@ def document_generator(query="*"):
             es_query = False
         if es_query:
             # total = _client.search(_elastic_index, body=es_query, size=0)['hits']['total']
-            for doc in _scroll_query(es_query):
+            for doc in _scroll(
+                es_query,
+                slices,
+                source_includes=source_includes,
+                source_excludes=source_excludes,
+            ):
                 yield doc
 
 
+def document_cursor(query="*", resume_token=None, **kwargs):
+    """A resumable cursor over the results of a query
+
+    Parameters
+    ----
+    query : string (default="*") or dict
+        A string query specifying the documents to return or a dict
+        that is a elasticsearch query
+    resume_token : string (default=None)
+        The `resume_token` of an interrupted cursor over the same query, to
+        continue after the last document it handled
+    **kwargs
+        Further options of `core.database.SearchAfterCursor`, such as
+        `point_in_time` or `source_includes`
+
+    Returns
+    ----
+    SearchAfterCursor
+        An iterable of documents with a `resume_token` property
+    """
+    if type(query) == str:
+        query = {"query": {"bool": {"must": {"query_string": {"query": query}}}}}
+    return _SearchAfterCursor(query, resume_token=resume_token, **kwargs)
+
+
 def doctype_first(doctype, num=1, by_field="META.ADDED", query=None):
     """Returns the first document of a given doctype
 
@@ -112,7 +234,7 @@ def doctype_first(doctype, num=1, by_field="META.ADDED", query=None):
 
     docs = (
         _client.search(
-            index=_elastic_index,
+            index=_search_index(doctype),
             body={
                 "sort": [{by_field: {"order": "asc"}}],
                 "size": num,
@@ -158,7 +280,7 @@ def doctype_last(doctype, num=1, by_field="META.ADDED", query=None):
 
     docs = (
         _client.search(
-            index=_elastic_index,
+            index=_search_index(doctype),
             body={
                 "sort": [{by_field: {"order": "desc"}}],
                 "size": num,
@@ -178,18 +300,21 @@ def doctype_examples(doctype, field=None, seed=42, num=10):
             "Could not get example documents: No database instance available"
         )
         return []
-    docs = _client.search(
-        index=_elastic_index,
-        body={
-            "size": num,
-            "query": {
-                "function_score": {
-                    "query": {"term": {"doctype": doctype}},
-                    "functions": [{"random_score": {"seed": seed}}],
-                }
-            },
+    body = {
+        "size": num,
+        "query": {
+            "function_score": {
+                "query": {"term": {"doctype": doctype}},
+                "functions": [{"random_score": {"seed": seed}}],
+            }
         },
-    )
+    }
+    # only retrieve the requested fields
+    if type(field) == str:
+        body["_source"] = [field.replace("_source.", "", 1)]
+    elif field:
+        body["_source"] = [fi.replace("_source.", "", 1) for fi in field]
+    docs = _client.search(index=_search_index(doctype), body=body)
     if not field:
         return docs["hits"]["hits"]
     elif type(field) == str:
@@ -198,15 +323,136 @@ def doctype_examples(doctype, field=None, seed=42, num=10):
         return [{fi: _dotkeys(doc, fi) for fi in field} for doc in docs["hits"]["hits"]]
 
 
-def doctype_fields(doctype):
+# the number of fields of which the coverage is counted in a single request
+FIELD_BATCH_SIZE = 500
+
+# seconds after which a field profile is recomputed instead of updated
+PROFILE_MAX_AGE = 24 * 60 * 60
+_profile_cache.ttl = PROFILE_MAX_AGE
+
+
+def _doctype_properties(doctype=None):
+    """Returns the mapping of the top-level fields of the indices of a doctype"""
+    properties = {}
+    for mapping in _client.indices.get_mapping(_search_index(doctype)).values():
+        properties.update(
+            mapping.get("mappings", {}).get("doc", {}).get("properties", {})
+        )
+    return properties
+
+
+def _field_counts(query, fields):
+    """Counts the documents matching `query` and, per field, those that have it
+
+    Fields are counted with a `filters` aggregation, FIELD_BATCH_SIZE fields
+    per request. The first request also retrieves the first and last
+    META.ADDED of the documents.
+    """
+    counts = {}
+    profile = {}
+    for start in range(0, max(len(fields), 1), FIELD_BATCH_SIZE):
+        batch = fields[start : start + FIELD_BATCH_SIZE]
+        aggs = {}
+        if batch:
+            aggs["fields"] = {
+                "filters": {
+                    "filters": {field: {"exists": {"field": field}} for field in batch}
+                }
+            }
+        if not start:
+            aggs["first"] = {"min": {"field": "META.ADDED"}}
+            aggs["last"] = {"max": {"field": "META.ADDED"}}
+        response = _client.search(
+            index=_index_for_query(query),
+            body={"size": 0, "query": query, "aggs": aggs},
+        )
+        aggregations = response.get("aggregations", {})
+        if not start:
+            total = response["hits"]["total"]
+            # elasticsearch 7 returns {"value": .., "relation": ..}
+            profile["total"] = total["value"] if type(total) == dict else total
+            profile["first"] = aggregations["first"].get("value")
+            profile["last"] = aggregations["last"].get("value")
+            profile["first_string"] = aggregations["first"].get("value_as_string")
+            profile["last_string"] = aggregations["last"].get("value_as_string")
+        for field, bucket in aggregations.get("fields", {}).get("buckets", {}).items():
+            counts[field] = bucket["doc_count"]
+    profile["counts"] = counts
+    return profile
+
+
+def _field_profile(doctype, refresh=False):
+    """Returns the field coverage profile of a doctype
+
+    The profile (the number of documents, the number of documents per field
+    and the first and last META.ADDED) is cached. Later calls only count the
+    documents added since the last call, and the fields that were added to
+    the mapping since. Changes to existing documents, such as fields added by
+    processors, are only picked up when the profile is recomputed, which
+    happens after PROFILE_MAX_AGE seconds or with `refresh=True`, and when
+    documents were deleted: either through `core.database` in this process,
+    or otherwise noticed because the number of documents does not add up.
+    """
+    properties = _doctype_properties(doctype)
+    fields = sorted(key for key in properties if key != "META")
+    doctype_query = {"term": {"doctype": doctype}}
+    profile = None if refresh else _profile_cache.peek(doctype)
+    if not profile or profile["last"] is None:
+        profile = _field_counts({"bool": {"filter": doctype_query}}, fields)
+    else:
+        added = _field_counts(
+            {
+                "bool": {
+                    "filter": [
+                        doctype_query,
+                        {
+                            "range": {
+                                "META.ADDED": {
+                                    "gt": int(profile["last"]),
+                                    "format": "epoch_millis",
+                                }
+                            }
+                        },
+                    ]
+                }
+            },
+            [field for field in fields if field in profile["counts"]],
+        )
+        total = _client.count(
+            index=_search_index(doctype), body={"query": doctype_query}
+        )["count"]
+        if total != profile["total"] + added["total"]:
+            # documents were deleted (or added without META.ADDED) elsewhere
+            return _field_profile(doctype, refresh=True)
+        # the cached profile is not changed, in case another thread reads it
+        profile = dict(profile, counts=dict(profile["counts"]))
+        if added["total"]:
+            profile["total"] += added["total"]
+            profile["last"] = added["last"]
+            profile["last_string"] = added["last_string"]
+            for field, count in added["counts"].items():
+                profile["counts"][field] += count
+        new_fields = [field for field in fields if field not in profile["counts"]]
+        if new_fields:
+            profile["counts"].update(
+                _field_counts({"bool": {"filter": doctype_query}}, new_fields)["counts"]
+            )
+    profile["types"] = {
+        field: properties[field].get("type", "unknown") for field in fields
+    }
+    _profile_cache.put(doctype, profile)
+    return profile
+
+
+def doctype_fields(doctype, refresh=False):
     """
     returns a summary of fields for documents of `doctype`:
     field : type - count (coverage)
 
     note:
-        As elasticsearch does not natively support an 'all fields' query,
-        this function runs a 1000 document sample and takes the union of
-        found keys as a proxy of fields shared by all documents.
+        The coverage of all fields is counted with a few aggregation
+        requests and cached, subsequent calls only count new documents.
+        Use `refresh=True` to count all documents again.
     """
     if not _DATABASE_AVAILABLE:
         _logger.warning(
@@ -214,44 +460,22 @@ def doctype_fields(doctype):
         )
         return []
 
-    doc_num = _client.search(
-        index=_elastic_index, body={"query": {"term": {"doctype": doctype}}}
-    )["hits"]["total"]
-    mappings = (
-        _client.indices.get_mapping(_elastic_index)
-        .get(_elastic_index, {})
-        .get("mappings", {})
-        .get("doc", {})
-        .get("properties", {})
-    )
-    coverage = {
-        key: _client.search(
-            _elastic_index,
-            body={
-                "query": {
-                    "bool": {
-                        "filter": [
-                            {"exists": {"field": key}},
-                            {"term": {"doctype": doctype}},
-                        ]
-                    }
-                }
-            },
-        )
-        .get("hits", {})
-        .get("total", 0)
-        for key in mappings.keys()
-        if key != "META"
-    }
-    summary = {
+    return _coverage(_field_profile(doctype, refresh))
+
+
+def _coverage(profile):
+    """The type and share of documents per field of a field profile"""
+    if not profile["total"]:
+        return {}
+    return {
         k: {
-            "coverage": coverage.get(k, "unknown") / float(doc_num),
-            "type": mappings[k].get("type", "unknown"),
+            # fields counted after the total (new fields) may count more documents
+            "coverage": min(1.0, count / float(profile["total"])),
+            "type": profile["types"].get(k, "unknown"),
         }
-        for k in mappings.keys()
-        if k != "META" and coverage.get(k, "unknown") != 0
+        for k, count in profile["counts"].items()
+        if count != 0 and k in profile["types"]
     }
-    return summary
 
 
 def missing_field(doctype=None, field="_source", stats_only=True):
@@ -262,9 +486,9 @@ def missing_field(doctype=None, field="_source", stats_only=True):
         return []
     query = {"query": {"bool": {"must_not": {"exists": {"field": field}}}}}
     if not doctype:
-        result = _client.search(_elastic_index, body=query)
+        result = _client.search(_search_index(), body=query)
     else:
-        result = _client.search(_elastic_index, doctype, body=query)
+        result = _client.search(_search_index(doctype), doctype, body=query)
     if not stats_only:
         return result["hits"]["hits"]
     else:
@@ -280,13 +504,15 @@ def missing_field(doctype=None, field="_source", stats_only=True):
         return stats
 
 
-def doctype_inspect(doctype):
+def doctype_inspect(doctype, refresh=False):
     """Show some information about documents of a specified type
 
     Parameters
     ----------
     doctype : string
         string specifying the doctype to examine (see list_doctypes for available documents)
+    refresh : bool (default=False)
+        count all documents again instead of updating the cached profile
 
     Returns
     -------
@@ -309,19 +535,17 @@ def doctype_inspect(doctype):
 
     """
 
-    firstdocs = doctype_first(doctype, by_field="META.ADDED")
-    lastdocs = doctype_last(doctype, by_field="META.ADDED")
+    if not _DATABASE_AVAILABLE:
+        _logger.warning("Could not inspect doctype: No database instance available")
+        return {}
 
+    profile = _field_profile(doctype, refresh)
+    keys = _coverage(profile)
     summary = dict(
-        total_collected=_client.search(
-            index=_elastic_index, body={"query": {"term": {"doctype": doctype}}}
-        )["hits"]["total"],
-        first_collected=firstdocs
-        and firstdocs[0].get("_source", {}).get("META", {}).get("ADDED", None)
-        or None,
-        last_collected=lastdocs
-        and lastdocs[0].get("_source", {}).get("META", {}).get("ADDED", None),
-        keys=doctype_fields(doctype),
+        total_collected=profile["total"],
+        first_collected=profile["first_string"],
+        last_collected=profile["last_string"],
+        keys=keys,
     )
 
     return summary
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import pytest
+
+from inca.core import database, search_utils
+from inca.core.metadata_cache import profile_cache
+
+
+class ProfileClient(object):
+    """Answers the requests of a field profile over a list of documents"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.indices = SimpleNamespace(
+            get_mapping=lambda index: {
+                "inca": {
+                    "mappings": {
+                        "doc": {"properties": {"text": {"type": "text"}, "META": {}}}
+                    }
+                }
+            }
+        )
+
+    def _matching(self, query):
+        filters = query["bool"]["filter"]
+        if type(filters) == dict:
+            filters = [filters]
+        since = [f["range"]["META.ADDED"]["gt"] for f in filters if "range" in f]
+        return [d for d in self.documents if not since or d["META.ADDED"] > since[0]]
+
+    def search(self, index=None, body=None):
+        matching = self._matching(body["query"])
+        aggregations = {
+            "fields": {
+                "buckets": {
+                    field: {"doc_count": sum(1 for d in matching if field in d)}
+                    for field in body["aggs"]
+                    .get("fields", {})
+                    .get("filters", {})
+                    .get("filters", {})
+                }
+            }
+        }
+        added = [d["META.ADDED"] for d in matching]
+        for name, function in (("first", min), ("last", max)):
+            value = function(added) if added else None
+            aggregations[name] = {"value": value, "value_as_string": str(value)}
+        return {
+            "hits": {"total": {"value": len(matching)}},
+            "aggregations": aggregations,
+        }
+
+    def count(self, index=None, body=None):
+        return {"count": len(self.documents)}
+
+
+@pytest.fixture
+def profile_client(monkeypatch):
+    documents = [{"text": "a", "META.ADDED": n} for n in range(1, 5)]
+    fake = ProfileClient(documents)
+    monkeypatch.setattr(search_utils, "_client", fake)
+    monkeypatch.setattr(search_utils, "_search_index", lambda doctype=None: "inca")
+    monkeypatch.setattr(search_utils, "_index_for_query", lambda query: "inca")
+    profile_cache.invalidate()
+    yield fake
+    profile_cache.invalidate()
+
+
+def test_profile_counts_added_documents(profile_client):
+    assert search_utils._field_profile("test")["total"] == 4
+    profile_client.documents.append({"META.ADDED": 5})
+    profile = search_utils._field_profile("test")
+    assert (profile["total"], profile["counts"]["text"]) == (5, 4)
+
+
+def test_profile_is_recomputed_after_deletions(profile_client):
+    search_utils._field_profile("test")
+    # deleted elsewhere: the number of documents does not add up
+    del profile_client.documents[0]
+    assert search_utils._coverage(search_utils._field_profile("test")) == {
+        "text": {"coverage": 1.0, "type": "text"}
+    }
+    assert search_utils._field_profile("test")["total"] == 3
+    # deleted through core.database
+    database._forget_deleted()
+    assert profile_cache.peek("test") is None
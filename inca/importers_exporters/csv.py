@@ -103,6 +103,17 @@ class export_csv(Exporter):
 
     batchsize = 1000
 
+    def _source_filter(
+        self, fields=None, include_meta=False, include_html=False, *args, **kwargs
+    ):
+        """Only retrieve the fields that are written to the csv file"""
+        source_excludes = []
+        if not include_meta:
+            source_excludes.append("META")
+        if not include_html:
+            source_excludes.append("htmlsource")
+        return fields or None, source_excludes
+
     def save(
         self,
         documents,
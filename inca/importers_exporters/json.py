@@ -70,6 +70,12 @@ class export_json_file(Exporter):
 
     version = 0.1
 
+    def _source_filter(self, compression=None, include_meta=False, *args, **kwargs):
+        """Do not retrieve META information if it is not exported"""
+        if include_meta:
+            return None, None
+        return None, ["META"]
+
     def save(
         self, batch_of_documents, destination, compression=None, include_meta=False
     ):
@@ -111,6 +117,12 @@ class export_json_files(Exporter):
 
     version = 0.1
 
+    def _source_filter(self, compression=None, include_meta=False, *args, **kwargs):
+        """Do not retrieve META information if it is not exported"""
+        if include_meta:
+            return None, None
+        return None, ["META"]
+
     def save(
         self, batch_of_documents, destination, compression=None, include_meta=False
     ):
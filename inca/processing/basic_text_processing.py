@@ -20,9 +20,26 @@ except ImportError:
 
 
 from sys import maxunicode
+from functools import lru_cache
 import unicodedata
 
 
+@lru_cache(maxsize=None)
+def _stopword_list(language):
+    """The nltk stopwords of a language, loaded once per process"""
+    from nltk.corpus import stopwords as sw
+
+    return frozenset(sw.words(language))
+
+
+@lru_cache(maxsize=None)
+def _stemmer(language):
+    """The nltk snowball stemmer of a language, created once per process"""
+    from nltk.stem.snowball import SnowballStemmer
+
+    return SnowballStemmer(language)
+
+
 class clean_whitespace(Processer):
     """Changes multiple whitespace to single whitespace"""
 
@@ -200,9 +217,7 @@ stopwords = requests.get("https://raw.githubusercontent.com/stopwords-iso/stopwo
         if stopwords in supported_languages:
             # if a language name instead of a stopword list is  provided,
             # use NLTK stopword lists
-            from nltk.corpus import stopwords as sw
-
-            stopwords = set(sw.words(stopwords))
+            stopwords = _stopword_list(stopwords)
 
         doc = " ".join(
             [w for w in str(document_field).split() if w.lower() not in stopwords]
@@ -215,9 +230,7 @@ class stemming(Processer):
     """Stems all the words in a document, based on nltk snowball stemming. Expects the keyword 'language' with the language  of the document as string as input, for example "dutch"."""
 
     def process(self, document_field, language):
-        from nltk.stem.snowball import SnowballStemmer
-
-        stemmer = SnowballStemmer(language)
+        stemmer = _stemmer(language)
         doc = ""
         for w in document_field.split():
             doc += " " + stemmer.stem(w)
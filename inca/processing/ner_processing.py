@@ -1,33 +1,85 @@
 # -*- coding: utf-8 -*-
 from ..core.processor_class import Processer
 from ..core.basic_utils import dotkeys
+from ..core.models import model_registry
 import logging
 import re
 import sys
 
 import spacy
-import nl_core_news_sm
 
-nlp = nl_core_news_sm.load()
+logger = logging.getLogger("INCA")
 
+# the pipeline components that named entity recognition depends on
+NER_COMPONENTS = ("ner", "tok2vec", "transformer")
 
-logger = logging.getLogger("INCA")
+# the first spaCy version whose `nlp.pipe` accepts `n_process`
+N_PROCESS_VERSION = (2, 2, 2)
 
 
 class ner(Processer):
-    """Named Entity Recognition using spacy.io"""
-
-    def process(self, document_field):
-        """NER based on spacy.io"""
-        doc = nlp(document_field)
-        nes = []
-        for ent in doc.ents:
-            nes.append(
-                {
-                    "text": ent.text,
-                    "start_char": ent.start_char,
-                    "end_char": ent.end_char,
-                    "label": ent.label_,
-                }
-            )
-        return nes
+    """Named Entity Recognition using spacy.io
+
+    The 'batch', 'parallel' and 'celery_batch' actions of `runwrap` stream
+    the texts of a page through `nlp.pipe`, with the pipeline components
+    that are not needed for NER disabled.
+    """
+
+    def process(self, document_field, model="nl_core_news_sm", **kwargs):
+        """NER based on spacy.io, `model` is the name or path of a spaCy model
+
+        Other keyword arguments, such as `extra_fields`, are not used.
+        """
+        return _entities(_nlp(model)(document_field))
+
+    def process_batch(
+        self,
+        document_fields,
+        model="nl_core_news_sm",
+        pipe_batch_size=64,
+        n_process=1,
+        **kwargs
+    ):
+        """NER on a list of texts with `nlp.pipe`, in batches of
+        `pipe_batch_size` texts and `n_process` processes
+
+        `n_process` needs spaCy 2.2.2 or later, older versions use a single
+        process. Other keyword arguments, such as `extra_fields`, are not
+        used.
+        """
+        nlp = _nlp(model)
+        disable = [name for name in nlp.pipe_names if name not in NER_COMPONENTS]
+        options = dict(batch_size=pipe_batch_size, disable=disable)
+        if n_process != 1:
+            if _spacy_version() >= N_PROCESS_VERSION:
+                options["n_process"] = n_process
+            else:
+                logger.warning(
+                    "spaCy {spacy.__version__} does not support n_process, "
+                    "using a single process".format(spacy=spacy)
+                )
+        return [_entities(doc) for doc in nlp.pipe(document_fields, **options)]
+
+
+def _entities(doc):
+    return [
+        {
+            "text": ent.text,
+            "start_char": ent.start_char,
+            "end_char": ent.end_char,
+            "label": ent.label_,
+        }
+        for ent in doc.ents
+    ]
+
+
+def _nlp(model):
+    """The spaCy model `model`, loaded once per process"""
+    return model_registry.get("spacy:%s" % model, lambda: spacy.load(model))
+
+
+def _spacy_version():
+    """The version of spaCy as a tuple of integers"""
+    return tuple(
+        int(part) for part in re.findall(r"\d+", spacy.__version__.split("+")[0])[:3]
+    )
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from ..core.processor_class import Processer
 from ..core.basic_utils import dotkeys
+from ..core.models import model_registry
 import logging
+import os
 import re
 import sys
 
@@ -14,11 +16,7 @@ class pretrained(Processer):
 
     def process(self, document_field, path_to_model):
         """classification based on pretrained model"""
-        try:
-            prediction = self.clf.predict([document_field])
-        except AttributeError:
-            self.load_model(path_to_model)
-            prediction = self.clf.predict([document_field])
+        prediction = self.load_model(path_to_model).predict([document_field])
 
         if type(prediction) is ndarray and len(prediction) == 1:
             prediction = prediction[0]
@@ -27,4 +25,7 @@ class pretrained(Processer):
         return prediction
 
     def load_model(self, path_to_model):
-        self.clf = joblib.load(path_to_model)
+        """Returns the model at `path_to_model`, loaded once per process"""
+        path = os.path.abspath(os.path.expanduser(path_to_model))
+        self.clf = model_registry.get(path, lambda: joblib.load(path))
+        return self.clf
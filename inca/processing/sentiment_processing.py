@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from ..core.processor_class import Processer
 from ..core.basic_utils import dotkeys
+from ..core.models import model_registry
 import logging
 import re
 import sys
@@ -25,7 +26,7 @@ class sentiment_vader_en(Processer):
     def process(self, document_field):
         """Added sentiment based on Vader"""
         try:
-            senti = vader.SentimentIntensityAnalyzer()
+            senti = model_registry.get("vader", vader.SentimentIntensityAnalyzer)
             sentimentscores = senti.polarity_scores(document_field)
             return sentimentscores
         except LookupError:
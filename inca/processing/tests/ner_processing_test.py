@@ -0,0 +1,68 @@
+"""
+TESTS FOR ner
+"""
+
+import pytest
+
+pytest.importorskip("spacy")
+
+from inca.processing import ner_processing
+
+
+class FakeEntity(object):
+    def __init__(self, text, start):
+        self.text = text
+        self.start_char = start
+        self.end_char = start + len(text)
+        self.label_ = "PER"
+
+
+class FakeDoc(object):
+    def __init__(self, text):
+        self.ents = [
+            FakeEntity(word, text.index(word))
+            for word in text.split()
+            if word.istitle()
+        ]
+
+
+class FakeNLP(object):
+    pipe_names = ["tagger", "parser", "ner"]
+
+    def __init__(self):
+        self.options = None
+
+    def __call__(self, text):
+        return FakeDoc(text)
+
+    def pipe(self, texts, **options):
+        self.options = options
+        return (FakeDoc(text) for text in texts)
+
+
+@pytest.fixture
+def nlp(monkeypatch):
+    nlp = FakeNLP()
+    monkeypatch.setattr(ner_processing, "_nlp", lambda model: nlp)
+    return nlp
+
+
+def test_process_batch_ignores_extra_fields(nlp):
+    results = ner_processing.ner().process_batch(
+        ["met Angela Merkel", "niemand"], extra_fields=[{"a": 1}, {"a": 2}]
+    )
+    assert [[entity["text"] for entity in result] for result in results] == [
+        ["Angela", "Merkel"],
+        [],
+    ]
+    assert nlp.options == dict(batch_size=64, disable=["tagger", "parser"])
+
+
+@pytest.mark.parametrize(
+    "version, options",
+    [("2.1.0", {}), ("2.2.2", {"n_process": 2}), ("3.0.0rc1", {"n_process": 2})],
+)
+def test_n_process_depends_on_spacy_version(nlp, monkeypatch, version, options):
+    monkeypatch.setattr(ner_processing.spacy, "__version__", version)
+    ner_processing.ner().process_batch(["Keulen"], n_process=2)
+    assert {k: v for k, v in nlp.options.items() if k == "n_process"} == options
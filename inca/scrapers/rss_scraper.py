@@ -3,7 +3,7 @@ import datetime
 from lxml.html import fromstring
 from ..core.scraper_class import Scraper
 from ..core.scraper_class import UnparsableException
-from ..core.database import check_exists
+from ..core.database import check_exists_many
 import logging
 import feedparser
 import re
@@ -109,13 +109,13 @@ class rss(Scraper):
         for thisurl in RSS_URL:
             rss_body = self.get_page_body(thisurl)
             d = feedparser.parse(rss_body)
-            for post in d.entries:
-                try:
-                    _id = post.id
-                except:
-                    _id = post.link
-                if _id == None:
-                    _id = post.link
+            post_ids = [self._post_id(post) for post in d.entries]
+            # look up all items of the feed at once instead of one request per item
+            if save == False:
+                existing = {}
+            else:
+                existing = check_exists_many(post_ids)
+            for post, _id in zip(d.entries, post_ids):
                 link = re.sub("/$", "", self.getlink(post.link))
                 # By now, we have retrieved the RSS feed. We now have to determine for the item that
                 # we are currently processing (post in d.entries), whether we want to follow its
@@ -124,7 +124,7 @@ class rss(Scraper):
                 # work with the database backend (as indicated by save=False), we probably also
                 # do not want to look something up in the database. We therefore also retrieve it in
                 # that case.
-                if save == False or check_exists(_id)[0] == False:
+                if save == False or existing.get(str(_id), False) == False:
                     try:
                         req = requests.get(
                             link,
@@ -196,6 +196,16 @@ class rss(Scraper):
                     docnoemptykeys = {k: v for k, v in doc.items() if v or v == False}
                     yield docnoemptykeys
 
+    def _post_id(self, post):
+        """Returns the identifier of an RSS entry, falling back to its link"""
+        try:
+            _id = post.id
+        except:
+            _id = post.link
+        if _id == None:
+            _id = post.link
+        return _id
+
     def get_page_body(self, url, **kwargs):
         """Makes an HTTP request to the given URL and returns a string containing the response body"""
         request = requests.get(url, headers={"User-Agent": "Wget/1.9"})
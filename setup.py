@@ -42,6 +42,7 @@ setup(
     package_data={"": ["*.cfg", "schema.json"]},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={"async": ["elasticsearch[async]>=7.8,<8"]},
     dependency_links=[],
     zip_safe=False,
 )